@@ -0,0 +1,633 @@
+"""
+Benchmarks for lockserver.py
+
+    python lockbench.py dispatch [sizes]
+
+dispatch
+    per-event dispatch cost of the server loop with a single active client and some number of
+    idle connections (default 100,1000,10000).  Idle connections are unused datagram sockets
+    so that 10k of them fit in the default fd limits.  The legacy select.select() cost over the same
+    fds is shown alongside where the fds fit in FD_SETSIZE.
+
+parse [commands]
+    server throughput on a burst of pipelined commands (default 10000) written by one client as
+    fast as the socket takes them, plain and tagged.  This is mostly the cost of splitting the input
+    into lines and dispatching them.  The queued run has the burst pile up behind an xlockwait that
+    is only granted once all of it has arrived, so the whole burst is parsed out of one buffer.
+
+journal [entries]
+    cost of the journal: lock throughput for a burst of pipelined xlocks on distinct names
+    (default 100000) with no journal and with each fsync policy, then how long a restart takes to
+    rebuild that state from the log alone and from a snapshot.
+
+shards [counts] [clients]
+    uncontended lock/release throughput of a single process server (count 0) against sharded
+    servers (default 0,1,2,4 shards, one router per shard).  Each of the client processes (default
+    one per cpu) takes and releases its own set of names in pipelined batches for a few seconds.
+
+load [scenarios] [clients] [seconds]
+    throughput and latency percentiles of a local server under each scenario (default all of them,
+    8 client processes, 3 seconds each).  Every client makes one request at a time and each
+    operation is timed from the client:
+        uncontended  xlockwait/release on a name of its own
+        hot          xlockwait/release on one name everyone wants
+        readers      slockwait/release on one name, one operation in 20 is an xlockwait instead
+        msgs         set a message and get another client's
+        connect      connect, count and hang up
+        cached       Lock() on a name of its own, mostly with cache=True so it stays on the
+                     connection, but now and then without cache or shared, which reuses, downgrades
+                     or gives back the cached grant
+
+transport [round trips]
+    latency of a single client talking to a local server over loopback TCP and over the server's
+    unix domain socket: count round trips (default 20000) one at a time, and connect, count and
+    hang up (a tenth as many).
+
+storm [connections] [backlogs]
+    a crowd of clients (default 2000) all connecting to a local server at once and sending a count,
+    as when a batch scheduler starts its workers together.  Reports how long until every one of them
+    has its reply, for each listen backlog (default 5, the old fixed value, and the server default).
+
+grant [sizes]
+    cost of handing a lock to a queue of shared waiters (default 2000,4000,8000) all at once when
+    the exclusive holder releases it, with each policy.  The time per waiter should stay flat as
+    the queue grows.
+
+Results are printed as JSON so they can be diffed between versions.
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import select
+import selectors
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import lockserver
+
+
+def raiseFdLimit(wanted):
+    "try to raise the open file limit to at least wanted fds, returns the resulting soft limit"
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= wanted:
+        return soft
+    for limit in ((wanted, max(hard, wanted)), (min(wanted, hard), hard)):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limit)
+            break
+        except (ValueError, OSError):
+            pass
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def resetServerState():
+    for conn in list(lockserver.ClientDict.values()):
+        if isinstance(conn, lockserver.LockConnection):
+            conn.killClient()
+    lockserver.ClientDict.clear()
+    lockserver.LockDict.clear()
+    lockserver.MsgDict.clear()
+
+
+def benchDispatch(idle, iterations=20000, edgeTriggered=False):
+    server = lockserver.LockServer(edgeTriggered=edgeTriggered, start=False)
+    # keep the "new client" chatter from drowning the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(idle):
+            # an unused datagram socket never becomes readable and only costs one fd
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            lockserver.LockConnection(sock, "idle%d"%i, server)
+        client, serverEnd = socket.socketpair()
+        lockserver.LockConnection(serverEnd, "active", server)
+
+    request = b"count benchlock\n"
+    elapsed = 0.0
+    for i in range(iterations):
+        client.send(request)
+        start = time.perf_counter()
+        server.runOnce(None)
+        elapsed += time.perf_counter() - start
+        client.recv(select.PIPE_BUF)
+
+    legacy = None
+    fds = list(lockserver.ClientDict.keys())
+    if max(fds) < 1024:
+        client.send(request)
+        start = time.perf_counter()
+        for i in range(iterations):
+            select.select(lockserver.ClientDict.keys(), [], lockserver.ClientDict.keys(), 0)
+        legacy = (time.perf_counter() - start) / iterations * 1e6
+        server.runOnce(None)
+        client.recv(select.PIPE_BUF)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        resetServerState()
+    server.selector.close()
+    client.close()
+
+    return {"idle": idle,
+            "edgeTriggered": server.edgeTriggered,
+            "iterations": iterations,
+            "usPerDispatch": elapsed / iterations * 1e6,
+            "usPerLegacySelect": legacy}
+
+
+def runDispatch(args):
+    sizes = [100, 1000, 10000]
+    if args:
+        sizes = [int(s) for s in args[0].split(',')]
+    limit = raiseFdLimit(max(sizes) + 64)
+
+    results = []
+    for idle in sizes:
+        if idle + 64 > limit:
+            results.append({"idle": idle, "skipped": "open file limit is %d"%limit})
+            continue
+        for edge in (False, True):
+            results.append(benchDispatch(idle, edgeTriggered=edge))
+    return {"benchmark": "dispatch", "results": results}
+
+
+def pump(server, client, data, expected):
+    "feed data to the server as fast as it takes it and run it until expected bytes of replies are back"
+    view = memoryview(data)
+    received = 0
+    while received < expected:
+        if view:
+            try:
+                view = view[client.send(view):]
+            except BlockingIOError:
+                pass
+        server.runOnce(0)
+        try:
+            received += len(client.recv(1<<20))
+        except BlockingIOError:
+            pass
+
+
+def benchParse(commands, tagged=False, queued=False, rounds=5):
+    server = lockserver.LockServer(start=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        client, serverEnd = socket.socketpair()
+        conn = lockserver.LockConnection(serverEnd, "active", server)
+        holder, holderEnd = socket.socketpair()
+        lockserver.LockConnection(holderEnd, "holder", server)
+    client.setblocking(False)
+
+    if tagged:
+        burst = b"".join(b"@%d count benchlock\n"%i for i in range(commands))
+    else:
+        burst = b"count benchlock\n" * commands
+    reply = b"ACCESSCOUNT benchlock 0\n"
+    expected = len(reply) * commands + (len(burst) - len(b"count benchlock\n") * commands)
+    if queued:
+        expected += len(b"ACQUIRED queuelock\nRELEASED queuelock\n")
+
+    best = None
+    for r in range(rounds):
+        view = memoryview(burst)
+        if queued:
+            # park the whole burst behind a wait, then time how long it takes to get through it
+            holder.send(b"xlock queuelock\n")
+            server.runOnce(None)
+            holder.recv(select.PIPE_BUF)
+            client.send(b"xlockwait queuelock\n")
+            while view or (conn.reading and select.select([serverEnd], [], [], 0)[0]):
+                try:
+                    view = view[client.send(view):]
+                except BlockingIOError:
+                    pass
+                server.runOnce(0)
+            view = memoryview(b"release queuelock\n")
+
+        start = time.perf_counter()
+        if queued:
+            holder.send(b"release queuelock\n")
+        pump(server, client, view, expected)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        if queued:
+            holder.recv(select.PIPE_BUF)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        resetServerState()
+    server.selector.close()
+    client.close()
+    holder.close()
+
+    return {"commands": commands,
+            "tagged": tagged,
+            "queued": queued,
+            "bytes": len(burst),
+            "bestSeconds": best,
+            "commandsPerSecond": commands / best,
+            "usPerCommand": best / commands * 1e6}
+
+
+def runParse(args):
+    commands = 10000
+    if args:
+        commands = int(args[0])
+    return {"benchmark": "parse",
+            "results": [benchParse(commands, tagged, queued) for tagged, queued in
+                        ((False, False), (True, False), (False, True))]}
+
+
+def benchJournal(entries, fsync):
+    directory = tempfile.mkdtemp()
+    server = lockserver.LockServer(start=False, journal=directory if fsync else None, fsync=fsync or "always")
+    with contextlib.redirect_stdout(io.StringIO()):
+        client, serverEnd = socket.socketpair()
+        lockserver.LockConnection(serverEnd, "active", server)
+    client.setblocking(False)
+
+    burst = b"".join(b"xlock j%d\n"%i for i in range(entries))
+    start = time.perf_counter()
+    pump(server, client, burst, len(burst) + len(b"ACQUIRED ") * entries - len(b"xlock ") * entries)
+    result = {"entries": entries,
+              "fsync": fsync,
+              "usPerLock": (time.perf_counter() - start) / entries * 1e6}
+
+    journal = server.journal
+    server.journal = None  # don't log the cleanup
+    with contextlib.redirect_stdout(io.StringIO()):
+        resetServerState()
+    server.selector.close()
+    client.close()
+
+    if journal is not None:
+        journal.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            recovered = lockserver.LockServer(start=False, journal=directory)
+            result["recoverFromLogSeconds"] = time.perf_counter() - start
+            assert len(lockserver.LockDict) == entries
+
+            recovered.journal.snapshot()
+            if recovered.journal.snapshotPid is not None:
+                os.waitpid(recovered.journal.snapshotPid, 0)
+            recovered.journal.close()
+            recovered.selector.close()
+            resetServerState()
+            start = time.perf_counter()
+            recovered = lockserver.LockServer(start=False, journal=directory)
+            result["recoverFromSnapshotSeconds"] = time.perf_counter() - start
+            assert len(lockserver.LockDict) == entries
+            recovered.journal.close()
+            recovered.selector.close()
+            resetServerState()
+    shutil.rmtree(directory)
+    return result
+
+
+def runJournal(args):
+    entries = 100000
+    if args:
+        entries = int(args[0])
+    return {"benchmark": "journal",
+            "results": [benchJournal(entries, fsync) for fsync in (None, "never", 1.0, "always")]}
+
+
+def runServer(port, shards, unixSocket=None, backlog=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        if shards:
+            lockserver.ShardedLockServer('127.0.0.1', port, shards, unixSocket=unixSocket, backlog=backlog)
+        else:
+            signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+            lockserver.LockServer('127.0.0.1', port, unixSocket=unixSocket, backlog=backlog)
+
+
+def lockReleaseClient(port, client, seconds, results, batch=50):
+    lc = None
+    for i in range(50):
+        try:
+            lc = lockserver.LockClient('127.0.0.1', port)
+            break
+        except OSError:
+            time.sleep(0.1)
+    names = ["c%d.%d"%(client, i) for i in range(batch)]
+    requests = [(cmd, name) for name in names for cmd in ("xlock", "release")]
+    ops = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        lc.batch(requests)
+        ops += batch
+    results.put(ops)
+
+
+def benchShards(shards, clients, seconds=3.0):
+    port = random.randint(30000, 60000)
+    server = multiprocessing.Process(target=runServer, args=(port, shards))
+    server.start()
+    time.sleep(0.5)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=lockReleaseClient, args=(port, c, seconds, results))
+             for c in range(clients)]
+    for proc in procs:
+        proc.start()
+    ops = sum(results.get() for proc in procs)
+    for proc in procs:
+        proc.join()
+    server.terminate()
+    server.join()
+    return {"shards": shards,
+            "clients": clients,
+            "seconds": seconds,
+            "lockReleasesPerSecond": ops / seconds}
+
+
+def runShards(args):
+    counts = [0, 1, 2, 4]
+    if args:
+        counts = [int(c) for c in args[0].split(',')]
+    clients = os.cpu_count() or 1
+    if len(args) > 1:
+        clients = int(args[1])
+    return {"benchmark": "shards", "cpus": os.cpu_count(),
+            "results": [benchShards(shards, clients) for shards in counts]}
+
+
+def loadOp(scenario, lc, client, clients, rng):
+    "one operation of the load scenario, returns the LockClient to use for the next one"
+    if scenario == "uncontended":
+        name = "u%d.%d"%(client, rng.randrange(16))
+        lc.getLock("xlockwait", name)
+        lc.releaseLock(name)
+    elif scenario == "hot":
+        lc.getLock("xlockwait", "hot")
+        lc.releaseLock("hot")
+    elif scenario == "readers":
+        lc.getLock("xlockwait" if rng.randrange(20) == 0 else "slockwait", "readers")
+        lc.releaseLock("readers")
+    elif scenario == "msgs":
+        lc.setMsg("m%d"%client, "update %d"%rng.randrange(1000000))
+        lc.getMsg("m%d"%rng.randrange(clients))
+    elif scenario == "connect":
+        lc = lockserver.LockClient(lc.host, lc.port)
+        lc.getAccessCount("hot")
+        lc.close()
+    elif scenario == "cached":
+        lock = lockserver.Lock("c%d"%client, shared=rng.randrange(4) == 0, cache=rng.randrange(4) != 0,
+                               lockClient=lc)
+        lock.lock()
+        lock.release()
+    return lc
+
+
+def loadClient(port, scenario, client, clients, seconds, results):
+    lc = None
+    for i in range(50):
+        try:
+            lc = lockserver.LockClient('127.0.0.1', port)
+            break
+        except OSError:
+            time.sleep(0.1)
+    rng = random.Random(client)
+    latency = lockserver.Histogram()
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        opStart = time.perf_counter_ns()
+        loadOp(scenario, lc, client, clients, rng)
+        latency.record(time.perf_counter_ns() - opStart)
+    results.put((latency.counts, latency.total, latency.max, time.perf_counter() - start))
+
+
+LoadScenarios = ("uncontended", "hot", "readers", "msgs", "connect", "cached")
+
+
+def benchLoad(scenario, clients, seconds):
+    port = random.randint(30000, 60000)
+    server = multiprocessing.Process(target=runServer, args=(port, 0))
+    server.start()
+    time.sleep(0.5)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=loadClient, args=(port, scenario, c, clients, seconds, results))
+             for c in range(clients)]
+    for proc in procs:
+        proc.start()
+    latency = lockserver.Histogram()
+    elapsed = 0.0
+    for proc in procs:
+        counts, total, longest, clientSeconds = results.get()
+        for index, count in counts.items():
+            latency.counts[index] = latency.counts.get(index, 0) + count
+        latency.total += total
+        latency.max = max(latency.max, longest)
+        elapsed = max(elapsed, clientSeconds)
+    for proc in procs:
+        proc.join()
+    server.terminate()
+    server.join()
+    ops = latency.count
+    return {"scenario": scenario,
+            "clients": clients,
+            "seconds": elapsed,
+            "ops": ops,
+            "opsPerSecond": ops / elapsed,
+            "latencyUs": latency.summary(1e3)}
+
+
+def runLoad(args):
+    scenarios = LoadScenarios
+    if args:
+        scenarios = args[0].split(',')
+        for scenario in scenarios:
+            if scenario not in LoadScenarios:
+                raise ValueError("unknown scenario %s"%scenario)
+    clients = 8
+    if len(args) > 1:
+        clients = int(args[1])
+    seconds = 3.0
+    if len(args) > 2:
+        seconds = float(args[2])
+    return {"benchmark": "load", "cpus": os.cpu_count(),
+            "results": [benchLoad(scenario, clients, seconds) for scenario in scenarios]}
+
+
+def benchTransport(transport, port, path, roundTrips):
+    unixSocket = path if transport == "unix" else None
+    lc = lockserver.LockClient('127.0.0.1', port, unixSocket=unixSocket)
+    assert (lc.sock.family == socket.AF_UNIX) == (transport == "unix")
+    for i in range(1000):
+        lc.getAccessCount("bench")
+    roundTrip = lockserver.Histogram()
+    for i in range(roundTrips):
+        start = time.perf_counter_ns()
+        lc.getAccessCount("bench")
+        roundTrip.record(time.perf_counter_ns() - start)
+    lc.close()
+
+    connect = lockserver.Histogram()
+    for i in range(roundTrips // 10):
+        start = time.perf_counter_ns()
+        lc = lockserver.LockClient('127.0.0.1', port, unixSocket=unixSocket)
+        lc.getAccessCount("bench")
+        lc.close()
+        connect.record(time.perf_counter_ns() - start)
+    return {"transport": transport,
+            "roundTrips": roundTrips,
+            "roundTripUs": roundTrip.summary(1e3),
+            "connectUs": connect.summary(1e3)}
+
+
+def runTransport(args):
+    roundTrips = 20000
+    if args:
+        roundTrips = int(args[0])
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "lockserver.sock")
+    port = random.randint(30000, 60000)
+    server = multiprocessing.Process(target=runServer, args=(port, 0, path))
+    server.start()
+    try:
+        for i in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        time.sleep(0.1)
+        return {"benchmark": "transport",
+                "results": [benchTransport(transport, port, path, roundTrips) for transport in ("tcp", "unix")]}
+    finally:
+        server.terminate()
+        server.join(5)
+        if server.is_alive():
+            # SIGTERM can land in the middle of a send and be swallowed as a connection error
+            server.kill()
+            server.join()
+        shutil.rmtree(directory)
+
+
+def benchStorm(connections, backlog, limit=60.0):
+    port = random.randint(30000, 60000)
+    server = multiprocessing.Process(target=runServer, args=(port, 0, None, backlog))
+    server.start()
+    time.sleep(0.5)
+    selector = selectors.DefaultSelector()
+    request = b"count storm\n"
+    start = time.perf_counter()
+    for i in range(connections):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(('127.0.0.1', port))
+        selector.register(sock, selectors.EVENT_WRITE)
+    answered = []  # seconds from the start until each client had its reply
+    failed = 0
+    while len(answered) + failed < connections and time.perf_counter() - start < limit:
+        for key, events in selector.select(1.0):
+            sock = key.fileobj
+            try:
+                if events & selectors.EVENT_WRITE:
+                    sock.send(request)
+                    selector.modify(sock, selectors.EVENT_READ)
+                    continue
+                if sock.recv(4096):
+                    answered.append(time.perf_counter() - start)
+                else:
+                    failed += 1
+            except OSError:
+                failed += 1
+            selector.unregister(sock)
+            sock.close()
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    server.terminate()
+    server.join(5)
+    if server.is_alive():
+        server.kill()
+        server.join()
+    answered.sort()
+    return {"connections": connections,
+            "backlog": backlog,
+            "answered": len(answered),
+            "failed": failed,
+            "p50Seconds": answered[len(answered) // 2] if answered else None,
+            "allSeconds": answered[-1] if len(answered) == connections else None}
+
+
+def runStorm(args):
+    connections = 2000
+    if args:
+        connections = int(args[0])
+    backlogs = [5, lockserver.DefaultListenBacklog]
+    if len(args) > 1:
+        backlogs = [int(b) for b in args[1].split(',')]
+    raiseFdLimit(connections * 2 + 64)
+    somaxconn = None  # the kernel's cap on any backlog
+    if os.path.exists("/proc/sys/net/core/somaxconn"):
+        with open("/proc/sys/net/core/somaxconn") as f:
+            somaxconn = int(f.read())
+    return {"benchmark": "storm", "somaxconn": somaxconn,
+            "results": [benchStorm(connections, backlog) for backlog in backlogs]}
+
+
+class GrantClient(object):
+    "stands in for the connections of the waiters in benchGrant, it just counts its grants"
+    def __init__(self):
+        self.grants = 0
+
+    def notify(self, request):
+        self.grants += 1
+
+
+def benchGrant(waiters, policy, rounds=5):
+    best = None
+    for i in range(rounds):
+        lockserver.LockDict.clear()
+        client = GrantClient()
+        lock = lockserver.ServerLock("bench")
+        lock.policy = policy
+        lock.tryRequest(False)
+        for tag in range(waiters):
+            lockserver.LockRequest(client, tag, [("bench", True)]).wait()
+        start = time.perf_counter()
+        lock.release()
+        elapsed = time.perf_counter() - start
+        assert client.grants == waiters
+        best = elapsed if best is None else min(best, elapsed)
+    lockserver.LockDict.clear()
+    return {"waiters": waiters,
+            "policy": policy,
+            "seconds": best,
+            "usPerWaiter": best / waiters * 1e6}
+
+
+def runGrant(args):
+    sizes = [2000, 4000, 8000]
+    if args:
+        sizes = [int(s) for s in args[0].split(',')]
+    return {"benchmark": "grant",
+            "results": [benchGrant(waiters, policy) for policy in lockserver.LockPolicies for waiters in sizes]}
+
+
+Benchmarks = {"dispatch": runDispatch,
+              "parse": runParse,
+              "journal": runJournal,
+              "shards": runShards,
+              "load": runLoad,
+              "transport": runTransport,
+              "storm": runStorm,
+              "grant": runGrant}
+
+
+def main(argv):
+    if len(argv) < 1 or argv[0] not in Benchmarks:
+        print(__doc__)
+        return 1
+    print(json.dumps(Benchmarks[argv[0]](argv[1:]), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,25 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
+import errno
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import secrets
 import select
+import signal
+import selectors
 import socket
 import sys
+import threading
 import time
+import weakref
+import zlib
 
 
 #############################################################
@@ -94,13 +112,195 @@ def getIp():
 #
 ################################################################
 
+class Histogram(object):
+    """
+    log-linear (HDR style) histogram of non-negative integers.  Values below 2**HistogramBits are
+    counted exactly, above that each power of two is split into 2**(HistogramBits-1) buckets so
+    every value is kept to within about 6%.  Only buckets that have been used take any memory and
+    there are never more than a couple of thousand of them, recording is one dict update.
+    """
+    def __init__(self):
+        self.counts = {}  # key is bucket index, val is how many values landed in it
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = value.bit_length() - HistogramBits
+        index = (shift << HistogramBits) | (value >> shift) if shift > 0 else value
+        try:
+            self.counts[index] += 1
+        except KeyError:
+            self.counts[index] = 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    @staticmethod
+    def bucketTop(index):
+        "the largest value that lands in bucket index"
+        shift = index >> HistogramBits
+        if shift == 0:
+            return index
+        return (((index & ((1 << HistogramBits) - 1)) + 1) << shift) - 1
+
+    def buckets(self):
+        "(largest value, count) for every used bucket, smallest first"
+        return [(self.bucketTop(index), self.counts[index]) for index in sorted(self.counts)]
+
+    def percentile(self, p):
+        "the value p percent of the recorded values are at or below"
+        wanted = self.count * p / 100.0
+        seen = 0
+        for top, count in self.buckets():
+            seen += count
+            if seen >= wanted:
+                return min(top, self.max)
+        return self.max
+
+    def powerBuckets(self):
+        "(upper bound, cumulative count) at every power of two up to the largest value recorded"
+        byBits = {}
+        for index, count in self.counts.items():
+            bits = self.bucketTop(index).bit_length()
+            byBits[bits] = byBits.get(bits, 0) + count
+        result = []
+        seen = 0
+        for bits in range(min(byBits, default=0), max(byBits, default=-1) + 1):
+            seen += byBits.get(bits, 0)
+            result.append(((1 << bits) - 1, seen))
+        return result
+
+    def summary(self, scale=1):
+        "dict of the count, mean, max and the usual percentiles, values divided by scale"
+        count = self.count
+        if count == 0:
+            return {"count": 0}
+        return {"count": count,
+                "mean": self.total / count / scale,
+                "p50": self.percentile(50) / scale,
+                "p99": self.percentile(99) / scale,
+                "p999": self.percentile(99.9) / scale,
+                "max": self.max / scale}
+
+
+class LockStats(object):
+    """
+    contention figures for one lock name.  They outlive the ServerLock (which goes as soon as
+    nobody holds or wants the lock), the least recently used are dropped once there are more than
+    MaxLockStats of them.  Times are in nanoseconds
+    """
+    def __init__(self, lName):
+        self.lName = lName
+        self.acquisitions = 0
+        self.waited = 0  # acquisitions that had to queue first
+        self.failed = 0  # requests turned down, either not waiting or timed out
+        self.maxQueue = 0  # deepest the wait queue has been
+        self.waitTimes = Histogram()
+        self.holdTimes = Histogram()
+
+    def summary(self):
+        lock = LockDict.get(self.lName)
+        return {"lock": self.lName,
+                "holders": lock.accessCount if lock is not None else 0,
+                "queue": len(lock.waitQueue) if lock is not None else 0,
+                "acquisitions": self.acquisitions,
+                "waited": self.waited,
+                "failed": self.failed,
+                "maxQueue": self.maxQueue,
+                "waitSeconds": self.waitTimes.summary(1e9),
+                "holdSeconds": self.holdTimes.summary(1e9)}
+
+
+def lockStats(lName):
+    "returns the LockStats for lName, making it the most recently used"
+    stats = LockStatsDict.get(lName)
+    if stats is None:
+        stats = LockStatsDict[lName] = LockStats(lName)
+        if len(LockStatsDict) > MaxLockStats:
+            LockStatsDict.popitem(last=False)
+    else:
+        LockStatsDict.move_to_end(lName)
+    return stats
+
+
+class WaitQueue(object):
+    """
+    The requests waiting on a ServerLock, in arrival order.  Adding, removing from anywhere in the
+    queue and popping are all O(1).  The shared and the exclusive waiters are also kept in order on
+    their own so a batch of shared waiters can be granted without stepping over exclusive ones.
+    """
+    def __init__(self):
+        self.waiters = collections.OrderedDict()  # key is LockRequest, val is shared
+        self.byMode = {True: collections.OrderedDict(), False: collections.OrderedDict()}
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def append(self, request, shared):
+        self.waiters[request] = shared
+        self.byMode[shared][request] = None
+
+    def remove(self, request):
+        shared = self.waiters.pop(request)
+        del(self.byMode[shared][request])
+
+    def items(self):
+        "(request, shared) for every waiter in arrival order"
+        return self.waiters.items()
+
+    def requests(self):
+        return self.waiters.keys()
+
+    def shared(self):
+        return self.byMode[True].keys()
+
+    def exclusive(self):
+        return self.byMode[False].keys()
+
+    def hasExclusive(self):
+        return len(self.byMode[False]) > 0
+
+
+class ModeQueue(WaitQueue):
+    "the requests waiting on a QueuedLock in arrival order, with the mode each of them wants"
+    def append(self, request, mode):
+        self.waiters[request] = mode
+
+    def remove(self, request):
+        del(self.waiters[request])
+
+
 class ServerLock(object):
-    "A ServerLock object exists for each lock on the server and handles all of the lock accounting"
+    """
+    A ServerLock object exists for each lock on the server and handles all of the lock accounting
+
+    The policy decides who gets the lock when there are waiters:
+      batch  -- (default) waiters are served in order but whenever the lock goes shared every
+                shared waiter gets it, and new shared requests join existing shared holders.
+      fifo   -- strictly first come first served, new requests queue behind any waiters.
+      writer -- exclusive waiters go first, new shared requests queue while a writer is waiting.
+
+    The mode a lock is requested and held in is shared, True or False.
+
+    A shared holder can upgrade to exclusive without letting go.  It waits for the other shared
+    holders to finish, ahead of everyone queued, and nobody new gets the lock in the meantime.
+    Only one holder can be waiting to upgrade at a time, a second would wait on the first forever.
+    """
+    kind = "lock"
+    permits = None  # only semaphores have permits
+
     def __init__(self, lName):
         LockDict[lName] = self
         self.lName = lName
-        self.clientsWaiting = []
+        self.waitQueue = WaitQueue()
         self.accessCount = 0
+        self.policy = LockPolicy
+        self.stats = lockStats(lName)
+        self.upgrader = None  # UpgradeRequest waiting for the other shared holders to go
 
     def tryRequest(self, shared):
         """
@@ -120,575 +320,4923 @@ class ServerLock(object):
         return False
             
         
-    def request(self, shared, client, wait):
-        """
-        requests lock asynchronously, 
-        returns True if lock is available immediately otherwise False
-        if wait is set, adds client to the wait list and the client will be notified when the lock
-        is given to them.
-        """
-        if self.tryRequest(shared):
-            return True
+    def available(self, shared):
+        "True if the lock could be given out this way right now, ignoring anyone waiting"
+        return self.accessCount == 0 or (self.shared and shared and self.upgrader is None)
 
-        if wait:
-            self.clientsWaiting.append((client,shared))
-        return False
+    def admits(self, shared):
+        "True if a new request should be granted straight away rather than queue up"
+        if not self.available(shared):
+            return False
+        if self.accessCount == 0 or self.policy == "batch":
+            return True
+        if self.policy == "fifo":
+            return len(self.waitQueue) == 0
+        return not self.waitQueue.hasExclusive()
 
-    def release(self):
+    def release(self, mode=None):
+        "a client only ever holds a lock once so mode, how it was held, doesn't matter here"
         self.accessCount -= 1
 
+        if self.accessCount == 1 and self.upgrader is not None:
+            # the only one left is the holder waiting to upgrade
+            self.shared = False
+            self.upgrader.granted()
+            return
         if self.accessCount > 0:
             return
 
-        if len(self.clientsWaiting) == 0:
-            del(LockDict[self.lName])
-            return
+        self.grantWaiters()
 
-        client, shared = self.clientsWaiting.pop(0)
-        self.tryRequest(shared)  # this should be guaranteed to work
-        client.notify()
+    def grantWaiters(self):
+        """
+        hand the lock to as many waiters as the policy allows.  The cost is proportional to the
+        number of waiters granted, plus any multi-lock requests passed over because they are still
+        blocked on one of their other locks (those never hold this one up).
 
-        if not shared:  # if it's an exclusive lock, there's nothing more to do
+        Waiters take their locks as we go but are only dequeued and notified at the end so the
+        queues aren't changed while we're walking them.
+        """
+        if self.upgrader is not None:
             return
+        granted = []
+        if self.policy == "fifo":
+            for request, shared in self.waitQueue.items():
+                if not self.available(shared):
+                    break
+                if request.available():
+                    request.take()
+                    granted.append(request)
+        else:
+            if self.accessCount == 0:
+                # the first waiter that can go decides if the lock is handed out shared or exclusive
+                if self.policy == "writer":
+                    candidates = itertools.chain(self.waitQueue.exclusive(), self.waitQueue.shared())
+                else:
+                    candidates = self.waitQueue.requests()
+                for request in candidates:
+                    if request.available():
+                        request.take()
+                        granted.append(request)
+                        break
 
-        # if it's a shared lock, check the remaining clients and see which others want access
-        clients = self.clientsWaiting
-        self.clientsWaiting = []
-        for client,shared in clients:
-            if shared:
-                self.tryRequest(shared)  # again this should always work
-                client.notify()
-            else:
-                self.clientsWaiting.append((client, shared))
+            if self.accessCount > 0 and self.shared and \
+                    (self.policy == "batch" or granted or not self.waitQueue.hasExclusive()):
+                # the only one of them that can be granted already is the first one, just above
+                first = granted[0] if granted else None
+                for request in self.waitQueue.shared():
+                    if request is not first and request.available():
+                        request.take()
+                        granted.append(request)
+
+        for request in granted:
+            request.granted()
+
+        self.cleanup()
 
-    def clearWaiting(self, client, shared):
-        self.clientsWaiting.remove((client, shared))
+    def cleanup(self):
+        "forget about this lock once nobody holds or wants it"
+        if self.accessCount == 0 and len(self.waitQueue) == 0 and LockDict.get(self.lName) is self:
+            del(LockDict[self.lName])
         
     def count(self):
         return self.accessCount
 
 
+class QueuedLock(ServerLock):
+    """
+    base for the locks with modes other than shared and exclusive.  Waiters are always served in
+    order, whatever the policy, so one wanting a lot can't be starved by a stream wanting a little,
+    and whenever it's released everyone at the front of the queue that now fits is granted
+    """
+    def __init__(self, lName):
+        super(QueuedLock, self).__init__(lName)
+        self.waitQueue = ModeQueue()
+
+    def admits(self, mode):
+        return self.available(mode) and len(self.waitQueue) == 0
+
+    def grantWaiters(self):
+        granted = []
+        for request, mode in self.waitQueue.items():
+            if not self.available(mode):
+                break
+            if request.available():
+                request.take()
+                granted.append(request)
+
+        for request in granted:
+            request.granted()
+
+        self.cleanup()
+
+
+class ServerSemaphore(QueuedLock):
+    """
+    a lock with a number of permits rather than shared and exclusive modes.  The mode it's requested
+    and held in is the number of permits, accessCount is how many are in use
+    """
+    kind = "semaphore"
+
+    def __init__(self, lName, permits):
+        super(ServerSemaphore, self).__init__(lName)
+        self.permits = permits
+
+    def tryRequest(self, count):
+        if not self.available(count):
+            return False
+        self.accessCount += count
+        return True
+
+    def available(self, count):
+        return self.accessCount + count <= self.permits
+
+    def release(self, count):
+        self.accessCount -= count
+        self.grantWaiters()
+
+
+class IntentLock(QueuedLock):
+    """
+    a lock on one of a hierarchy of names separated by /, like db/table/partition.  Taking a name S
+    (shared) or X (exclusive) also takes each of the names above it IS or IX (intention shared or
+    exclusive) in the same request, so a lock on a parent conflicts with the locks held anywhere
+    beneath it while only the names on the path are ever looked at.  Which modes can be held
+    together:
+
+            IS  IX  S   X
+        IS  y   y   y   -
+        IX  y   y   -   -
+        S   y   -   y   -
+        X   -   -   -   -
+
+    accessCount is the number of holders in any mode
+    """
+    kind = "hierarchical lock"
+    compatible = {"IS": ("IS", "IX", "S"), "IX": ("IS", "IX"), "S": ("IS", "S"), "X": ()}
+
+    def __init__(self, lName):
+        super(IntentLock, self).__init__(lName)
+        self.held = {"IS": 0, "IX": 0, "S": 0, "X": 0}  # holders in each mode
+
+    def tryRequest(self, mode):
+        if not self.available(mode):
+            return False
+        self.held[mode] += 1
+        self.accessCount += 1
+        return True
+
+    def available(self, mode):
+        compatible = IntentLock.compatible[mode]
+        for other, count in self.held.items():
+            if count and other not in compatible:
+                return False
+        return True
+
+    def release(self, mode):
+        self.held[mode] -= 1
+        self.accessCount -= 1
+        self.grantWaiters()
+
+
+def intentsFor(path, mode):
+    "[(name, mode)] of the intention locks above path needed to lock it in mode, the root first"
+    intent = "IS" if mode in ("IS", "S") else "IX"
+    parts = path.split('/')
+    return [('/'.join(parts[:i]), intent) for i in range(1, len(parts))]
+
+
+class LockRequest(object):
+    """
+    A client's request for one or more locks.  The locks are always granted together, a request
+    never holds some of its locks while it waits for the rest so it can't deadlock with another
+    request taking the same locks in a different order.
+    """
+    def __init__(self, client, tag, locks, lease=None, intents=(), cache=False):
+        self.client = client
+        self.tag = tag
+        self.locks = locks  # list of (lName, mode), mode being shared or for a semaphore the permits wanted
+        self.intents = list(intents)  # (lName, mode) of the intention locks taken along with a hierarchical lock
+        self.taking = self.intents + locks  # everything the request takes
+        self.lease = lease  # seconds the client may hold the locks once they're granted
+        self.cache = cache  # the client hangs on to the locks after using them until they're revoked
+        self.timer = None  # gives up waiting when it fires
+        self.queued = None  # perf_counter_ns() when we started waiting
+
+    def names(self):
+        return " ".join(lName for lName, shared in self.locks)
+
+    def available(self):
+        "True if every lock could be given to us right now"
+        for lName, mode in self.taking:
+            lock = LockDict.get(lName)  # don't create locks just to look at them
+            if lock is not None and not lock.available(mode):
+                return False
+        return True
+
+    def tryNow(self):
+        "takes all of the locks if the policy of each lets a new request have it, returns True if it did"
+        for lName, mode in self.taking:
+            lock = LockDict.get(lName)
+            if lock is not None and not lock.admits(mode):
+                return False
+        self.take()
+        return True
+
+    def take(self):
+        for lName, mode in self.taking:
+            LockDict[lName].tryRequest(mode)  # the caller has checked these are all available
+
+    def wait(self):
+        "queue on every lock, whichever of them frees up last will grant the request"
+        self.queued = time.perf_counter_ns()
+        for lName, mode in self.taking:
+            lock = LockDict[lName]
+            lock.waitQueue.append(self, mode)
+            depth = len(lock.waitQueue)
+            QueueDepths.record(depth)
+            if depth > lock.stats.maxQueue:
+                lock.stats.maxQueue = depth
+
+    def granted(self):
+        "called once take() has been done on behalf of a waiting request"
+        if self.timer is not None:
+            self.timer.cancel()
+        for lName, mode in self.taking:
+            LockDict[lName].waitQueue.remove(self)
+        self.client.notify(self)
+
+    def detach(self):
+        "stop waiting without letting anyone else go yet, returns the names of the locks we were queued on"
+        if self.timer is not None:
+            self.timer.cancel()
+        for lName, mode in self.taking:
+            LockDict[lName].waitQueue.remove(self)
+        return [lName for lName, mode in self.taking]
+
+    def cancel(self):
+        for lName in self.detach():
+            lock = LockDict.get(lName)
+            if lock is not None:
+                # whoever was behind us might be able to go now
+                lock.grantWaiters()
+
+
+class UpgradeRequest(LockRequest):
+    "a shared holder waiting to upgrade its lock to exclusive, it waits as the lock's upgrader"
+    def wait(self):
+        self.queued = time.perf_counter_ns()
+        lName, shared = self.locks[0]
+        LockDict[lName].upgrader = self
+
+    def granted(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        lName, shared = self.locks[0]
+        LockDict[lName].upgrader = None
+        self.client.stopWaiting(self)
+        self.client.upgraded(lName, self.tag)
+
+    def detach(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        lName, shared = self.locks[0]
+        LockDict[lName].upgrader = None
+        # shared waiters held back for us might be able to go once cancel() calls grantWaiters()
+        return [lName]
+
+
+class SortedIndex(object):
+    """
+    sorted set of names kept as a list of short sorted lists (split in two once they reach twice
+    load), so adding and removing a name stays cheap however many there are and everything starting
+    with a prefix can be walked in order
+    """
+    def __init__(self, load=1000):
+        self.lists = []  # sorted, everything in lists[i] comes before everything in lists[i+1]
+        self.maxes = []  # the last name in each list
+        self.load = load
+
+    def __len__(self):
+        return sum(len(names) for names in self.lists)
+
+    def add(self, name):
+        "add a name that isn't already there"
+        if not self.lists:
+            self.lists.append([name])
+            self.maxes.append(name)
+            return
+        i = bisect.bisect_left(self.maxes, name)
+        if i == len(self.maxes):
+            i -= 1
+            names = self.lists[i]
+            names.append(name)
+            self.maxes[i] = name
+        else:
+            names = self.lists[i]
+            bisect.insort(names, name)
+        if len(names) >= 2 * self.load:
+            self.lists.insert(i + 1, names[self.load:])
+            del(names[self.load:])
+            self.maxes.insert(i, names[-1])
+
+    def remove(self, name):
+        "remove a name that is there"
+        i = bisect.bisect_left(self.maxes, name)
+        names = self.lists[i]
+        del(names[bisect.bisect_left(names, name)])
+        if not names:
+            del(self.lists[i])
+            del(self.maxes[i])
+        else:
+            self.maxes[i] = names[-1]
+
+    def startingWith(self, prefix, after=None):
+        "yields the names starting with prefix in order, only those that come after after if given"
+        if after is None or after < prefix:
+            i = bisect.bisect_left(self.maxes, prefix)
+            j = bisect.bisect_left(self.lists[i], prefix) if i < len(self.lists) else 0
+        else:
+            i = bisect.bisect_left(self.maxes, after)
+            j = bisect.bisect_right(self.lists[i], after) if i < len(self.lists) else 0
+        while i < len(self.lists):
+            for name in itertools.islice(self.lists[i], j, None):
+                if not name.startswith(prefix):
+                    return
+                yield name
+            i += 1
+            j = 0
+
+
 class ServerMsg(object):
-    "a ServerMsg object exists for each message stored on the lock server"
+    """
+    a ServerMsg object exists for each message stored on the lock server.  Besides MsgDict every
+    message is in MsgIndex (for prefix scans) and MsgLRU (least recently set or read first, for
+    eviction once the messages take up more than MaxMsgBytes)
+    """
     def __init__(self, mName):
         MsgDict[mName] = self
         self.mName = mName
         self.text = None
         self.owner = None
+        self.expiry = None  # Timer that drops the message when its ttl is up
+
+    def set(self, msg, owner, ttl=None):
+        global MsgBytes
 
-    def set(self, msg, owner):
+        if self.text is None:
+            MsgIndex.add(self.mName)
+            MsgLRU[self.mName] = None
+            MsgBytes += len(self.mName) + len(msg)
+        else:
+            MsgLRU.move_to_end(self.mName)
+            MsgBytes += len(msg) - len(self.text)
         self.text = msg
         self.owner = owner
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        if ttl is not None:
+            self.expiry = owner.server.callLater(ttl, self.drop)
+        notifyWatchers(self.mName, "! SET %s %s\n"%(self.mName, msg))
+        if MaxMsgBytes is not None and MsgBytes > MaxMsgBytes:
+            evictMsgs()
 
     def get(self):
         if self.text is None:
             del(MsgDict[self.mName])
             raise(Exception())
+        MsgLRU.move_to_end(self.mName)
         return self.text
 
     def release(self, owner):
+        global MsgBytes
+
         if owner != self.owner: # presumably someone else overwrote the message
             return        
         del(MsgDict[self.mName])
+        MsgIndex.remove(self.mName)
+        del(MsgLRU[self.mName])
+        MsgBytes -= len(self.mName) + len(self.text)
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        notifyWatchers(self.mName, "! CLEARED %s\n"%self.mName)
+
+    def drop(self):
+        "the message goes whoever set it, when its ttl runs out or it's evicted"
+        owner = self.owner
+        self.expiry = None
+        owner.msgs.discard(self.mName)
+        if owner.server.journal is not None:
+            owner.server.journal.relMsg(owner, self.mName)
+        self.release(owner)
+
+
+def evictMsgs():
+    "drop the least recently used messages until they fit in MaxMsgBytes again, never the newest"
+    global EvictedMsgs
+
+    while MsgBytes > MaxMsgBytes and len(MsgLRU) > 1:
+        MsgDict[next(iter(MsgLRU))].drop()
+        EvictedMsgs += 1
+
+
+def notifyWatchers(mName, line):
+    "push line to every connection watching message mName"
+    watchers = WatchDict.get(mName)
+    if watchers:
+        for conn in watchers:
+            conn.send(line)
+
+
+class SyncRequest(object):
+    "a client waiting at a barrier or on a latch, it holds no locks"
+    def __init__(self, client, tag, sync):
+        self.client = client
+        self.tag = tag
+        self.sync = sync  # the ServerBarrier or ServerLatch
+        self.locks = []
+        self.intents = []
+        self.timer = None  # gives up waiting when it fires
+
+    def names(self):
+        return self.sync.name
+
+    def detach(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.sync.leave(self)
+        return []
+
+    def cancel(self):
+        self.detach()
+
+
+def wakeAll(waiting, line):
+    "let every SyncRequest in waiting go, sending each of them line"
+    for request in waiting:
+        if request.timer is not None:
+            request.timer.cancel()
+        request.client.stopWaiting(request)
+        request.client.send(line, request.tag)
+
+
+class ServerBarrier(object):
+    """
+    a barrier exists from the first party arriving at it until the last of its parties does, then
+    they're all let through at once and the next to arrive starts it over.  Everyone using the
+    name has to give the same number of parties
+    """
+    def __init__(self, name, parties):
+        BarrierDict[name] = self
+        self.name = name
+        self.parties = parties
+        self.waiting = {}  # key is SyncRequest, in the order they arrived
+
+    def arrive(self, request):
+        self.waiting[request] = None
+        if len(self.waiting) == self.parties:
+            del(BarrierDict[self.name])
+            wakeAll(self.waiting, "PASSED %s\n"%self.name)
+
+    def leave(self, request):
+        "a party gave up waiting or went away"
+        del(self.waiting[request])
+        if not self.waiting:
+            del(BarrierDict[self.name])
+
+
+class ServerLatch(object):
+    """
+    a countdown latch.  Its owner sets the count, countdown takes it down and everyone waiting is
+    let go when it gets to 0.  It stays open until it's set again or its owner goes away, like a
+    message.  Waiting on a latch that hasn't been set yet is fine
+    """
+    def __init__(self, name):
+        LatchDict[name] = self
+        self.name = name
+        self.count = None  # None until it's set
+        self.owner = None  # the LockConnection that set it
+        self.waiting = {}  # key is SyncRequest
+
+    def set(self, count, owner):
+        if self.owner is not None and self.owner is not owner:
+            self.owner.latches.discard(self.name)
+        self.owner = owner
+        owner.latches.add(self.name)
+        self.count = count
+        if count == 0:
+            self.open()
+
+    def countDown(self, count):
+        self.count = max(self.count - count, 0)
+        if self.count == 0:
+            self.open()
+
+    def open(self):
+        waiting = self.waiting
+        self.waiting = {}
+        wakeAll(waiting, "OPEN %s\n"%self.name)
+
+    def leave(self, request):
+        del(self.waiting[request])
+        self.cleanup()
+
+    def disown(self):
+        "our owner has gone so forget the count, anyone waiting waits for it to be set again"
+        self.owner = None
+        self.count = None
+        self.cleanup()
 
+    def cleanup(self):
+        if self.owner is None and not self.waiting:
+            del(LatchDict[self.name])
 
 
 class LockConnection(object):
     "a LockConnection object exists for each client that connects to the lock server"
-    def __init__(self, clientSocket, address):
+    def __init__(self, clientSocket, address, server):
         self.fileno = clientSocket.fileno()
         ClientDict[self.fileno] = self
         self.clientSocket = clientSocket
         self.address = address
-        print("new client from %s on fd %s"%(address, self.fileno))
-        self.readBuf = b""
-        self.locks = {}  # True if shared, False if exclusive
-        self.msgs = set()
-        self.waiting = False  # True if waiting for a lock
+        self.server = server
+        self.peer = None  # who the server counts us against for MaxHostConnections, None if it doesn't
+        if Verbose:
+            print("new client from %s on fd %s"%(address, self.fileno))
+        self.readBuf = bytearray(ReadBufSize)  # input from the client, reused rather than reallocated
+        self.readStart = 0  # readBuf[readStart:readEnd] is input that hasn't been processed yet
+        self.readEnd = 0
+        self.writeBuf = bytearray()  # replies the socket hasn't taken yet
+        self.writing = False  # True while the selector is watching for writability
+        self.reading = True  # False while reads are paused because readBuf is full
+        self.initState()
 
         self.clientSocket.setblocking(0)
+        server.register(clientSocket, self)
+
+    def initState(self):
+        self.locks = {}  # True if shared, False if exclusive, the number of permits held for a semaphore
+        self.msgs = set()
+        self.waiting = False  # True while blocked on an untagged wait
+        self.waits = {}  # key is tag (None if untagged), val is the LockRequest we're waiting on
+        self.waitNames = {}  # key is lName we're waiting for, val is its LockRequest
+        self.waitIntents = {}  # key is the lName of an intention lock we wait for, val is how many of our waits want it
+        self.intents = {}  # key is lName, val is {mode: count} of the intention locks we hold on it
+        self.cached = set()  # names of the locks we hold with cache=1 that nobody has asked for yet
+        self.leases = {}  # key is lName, val is the Timer that takes it back when its lease runs out
+        self.heldSince = {}  # key is lName, val is perf_counter_ns() when we got it
+        self.watches = set()  # names of the messages we're watching
+        self.latches = set()  # names of the latches we've set
+        self.ownerId = None  # who we are in the journal, given out the first time we're written to it
+        self.session = None  # token the client can resume us with after a dropped connection
+        self.detached = False  # True while our session is waiting for the client to come back
+        self.untimed = 1  # commands to go until the next one is timed
+        self.closed = False
 
     def read(self):
-        try:
-            data = self.clientSocket.recv(select.PIPE_BUF)
-            if len(data) == 0:
-                self.killClient()
+        while True:
+            if self.readEnd == len(self.readBuf):
+                self.makeRoom()
+            try:
+                with memoryview(self.readBuf) as view:
+                    count = self.clientSocket.recv_into(view[self.readEnd:])
+            except BlockingIOError:
+                break
+            except:
+                if Verbose:
+                    print("got exception on read")
+                self.connectionLost()
                 return
-            self.readBuf += data
-        except:
-            print("got exception on read")
-            self.killClient()
-            return
+            if count == 0:
+                self.connectionLost()
+                return
+            self.readEnd += count
+            if self.readEnd - self.readStart > MaxReadBuf:
+                self.processReadBuf()
+                if self.closed or not self.reading or not self.server.edgeTriggered:
+                    return
+                continue
+            # edge triggered fds only wake us again on new data so drain the socket now
+            if not self.server.edgeTriggered:
+                break
         self.processReadBuf()
 
+    def makeRoom(self):
+        "move the unprocessed input to the front of readBuf, doubling it if that doesn't free anything"
+        pending = self.readEnd - self.readStart
+        if self.readStart:
+            with memoryview(self.readBuf) as view:
+                view[:pending] = view[self.readStart:self.readEnd]
+            self.readStart = 0
+            self.readEnd = pending
+        if pending == len(self.readBuf):
+            self.readBuf.extend(bytes(len(self.readBuf)))
+
     def processReadBuf(self):
-        # process read buffer for as long as we have complete commands and aren't waiting for a lock
-        while self.waiting is False:
-            line, nl, rest = self.readBuf.partition(b'\n')
-            if nl != b'\n':
+        """
+        process read buffer for as long as we have complete commands and aren't waiting for a lock.
+        
+        Commands pipelined behind a blocked xlockwait/slockwait stay queued in readBuf and are picked
+        up again once the lock is granted.  If too much piles up behind a wait we stop reading from
+        the socket until the backlog drains.
+
+        A command may be prefixed with "@<tag> ", every reply to it then carries the same prefix.
+        Tagged waits don't block the connection so one client can wait on any number of locks
+        and match the ACQUIRED replies up by tag as they arrive.
+        """
+        with memoryview(self.readBuf) as view:
+            while self.waiting is False and not self.closed:
+                end = self.readBuf.find(b'\n', self.readStart, self.readEnd)
+                if end < 0:
+                    if self.readEnd - self.readStart > MaxReadBuf:
+                        # nobody sends lines this long
+                        self.killClient()
+                        return
+                    break
+                # decode straight out of the buffer, the rest of it stays where it is
+                line = str(view[self.readStart:end], 'ascii')
+                self.readStart = end + 1
+                if self.session is not None:
+                    self.linesIn += 1
+                self.processLine(line)
+
+        if self.readStart == self.readEnd:
+            # everything's been used so start from the front again without copying anything
+            self.readStart = self.readEnd = 0
+            if len(self.readBuf) > ReadBufSize:
+                self.readBuf = bytearray(ReadBufSize)
+        if not self.closed:
+            self.updateInterest()
+
+    @staticmethod
+    def parseLine(line):
+        "splits a command line into (tag, cmd, arg), returns None if it's malformed"
+        line = line.strip()
+        tag = None
+        if line.startswith('@'):
+            tag, sp, line = line[1:].partition(' ')
+            if sp != ' ' or tag == '':
+                return None
+            line = line.lstrip()
+
+        cmd, sp, arg = line.partition(' ')
+        if sp != ' ' or cmd not in LockConnection.cmdDict:
+            return None
+        return tag, cmd, arg.strip()
+
+    def processLine(self, line):
+        parsed = self.parseLine(line)
+        if parsed is None:
+            self.killClient()
+            return
+        tag, cmd, arg = parsed
+        CommandCounts[cmd] += 1
+        self.untimed -= 1
+        if self.untimed:
+            LockConnection.cmdDict[cmd](self, arg, tag)
+            return
+        # timing every command would cost more than most of them take to run, so only some are
+        self.untimed = CommandSampleRate
+        start = time.perf_counter_ns()
+        LockConnection.cmdDict[cmd](self, arg, tag)
+        CommandTimes[cmd].record(time.perf_counter_ns() - start)
+
+    def doRelease(self, arg, tag):
+        "release <name> [count]: count gives back only that many of the permits held on a semaphore"
+        lName, count = arg, ""
+        if arg not in self.locks:
+            # lock names can have spaces in them, a trailing number is only a count for a semaphore
+            name, sp, last = arg.rpartition(' ')
+            if sp and last.isdigit() and name in self.locks and LockDict[name].permits is not None:
+                lName, count = name, last
+        if lName not in self.locks:
+            self.send("ERROR %s not already locked\n"%lName, tag)
+            return
+        if count:
+            held = self.locks[lName]
+            if not 0 < int(count) <= held:
+                self.send("ERROR invalid release %s\n"%arg, tag)
                 return
-            self.readBuf = rest
-            line = line.decode('ascii')
-            line = line.strip()
-            cmd, sp, lName = line.partition(' ')
-            if sp != ' ':
-                self.killClient()
+            if int(count) < held:
+                self.releasePermits(lName, int(count))
+                self.send("RELEASED %s\n"%lName, tag)
                 return
+        self.releaseLock(lName)
+        self.send("RELEASED %s\n"%lName, tag)
 
-            lName = lName.strip()
-            if cmd == "release":
-                if lName not in self.locks:
-                    self.send("ERROR %s not already locked\n"%lName)
-                    continue
-                LockDict[lName].release()
-                del(self.locks[lName])
-                self.send("RELEASED %s\n"%lName)
-                continue
+    def doCount(self, lName, tag):
+        if lName in LockDict:
+            count = LockDict[lName].count()
+        else:
+            count = 0
 
-            if cmd == "count":
-                if lName in LockDict:
-                    count = LockDict[lName].count()
-                else:
-                    count = 0
-                
-                self.send("ACCESSCOUNT %s %d\n"%(lName, count))
-                continue
+        self.send("ACCESSCOUNT %s %d\n"%(lName, count), tag)
 
-            if cmd == "set":
-                mName, sp, text = lName.partition(' ')
-                if sp != ' ':
-                    self.killClient()
-                    return
+    def doSet(self, arg, tag):
+        mName, sp, text = arg.partition(' ')
+        if sp != ' ':
+            self.killClient()
+            return
 
-                MsgDict[mName].set(text, self)
-                self.msgs.add(mName)
-                # no response, just continue on
-                continue
+        self.setMsg(mName, text)
+        # no response
 
-            if cmd == "get":
-                try:
-                    text = MsgDict[lName].get()
-                    self.send(f"MSG {lName} {text}\n")
-                except:
-                    self.send("NOMSG\n")
-                continue
-                    
-            if cmd == "relmsg":
-                try:
-                    self.msgs.remove(lName)
-                    MsgDict[lName].release(self)
-                except:
-                    pass
+    def doSetEx(self, arg, tag):
+        "setex <name> <seconds> <text>: set but the message goes away by itself after seconds"
+        mName, ttl, text = (arg.split(' ', 2) + ['', ''])[:3]
+        try:
+            ttl = float(ttl)
+        except ValueError:
+            ttl = -1.0
+        if text == '' or not ttl >= 0:
+            self.killClient()
+            return
 
-            # all other commands require an lName that isn't already in locks
-            if lName in self.locks:
-                self.send("ERROR %s already locked\n"%lName)
-                continue
-                            
-            if cmd == "xlock":
-                self.request(lName, shared=False, wait=False)
-            elif cmd == "slock":
-                self.request(lName, shared=True, wait=False)
-            elif cmd == "xlockwait":
-                self.request(lName, shared=False, wait=True)
-            elif cmd == "slockwait":
-                self.request(lName, shared=True, wait=True)
-            else:
-                self.killClient()
-                return
-                
-    def request(self, lName, shared, wait):
-        if LockDict[lName].request(shared=shared, client=self, wait=wait):
-            self.locks[lName] = shared
-            self.send("ACQUIRED %s\n"%lName)
+        self.setMsg(mName, text, ttl)
+        # no response
+
+    def setMsg(self, mName, text, ttl=None):
+        # journalled first as setting it might evict others
+        if self.server.journal is not None:
+            self.server.journal.setMsg(self, mName, text)
+        MsgDict[mName].set(text, self, ttl)
+        self.msgs.add(mName)
+
+    def doGet(self, mName, tag):
+        try:
+            text = MsgDict[mName].get()
+            self.send(f"MSG {mName} {text}\n", tag)
+        except:
+            self.send("NOMSG\n", tag)
+
+    def doMGet(self, arg, tag):
+        "mget <name> ...: replies MSGS and a JSON object of the messages, missing ones are null"
+        msgs = {}
+        for mName in arg.split():
+            try:
+                msgs[mName] = MsgDict[mName].get()
+            except:
+                msgs[mName] = None
+        self.send("MSGS %s\n"%json.dumps(msgs, separators=(',', ':')), tag)
+
+    def doScan(self, arg, tag):
+        """
+        scan <prefix> [<count> [<after>]]: replies MSGS and a JSON object of the messages whose names
+        start with prefix in name order, at most count of them (default MaxScanMsgs) and only those
+        after the name after, to carry on from where a previous scan stopped
+        """
+        words = arg.split()
+        if len(words) > 3 or (len(words) > 1 and not words[1].isdigit()):
+            self.send("ERROR invalid scan %s\n"%arg, tag)
             return
+        count = int(words[1]) if len(words) > 1 else MaxScanMsgs
+        after = words[2] if len(words) > 2 else None
+        names = itertools.islice(MsgIndex.startingWith(words[0], after), count)
+        msgs = {mName: MsgDict[mName].text for mName in names}
+        self.send("MSGS %s\n"%json.dumps(msgs, separators=(',', ':')), tag)
 
-        if wait:
-            self.waitName = lName
-            self.waitShared = shared
+    def doRelMsg(self, mName, tag):
+        try:
+            self.msgs.remove(mName)
+            MsgDict[mName].release(self)
+        except:
+            return
+        if self.server.journal is not None:
+            self.server.journal.relMsg(self, mName)
+
+    def doWatch(self, mName, tag):
+        """
+        from now on push "! SET <name> <text>" whenever message mName is set and "! CLEARED <name>"
+        when it goes away, until unwatch
+        """
+        WatchDict.setdefault(mName, {})[self] = None
+        self.watches.add(mName)
+        self.send("WATCHING %s\n"%mName, tag)
+
+    def doUnwatch(self, mName, tag):
+        if mName in self.watches:
+            self.dropWatch(mName)
+        self.send("UNWATCHED %s\n"%mName, tag)
+
+    def dropWatch(self, mName):
+        self.watches.discard(mName)
+        watchers = WatchDict[mName]
+        del(watchers[self])
+        if not watchers:
+            del(WatchDict[mName])
+
+    def doXLock(self, arg, tag):
+        lName, options = self.parseOptions(arg, tag)
+        if lName is not None:
+            self.request([(lName, False)], False, tag, **options)
+
+    def doSLock(self, arg, tag):
+        lName, options = self.parseOptions(arg, tag)
+        if lName is not None:
+            self.request([(lName, True)], False, tag, **options)
+
+    def doXLockWait(self, arg, tag):
+        lName, options = self.parseOptions(arg, tag)
+        if lName is not None:
+            self.request([(lName, False)], True, tag, **options)
+
+    def doSLockWait(self, arg, tag):
+        lName, options = self.parseOptions(arg, tag)
+        if lName is not None:
+            self.request([(lName, True)], True, tag, **options)
+
+    def doUpgrade(self, arg, tag):
+        """
+        upgrade <name>: make a shared lock we hold exclusive without letting go of it.  Waits for the
+        other shared holders to release it, ahead of anyone queued for it.  The reply is UPGRADED, or
+        FAILED straight away if another holder is already waiting to upgrade (we'd wait for each
+        other forever) or once timeout=<seconds> is up, the lock is still held shared either way
+        """
+        lName, options = self.parseOptions(arg, tag)
+        if lName is None:
+            return
+        if self.locks.get(lName) is not True or LockDict[lName].kind != "lock":
+            self.send("ERROR %s not locked shared\n"%lName, tag)
+            return
+        if lName in self.waitNames:
+            self.send("ERROR %s already waiting\n"%lName, tag)
+            return
+        if tag in self.waits:
+            self.send("ERROR %s tag already in use\n"%lName, tag)
+            return
+        lock = LockDict[lName]
+        if lock.accessCount == 1:
+            self.upgraded(lName, tag)
+            return
+        timeout = options.get('timeout')
+        if lock.upgrader is not None or timeout == 0:
+            lock.stats.failed += 1
+            self.send("FAILED %s\n"%lName, tag)
+            return
+
+        if not self.admitWait(tag):
+            return
+
+        request = UpgradeRequest(self, tag, [(lName, False)])
+        self.revokeCached(request)
+        request.wait()
+        self.addWait(request)
+        self.waitNames[lName] = request
+        if timeout is not None:
+            request.timer = self.server.callLater(timeout, lambda: self.waitTimedOut(request))
+        if tag is None:
             self.waiting = True
+
+    def upgraded(self, lName, tag):
+        LockDict[lName].shared = False
+        self.locks[lName] = False
+        if self.server.journal is not None:
+            self.server.journal.grant(self, lName, False)
+        self.send("UPGRADED %s\n"%lName, tag)
+
+    def doDowngrade(self, lName, tag):
+        "downgrade <name>: make an exclusive lock we hold shared, letting in whoever is waiting for it shared"
+        if self.locks.get(lName) is not False or LockDict[lName].kind != "lock":
+            self.send("ERROR %s not locked exclusive\n"%lName, tag)
             return
-        
-        self.send("FAILED %s\n"%lName)
+        lock = LockDict[lName]
+        lock.shared = True
+        self.locks[lName] = True
+        if self.server.journal is not None:
+            self.server.journal.grant(self, lName, True)
+        self.send("DOWNGRADED %s\n"%lName, tag)
+        lock.grantWaiters()
+
+    def doAcquire(self, arg, tag):
+        self.acquireSemaphore(arg, False, tag)
+
+    def doAcquireWait(self, arg, tag):
+        self.acquireSemaphore(arg, True, tag)
+
+    def acquireSemaphore(self, arg, wait, tag):
+        """
+        acquire[wait] <name> <count> <permits>: take count permits of semaphore name, which has permits
+        of them in all.  The replies are the same as for the lock commands, as are the options
+        """
+        arg, options = self.parseOptions(arg, tag)
+        if arg is None:
+            return
+        words = arg.split()
+        if len(words) != 3 or not words[1].isdigit() or not words[2].isdigit() or \
+                not 0 < int(words[1]) <= int(words[2]):
+            self.send("ERROR invalid acquire %s\n"%arg, tag)
+            return
+        self.request([(words[0], int(words[1]))], wait, tag, permits=int(words[2]), **options)
 
-    def notify(self):
-        self.locks[self.waitName] = self.waitShared
-        self.send("ACQUIRED %s\n"%self.waitName)
-        self.waiting = False
+    def doHLock(self, arg, tag):
+        self.hierarchicalLock(arg, False, tag)
+
+    def doHLockWait(self, arg, tag):
+        self.hierarchicalLock(arg, True, tag)
+
+    def hierarchicalLock(self, arg, wait, tag):
+        """
+        hlock[wait] <path> s|x: lock path, a name like db/table/partition, shared or exclusive so that
+        it also conflicts with locks on the names above and beneath it (see IntentLock).  The replies
+        are the same as for the lock commands, as are the options
+        """
+        arg, options = self.parseOptions(arg, tag)
+        if arg is None:
+            return
+        path, sp, mode = arg.partition(' ')
+        if mode not in ('s', 'x') or '' in path.split('/'):
+            self.send("ERROR invalid hlock %s\n"%arg, tag)
+            return
+        self.request([(path, mode.upper())], wait, tag, hierarchical=True, **options)
+
+    def doMLock(self, arg, tag):
+        arg, options = self.parseOptions(arg, tag)
+        locks = self.parseLockList(arg, tag)
+        if locks is not None:
+            self.request(locks, False, tag, **options)
+
+    def doMLockWait(self, arg, tag):
+        arg, options = self.parseOptions(arg, tag)
+        locks = self.parseLockList(arg, tag)
+        if locks is not None:
+            self.request(locks, True, tag, **options)
+
+    def doMRelease(self, arg, tag):
+        names = arg.split()
+        if len(set(names)) != len(names):
+            self.send("ERROR invalid release list %s\n"%arg, tag)
+            return
+        for lName in names:
+            if lName not in self.locks:
+                self.send("ERROR %s not already locked\n"%lName, tag)
+                return
+        for lName in names:
+            self.releaseLock(lName)
+        self.send("RELEASED %s\n"%" ".join(names), tag)
+
+    def doBarrier(self, arg, tag):
+        """
+        barrier <name> <parties>: wait until parties clients (this one included) have arrived, then
+        they're all sent PASSED together.  FAILED after timeout=<seconds>, this party leaves again
+        """
+        arg, options = self.parseOptions(arg, tag)
+        if arg is None:
+            return
+        name, sp, parties = arg.partition(' ')
+        try:
+            parties = int(parties)
+            if parties < 1:
+                raise ValueError()
+        except ValueError:
+            self.send("ERROR invalid barrier %s\n"%arg, tag)
+            return
+        barrier = BarrierDict.get(name)
+        if barrier is not None and barrier.parties != parties:
+            self.send("ERROR %s is a barrier with %d parties\n"%(name, barrier.parties), tag)
+            return
+        if barrier is None:
+            barrier = ServerBarrier(name, parties)
+        request = self.syncWait(SyncRequest(self, tag, barrier), options.get('timeout'))
+        if request is not None:
+            barrier.arrive(request)
+        elif not barrier.waiting:
+            del(BarrierDict[name])
+
+    def doLatch(self, arg, tag):
+        "latch <name> <count>: set (or reset) the count of a latch, we own it until we go away"
+        name, sp, count = arg.partition(' ')
+        try:
+            count = int(count)
+            if count < 0:
+                raise ValueError()
+        except ValueError:
+            self.send("ERROR invalid latch %s\n"%arg, tag)
+            return
+        latch = LatchDict.get(name) or ServerLatch(name)
+        latch.set(count, self)
+        self.send("LATCH %s %d\n"%(name, count), tag)
+
+    def doCountDown(self, arg, tag):
+        "countdown <name> [count]: take count (1 by default) off a latch, replies with what's left"
+        name, sp, count = arg.partition(' ')
+        try:
+            count = int(count) if count else 1
+            if count < 1:
+                raise ValueError()
+        except ValueError:
+            self.send("ERROR invalid countdown %s\n"%arg, tag)
+            return
+        latch = LatchDict.get(name)
+        if latch is None or latch.count is None:
+            self.send("ERROR %s latch not set\n"%name, tag)
+            return
+        latch.countDown(count)
+        self.send("LATCH %s %d\n"%(name, latch.count), tag)
+
+    def doAwait(self, arg, tag):
+        "await <name>: wait for a latch to count down to 0, replies OPEN or FAILED after timeout=<seconds>"
+        name, options = self.parseOptions(arg, tag)
+        if name is None:
+            return
+        latch = LatchDict.get(name)
+        if latch is not None and latch.count == 0:
+            self.send("OPEN %s\n"%name, tag)
+            return
+        if latch is None:
+            latch = ServerLatch(name)
+        request = self.syncWait(SyncRequest(self, tag, latch), options.get('timeout'))
+        if request is not None:
+            latch.waiting[request] = None
+        else:
+            latch.cleanup()
+
+    def syncWait(self, request, timeout):
+        "start waiting on a barrier or latch, returns None after sending an error"
+        if request.tag in self.waits:
+            self.send("ERROR %s tag already in use\n"%request.names(), request.tag)
+            return None
+        if not self.admitWait(request.tag):
+            return None
+        self.addWait(request)
+        if timeout is not None:
+            request.timer = self.server.callLater(timeout, lambda: self.waitTimedOut(request))
+        if request.tag is None:
+            self.waiting = True
+        return request
+
+    def doRenew(self, arg, tag):
+        lName, options = self.parseOptions(arg, tag)
+        if lName is None:
+            return
+        if lName not in self.locks:
+            self.send("ERROR %s not already locked\n"%lName, tag)
+            return
+        self.setLease(lName, options.get('lease'))
+        self.send("RENEWED %s\n"%lName, tag)
+
+    def doSession(self, arg, tag):
+        """
+        session <seconds>: if the connection drops keep everything we hold or are waiting for for up
+        to that many seconds (capped by the server) so the client can pick it back up with resume.
+        Sending it again just changes the grace period, session 0 before hanging up lets go at once
+        """
+        try:
+            grace = float(arg)
+        except ValueError:
+            grace = -1.0
+        if not grace >= 0:
+            self.send("ERROR invalid session %s\n"%arg, tag)
+            return
+        self.grace = min(grace, self.server.sessionGrace)
+        if self.session is not None:
+            self.send("SESSION %s %s\n"%(self.session, self.grace), tag)
+            return
+        token = secrets.token_hex(16)
+        self.send("SESSION %s %s\n"%(token, self.grace), tag)
+        # lines in and out are counted from here on so a resume knows what each side has missed
+        self.session = token
+        self.linesIn = 0
+        self.linesOut = 0
+        self.replay = collections.deque(maxlen=SessionReplayLines)  # the last lines we sent
+        SessionDict[token] = self
+
+    def doResume(self, arg, tag):
+        """
+        resume <token> <lines received>: take over a session from a connection that dropped.  The
+        reply is RESUMED <token> <lines received>, after which the replies the client missed are sent
+        again and the client sends again whatever we hadn't received.  NOSESSION if it's gone
+        """
+        token, sp, received = arg.partition(' ')
+        conn = SessionDict.get(token)
+        try:
+            missed = conn.linesOut - int(received)
+        except (AttributeError, ValueError):
+            missed = -1
+        if conn is not None and (missed < 0 or missed > len(conn.replay)):
+            # too far behind to pick up where it left off, the client has to start over
+            conn.killClient()
+            conn = None
+        if conn is None or self.session is not None or self.locks or self.waits or self.msgs:
+            self.send("NOSESSION %s\n"%token, tag)
+            return
+        conn.adopt(self, missed, tag)
+
+    def doStats(self, arg, tag):
+        """
+        stats server: connection, lock and message counts, how many of each command has been run and
+            the latency of a sample of them, and how long locks have been waited for and held
+        stats locks [count]: the most contended locks (by total time spent waiting for them)
+        stats lock <name>: the figures for one lock
+
+        the reply is STATS followed by the figures as JSON on one line, times are in seconds
+        """
+        # shard=<n> is only there for a router to pick the shard by
+        words = [word for word in arg.split() if not word.startswith("shard=")]
+        what = words[0] if words else ""
+        if what == "server":
+            stats = self.server.stats()
+        elif what == "locks" and len(words) <= 2 and (len(words) == 1 or words[1].isdigit()):
+            count = int(words[1]) if len(words) == 2 else DefaultStatsLocks
+            hot = sorted(LockStatsDict.values(), key=lambda stats: (stats.waitTimes.total, stats.acquisitions),
+                         reverse=True)
+            stats = [entry.summary() for entry in hot[:count]]
+        elif what == "lock" and len(words) == 2:
+            stats = LockStatsDict.get(words[1]) or LockStats(words[1])
+            stats = stats.summary()
+        else:
+            self.send("ERROR invalid stats %s\n"%arg, tag)
+            return
+        self.send("STATS %s\n"%json.dumps(stats, separators=(',', ':')), tag)
+
+    cmdDict = {"release": doRelease,
+               "count": doCount,
+               "set": doSet,
+               "setex": doSetEx,
+               "get": doGet,
+               "mget": doMGet,
+               "scan": doScan,
+               "relmsg": doRelMsg,
+               "watch": doWatch,
+               "unwatch": doUnwatch,
+               "xlock": doXLock,
+               "slock": doSLock,
+               "xlockwait": doXLockWait,
+               "slockwait": doSLockWait,
+               "mlock": doMLock,
+               "mlockwait": doMLockWait,
+               "mrelease": doMRelease,
+               "upgrade": doUpgrade,
+               "downgrade": doDowngrade,
+               "acquire": doAcquire,
+               "acquirewait": doAcquireWait,
+               "hlock": doHLock,
+               "hlockwait": doHLockWait,
+               "barrier": doBarrier,
+               "latch": doLatch,
+               "countdown": doCountDown,
+               "await": doAwait,
+               "renew": doRenew,
+               "session": doSession,
+               "resume": doResume,
+               "stats": doStats}
+
+    lockOptions = ("timeout", "lease", "cache")
+
+    def parseOptions(self, arg, tag):
+        """
+        strips trailing "timeout=<seconds>", "lease=<seconds>" and "cache=1" options off the arguments
+        of a lock command.  returns (arg, {option: value}) or (None, None) after sending an error.
+
+        cache=1 means the client keeps the locks after it's done with them in case it wants them
+        again, the server pushes "! REVOKE <name>" when anyone else wants one so it's released
+        """
+        options = {}
+        while True:
+            rest, sp, last = arg.rpartition(' ')
+            key, eq, val = last.partition('=')
+            if eq != '=' or key not in LockConnection.lockOptions:
+                return arg, options
+            try:
+                options[key] = float(val)
+                if options[key] < 0:
+                    raise ValueError()
+            except ValueError:
+                self.send("ERROR invalid %s %s\n"%(key, val), tag)
+                return None, None
+            arg = rest.rstrip()
+
+    def parseLockList(self, arg, tag):
+        """
+        parses the "x:name s:name ..." list given to mlock/mlockwait into [(lName, shared), ...]
+        sends an error and returns None if it's malformed
+        """
+        locks = []
+        names = set()
+        for item in arg.split():
+            mode, colon, lName = item.partition(':')
+            if colon != ':' or mode not in ('x', 's') or lName == '' or lName in names:
+                self.send("ERROR invalid lock list %s\n"%arg, tag)
+                return None
+            names.add(lName)
+            locks.append((lName, mode == 's'))
+        return locks
+
+    def request(self, locks, wait, tag=None, timeout=None, lease=None, cache=None, permits=None, hierarchical=False):
+        """
+        permits is set when locks are semaphores with that many permits.  hierarchical locks are
+        IntentLocks and the intention locks above them are taken along with them
+        """
+        for lName, mode in locks:
+            if lName in self.locks:
+                self.send("ERROR %s already locked\n"%lName, tag)
+                return
+            if lName in self.waitNames:
+                self.send("ERROR %s already waiting\n"%lName, tag)
+                return
+        intents = []
+        if hierarchical:
+            for lName, mode in locks:
+                intents.extend(intentsFor(lName, mode))
+        request = LockRequest(self, tag, locks, lease, intents, bool(cache))
+        if tag in self.waits:
+            self.send("ERROR %s tag already in use\n"%request.names(), tag)
+            return
+
+        kind = "semaphore" if permits is not None else "hierarchical lock" if hierarchical else "lock"
+        for lName, mode in request.taking:
+            lock = LockDict.get(lName)
+            if lock is not None and (lock.kind != kind or lock.permits != permits):
+                if lock.permits is not None:
+                    self.send("ERROR %s is a semaphore with %d permits\n"%(lName, lock.permits), tag)
+                else:
+                    self.send("ERROR %s is a %s\n"%(lName, lock.kind), tag)
+                return
+            if hierarchical:
+                # we'd only end up waiting on ourselves
+                held = list(self.intents.get(lName, ()))
+                if lName in self.locks:
+                    held.append(self.locks[lName])
+                if any(other not in IntentLock.compatible[mode] for other in held):
+                    self.send("ERROR %s already locked\n"%lName, tag)
+                    return
+        if kind != "lock":
+            for lName, mode in request.taking:
+                if lName not in LockDict:
+                    if permits is not None:
+                        ServerSemaphore(lName, permits)
+                    else:
+                        IntentLock(lName)
+
+        if request.tryNow():
+            self.acquired(request)
+            return
+
+        self.revokeCached(request)
+        if wait:
+            if not self.admitWait(tag):
+                return
+            request.wait()
+            self.addWait(request)
+            for lName, shared in locks:
+                self.waitNames[lName] = request
+            for lName, mode in request.intents:
+                self.waitIntents[lName] = self.waitIntents.get(lName, 0) + 1
+            if timeout is not None:
+                request.timer = self.server.callLater(timeout, lambda: self.waitTimedOut(request))
+            if tag is None:
+                # untagged waits block the connection until they're granted
+                self.waiting = True
+            return
+        
+        for lName, shared in locks:
+            lock = LockDict.get(lName)
+            if lock is not None:
+                lock.stats.failed += 1
+        self.send("FAILED %s\n"%request.names(), tag)
+
+    def acquired(self, request):
+        journal = self.server.journal
+        now = time.perf_counter_ns()
+        waited = None
+        if request.queued is not None:
+            waited = now - request.queued
+            WaitTimes.record(waited)
+        for lName, shared in request.locks:
+            stats = LockDict[lName].stats
+            stats.acquisitions += 1
+            if waited is not None:
+                stats.waited += 1
+                stats.waitTimes.record(waited)
+            self.heldSince[lName] = now
+            self.locks[lName] = shared
+            self.setLease(lName, request.lease)
+            if journal is not None:
+                journal.grant(self, lName, shared)
+        for lName, mode in request.intents:
+            modes = self.intents.setdefault(lName, {})
+            modes[mode] = modes.get(mode, 0) + 1
+        if request.cache:
+            for lName, mode in request.locks:
+                CachedLocks.setdefault(lName, {})[self] = None
+                self.cached.add(lName)
+        self.send("ACQUIRED %s\n"%request.names(), request.tag)
+
+    def revokeCached(self, request):
+        "ask whoever holds any of the locks request is held up by with cache=1 to give it back"
+        for lName, mode in request.locks:
+            holders = CachedLocks.get(lName)
+            if holders is not None:
+                for conn in list(holders):
+                    if conn is not self:
+                        conn.uncache(lName)
+                        conn.send("! REVOKE %s\n"%lName)
+
+    def uncache(self, lName):
+        self.cached.discard(lName)
+        holders = CachedLocks[lName]
+        del(holders[self])
+        if not holders:
+            del(CachedLocks[lName])
+
+    def admitWait(self, tag):
+        """
+        True if another wait can be queued, otherwise replies BUSY.  MaxClientWaiters caps the
+        waits one connection can have queued and MaxWaiters the whole server's
+        """
+        global BusyReplies
+
+        if ((MaxClientWaiters is not None and len(self.waits) >= MaxClientWaiters) or
+                (MaxWaiters is not None and QueuedWaiters >= MaxWaiters)):
+            BusyReplies += 1
+            self.send("BUSY retry=%g\n"%BusyRetry, tag)
+            return False
+        return True
+
+    def addWait(self, request):
+        global QueuedWaiters
+
+        self.waits[request.tag] = request
+        QueuedWaiters += 1
+
+    def stopWaiting(self, request):
+        global QueuedWaiters
+
+        QueuedWaiters -= 1
+        del(self.waits[request.tag])
+        for lName, shared in request.locks:
+            del(self.waitNames[lName])
+        for lName, mode in request.intents:
+            self.waitIntents[lName] -= 1
+            if self.waitIntents[lName] == 0:
+                del(self.waitIntents[lName])
+        if request.tag is None:
+            self.waiting = False
+            # we're usually called from inside someone else's release so leave any queued commands
+            # to the server loop rather than processing them from here
+            self.server.schedule(self)
+
+    def notify(self, request):
+        self.stopWaiting(request)
+        self.acquired(request)
+
+    def waitTimedOut(self, request):
+        for lName, shared in request.locks:
+            LockDict[lName].stats.failed += 1
+        request.cancel()
+        self.stopWaiting(request)
+        self.send("FAILED %s\n"%request.names(), request.tag)
+
+    def setLease(self, lName, lease):
+        "(re)arms the lease on a lock we hold, lease of None means hold it until released"
+        timer = self.leases.pop(lName, None)
+        if timer is not None:
+            timer.cancel()
+        if lease is not None:
+            self.leases[lName] = self.server.callLater(lease, lambda: self.leaseExpired(lName))
+
+    def leaseExpired(self, lName):
+        "the lease ran out so take the lock back, and tell the client in case it's still listening"
+        del(self.leases[lName])
+        self.releaseLock(lName)
+        self.send("! EXPIRED %s\n"%lName)
+
+    def releaseLock(self, lName):
+        if lName not in self.locks:
+            # nothing to do, callers check but a bad one mustn't take the server down
+            return
+        request = self.waitNames.get(lName)
+        if request is not None:
+            # an upgrade we were still waiting for
+            self.waitTimedOut(request)
+        self.setLease(lName, None)
+        if lName in self.cached:
+            self.uncache(lName)
+        mode = self.locks.pop(lName)
+        if self.server.journal is not None:
+            self.server.journal.release(self, lName)
+        lock = LockDict[lName]
+        self.recordHold(lock, time.perf_counter_ns())
+        lock.release(mode)
+        if lock.kind == "hierarchical lock":
+            self.releaseIntents(lName, mode)
+
+    def releaseIntents(self, lName, mode):
+        "let go of the intention locks that were taken along with hierarchical lock lName"
+        for parent, intent in intentsFor(lName, mode):
+            modes = self.intents[parent]
+            modes[intent] -= 1
+            if not modes[intent]:
+                del(modes[intent])
+                if not modes:
+                    del(self.intents[parent])
+            LockDict[parent].release(intent)
+
+    def releasePermits(self, lName, count):
+        "give back some but not all of the permits we hold on a semaphore"
+        self.locks[lName] -= count
+        if self.server.journal is not None:
+            self.server.journal.grant(self, lName, self.locks[lName])
+        LockDict[lName].release(count)
+
+    def recordHold(self, lock, now):
+        since = self.heldSince.pop(lock.lName, None)
+        if since is not None:
+            HoldTimes.record(now - since)
+            lock.stats.holdTimes.record(now - since)
+
+    def send(self, data, tag=None):
+        """
+        queue data to go back to the client.  The server loop flushes the queue once per wakeup
+        so replies to pipelined commands go out together.  Replies to tagged commands get the tag
+        prepended.
+
+        this will fail on unicode strings
+        """
+        if tag is not None:
+            data = "@%s %s"%(tag, data)
+        data = bytes(data, 'ascii')
+        self.writeBuf += data
+        if self.session is not None:
+            self.linesOut += 1
+            self.replay.append(data)
+        self.server.dirty.add(self)
+
+    def flush(self):
+        "write as much of writeBuf as the socket will take and watch for writability if anything is left"
+        if self.closed or self.detached:
+            return
+        if self.writeBuf:
+            try:
+                sent = self.clientSocket.send(self.writeBuf)
+                del(self.writeBuf[:sent])
+            except BlockingIOError:
+                pass
+            except:
+                self.connectionLost()
+                return
+            if len(self.writeBuf) > MaxWriteBuf:
+                # client isn't reading its replies
+                self.overflowed()
+                if self.closed:
+                    return
+        self.updateInterest()
+
+    def overflowed(self):
+        self.killClient()
+
+    def write(self):
+        self.flush()
+
+    def updateInterest(self):
+        if self.detached:
+            return
+        reading = self.waiting is False or self.readEnd - self.readStart <= MaxReadBuf
+        writing = len(self.writeBuf) > 0
+        if reading != self.reading or writing != self.writing:
+            self.reading = reading
+            self.writing = writing
+            self.server.modify(self.clientSocket, self, reading, writing)
+
+    def killClient(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.session is not None:
+            del(SessionDict[self.session])
+            if self.detached:
+                self.graceTimer.cancel()
+        self.dropState()
+        if not self.detached:
+            self.disconnect()
+
+    def connectionLost(self):
+        "the socket has gone, if the client asked for a session hang on to everything for a while"
+        if self.session is None or self.closed:
+            self.killClient()
+            return
+        if Verbose:
+            print("client on fd %s dropped, holding its session for %s seconds"%(self.fileno, self.grace))
+        self.disconnect()
+        self.detached = True
+        self.clientSocket = None
+        # what was still to go out is in self.replay, a resume sends it from there
+        self.writeBuf = bytearray()
+        self.graceTimer = self.server.callLater(self.grace, self.killClient)
+
+    def adopt(self, conn, missed, tag):
+        """
+        carry on our session on conn's socket, conn being the new connection the client sent resume
+        on.  It's quietly dropped, and the last missed lines we sent go out again after the reply
+        """
+        if self.detached:
+            self.graceTimer.cancel()
+            self.detached = False
+        else:
+            # the client gave up on the old connection before we noticed anything wrong with it
+            self.disconnect()
+        conn.closed = True
+        conn.dropState()
+        self.server.unregister(conn.clientSocket)
+        self.clientSocket = conn.clientSocket
+        self.fileno = conn.fileno
+        self.address = conn.address
+        self.peer, conn.peer = conn.peer, None
+        ClientDict[self.fileno] = self
+        self.reading = self.writing = False
+        if Verbose:
+            print("client on fd %s resumed session from %s"%(self.fileno, self.address))
+
+        # a partial last line is dropped, the client sends it again.  Anything that came in behind
+        # the resume follows on from what we have
+        end = self.readBuf.rfind(b'\n', self.readStart, self.readEnd)
+        self.readEnd = end + 1 if end >= 0 else self.readStart
+        received = self.linesIn + self.readBuf.count(b'\n', self.readStart, self.readEnd)
+        self.readBuf[self.readEnd:] = conn.readBuf[conn.readStart:conn.readEnd]
+        self.readEnd = len(self.readBuf)
+        if self.readEnd < ReadBufSize:
+            self.readBuf.extend(bytes(ReadBufSize - self.readEnd))
+        conn.readStart = conn.readEnd
+
+        reply = "RESUMED %s %d\n"%(self.session, received)
+        if tag is not None:
+            reply = "@%s %s"%(tag, reply)
+        self.writeBuf = bytearray(bytes(reply, 'ascii'))
+        if missed:
+            self.writeBuf += b"".join(itertools.islice(self.replay, len(self.replay) - missed, None))
+        self.server.dirty.add(self)
+        self.server.schedule(self)
+
+    def dropState(self):
+        "give up everything the client holds or is waiting for"
+        global QueuedWaiters
+
+        if self.server.journal is not None:
+            # logged first so nothing granted to others below can come before it in the journal
+            self.server.journal.closed(self)
+
+        # stop waiting first so none of our own releases can grant us anything.  Every request comes
+        # out of its queues before anyone is let go, otherwise letting someone go from one queue could
+        # grant one of our own requests we haven't got to yet
+        for request in self.waits.values():
+            request.detach()
+        QueuedWaiters -= len(self.waits)
+        for lName in itertools.chain(list(self.waitNames), list(self.waitIntents)):
+            lock = LockDict.get(lName)
+            if lock is not None:
+                lock.grantWaiters()
+
+        for timer in self.leases.values():
+            timer.cancel()
+
+        for lName in list(self.cached):
+            self.uncache(lName)
+
+        now = time.perf_counter_ns()
+        for lName, mode in self.locks.items():
+            lock = LockDict[lName]
+            self.recordHold(lock, now)
+            lock.release(mode)
+
+        for lName, modes in self.intents.items():
+            lock = LockDict[lName]
+            for mode, count in modes.items():
+                for i in range(count):
+                    lock.release(mode)
+
+        for mName in list(self.watches):
+            self.dropWatch(mName)
+
+        for name in list(self.latches):
+            LatchDict[name].disown()
+
+        for mName in self.msgs:
+            MsgDict[mName].release(self)
+
+    def disconnect(self):
+        global ClientConnections
+
+        self.server.unregister(self.clientSocket)
+        try:
+            self.clientSocket.close()
+        except:
+            pass
+
+        del(ClientDict[self.fileno])
+        if self.peer is not None:
+            ClientConnections -= 1
+            HostConnections[self.peer] -= 1
+            if not HostConnections[self.peer]:
+                del(HostConnections[self.peer])
+            self.peer = None
+
+    def socketError(self):
+        self.connectionLost()
+
+
+
+if hasattr(select, 'epoll'):
+    class EdgeEpollSelector(selectors.EpollSelector):
+        "epoll selector that registers every fd edge triggered"
+        _EVENT_READ = select.EPOLLIN | select.EPOLLET
+        _EVENT_WRITE = select.EPOLLOUT | select.EPOLLET
+else:
+    EdgeEpollSelector = None
+
+
+class Timer(object):
+    "handle returned by LockServer.callLater().  cancel() stops it from firing"
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.wheel = None
+        self.level = 0
+        self.slot = None  # the TimerWheel slot holding us
+
+    def cancel(self):
+        self.callback = None
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+            self.wheel.levelCounts[self.level] -= 1
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel.  Adding and cancelling a timer are O(1) and each timer is moved down
+    a level at most once per level, so millions of armed timers (lock wait timeouts, leases, ...)
+    cost O(1) amortized each.
+
+    Level 0 has one slot per tick, each slot of the level above covers a full turn of the level
+    below it.  When a level wraps round, the next slot of the level above is emptied back into the
+    wheel.  Timers never fire early but may fire up to a tick late.  Anything further out than the
+    wheel covers is parked in the last slot of the top level and rescheduled from there.
+    """
+    def __init__(self, tick=0.01, slots=256, levels=4, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[set() for i in range(slots)] for l in range(levels)]
+        self.current = int(now / tick)  # the last tick that has been run
+        self.count = 0
+        self.levelCounts = [0]*levels
+
+    def add(self, timer):
+        expires = max(int(math.ceil(timer.when / self.tick)), self.current + 1)
+        delta = expires - self.current
+        span = self.slots
+        level = 0
+        while delta >= span and level < len(self.levels) - 1:
+            span *= self.slots
+            level += 1
+        if delta >= span:
+            # too far out, park it at the far edge of the wheel and it'll be re-added from there
+            expires = self.current + span - 1
+        index = (expires // (span // self.slots)) % self.slots
+        slot = self.levels[level][index]
+        slot.add(timer)
+        timer.wheel = self
+        timer.level = level
+        timer.slot = slot
+        self.count += 1
+        self.levelCounts[level] += 1
+
+    def nextTimeout(self, now):
+        "seconds until the wheel next needs to run, or None if no timers are armed"
+        if self.count == 0:
+            return None
+        # nothing can be due before level 0 wraps and the next cascade happens
+        tick = (self.current // self.slots + 1) * self.slots
+        if self.levelCounts[0] > 0:
+            level0 = self.levels[0]
+            for t in range(self.current + 1, tick):
+                if level0[t % self.slots]:
+                    tick = t
+                    break
+        return max(0, tick * self.tick - now)
+
+    def advance(self, now):
+        "run every timer that is due by now"
+        target = int(now / self.tick)
+        while self.current < target:
+            if self.count == 0:
+                self.current = target
+                break
+            self.current += 1
+            tick = self.current
+            # cascade the levels above whenever the level below wraps round
+            level = 0
+            span = 1
+            while level < len(self.levels) - 1 and (tick // span) % self.slots == 0:
+                level += 1
+                span *= self.slots
+                self.cascade(level, (tick // span) % self.slots)
+            self.fire(self.levels[0][tick % self.slots])
+
+    def cascade(self, level, index):
+        slot = self.levels[level][index]
+        if not slot:
+            return
+        self.levels[level][index] = set()
+        self.count -= len(slot)
+        self.levelCounts[level] -= len(slot)
+        for timer in slot:
+            self.add(timer)
+
+    def fire(self, slot):
+        if not slot:
+            return
+        timers = list(slot)
+        slot.clear()
+        self.count -= len(timers)
+        self.levelCounts[0] -= len(timers)
+        for timer in timers:
+            callback = timer.callback
+            timer.callback = None
+            timer.slot = None
+            if callback is not None:
+                callback()
+
+
+class LockServer(object):
+    """
+    The event loop.  Every socket is registered once with a selectors selector (epoll on linux)
+    and only the ready ones are dispatched, so an idle connection costs nothing per wakeup.
+
+    edgeTriggered uses EPOLLET where it's available, connections then drain their socket on each
+    wakeup.  loopTimeout caps how long the loop sleeps between runs of the timers.  policy picks
+    how waiters are served (see ServerLock).
+
+    journal is a directory to keep a write-ahead log and snapshots of the lock and message state in
+    so a restarted server picks up where it left off (see Journal), fsync says how often it's synced.
+    recoveryGrace is how long the recovered locks are held for their old owners.
+
+    sessionGrace caps how long a client that asked for a session gets to reconnect and resume it
+    after its connection drops before everything it held is given up.
+
+    metricsPort, if given, is a port to serve the stats on in the Prometheus text format.
+
+    maxMsgBytes caps the total size of the stored messages, the least recently used are dropped
+    to make room for new ones.
+
+    unixSocket is a path to listen on as a unix domain socket as well, clients on the same host
+    skip the TCP stack by connecting to it.  backlog is how many connections the kernel queues
+    for us to accept on each listening socket.
+
+    maxConnections and maxHostConnections cap the client connections in all and from any one host,
+    maxWaiters and maxClientWaiters the requests waiting for locks, barriers and latches in all and
+    on any one connection.  Past them a new connection is sent "! BUSY retry=<seconds>" and closed,
+    a new wait gets "BUSY retry=<seconds>" as its reply.  verbose logs every connection.
+    """
+    connectionClass = LockConnection
+
+    def __init__(self, host='', port=29292, edgeTriggered=False, loopTimeout=None, policy=None, start=True,
+                 journal=None, fsync="always", recoveryGrace=None, sessionGrace=None, metricsPort=None,
+                 maxMsgBytes=None, unixSocket=None, backlog=None, maxConnections=None, maxHostConnections=None,
+                 maxWaiters=None, maxClientWaiters=None, verbose=None):
+        global LockPolicy, MaxMsgBytes, MaxConnections, MaxHostConnections, MaxWaiters, MaxClientWaiters, Verbose
+
+        if policy is not None:
+            if policy not in LockPolicies:
+                raise ValueError("unknown lock policy %s"%policy)
+            LockPolicy = policy
+        if maxMsgBytes is not None:
+            MaxMsgBytes = maxMsgBytes
+        if maxConnections is not None:
+            MaxConnections = maxConnections
+        if maxHostConnections is not None:
+            MaxHostConnections = maxHostConnections
+        if maxWaiters is not None:
+            MaxWaiters = maxWaiters
+        if maxClientWaiters is not None:
+            MaxClientWaiters = maxClientWaiters
+        if verbose is not None:
+            Verbose = verbose
+
+        self.host = host
+        self.port = port
+        self.unixSocket = unixSocket
+        self.backlog = backlog if backlog is not None else DefaultListenBacklog
+        self.loopTimeout = loopTimeout
+        self.edgeTriggered = edgeTriggered and EdgeEpollSelector is not None
+        if self.edgeTriggered:
+            self.selector = EdgeEpollSelector()
+        else:
+            self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel()
+        self.pending = collections.deque()  # connections with queued commands to process
+        self.dirty = set()  # connections with replies to flush
+        self.running = False
+        self.sessionGrace = sessionGrace if sessionGrace is not None else MaxSessionGrace
+        self.metricsPort = metricsPort
+        self.started = time.monotonic()
+        # given up when we run out of fds so we can still accept a connection to tell it we're busy
+        self.spareFd = os.open(os.devnull, os.O_RDONLY)
+
+        self.journal = None
+        if journal is not None:
+            self.journal = Journal(self, journal, fsync)
+            self.journal.recover(recoveryGrace)
+
+        if start:
+            self.serve()
+
+
+    def listen(self):
+        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSocket.bind((self.host, self.port))
+        self.listenSocket.listen(self.backlog)
+        self.listenSocket.setblocking(0)
+
+        ClientDict[self.listenSocket.fileno()] = self
+        self.register(self.listenSocket, self)
+        if self.unixSocket is not None:
+            UnixListener(self, bindUnixSocket(self.unixSocket, self.backlog))
+
+    def serve(self):
+        self.listen()
+        if self.metricsPort is not None:
+            MetricsListener(self, self.host, self.metricsPort)
+        self.running = True
+        try:
+            while self.running:
+                self.runOnce(self.pollTimeout())
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+            if self.unixSocket is not None:
+                removeUnixSocket(self.unixSocket)
+
+    def runOnce(self, timeout=None):
+        """
+        wait at most timeout seconds for events, dispatch them and then run any timers that are due.
+        Connections unblocked along the way get to process their queued commands and finally all
+        of the replies generated are flushed.
+        """
+        for key, events in self.selector.select(timeout):
+            handler = key.data
+            # a connection may have been killed by an earlier event in this same batch
+            if ClientDict.get(key.fd) is not handler:
+                continue
+            if events & selectors.EVENT_WRITE:
+                handler.write()
+            if events & selectors.EVENT_READ and ClientDict.get(key.fd) is handler:
+                handler.read()
+        self.runTimers()
+        self.runPending()
+        if self.journal is not None:
+            # group commit: everything this pass did goes to disk before any of its replies go out
+            self.journal.commit()
+        self.flush()
+
+    def schedule(self, conn):
+        "have conn.processReadBuf() called from the loop once the current event is done"
+        self.pending.append(conn)
+
+    def runPending(self):
+        while self.pending:
+            conn = self.pending.popleft()
+            if not conn.closed:
+                conn.processReadBuf()
+
+    def flush(self):
+        while self.dirty:
+            self.dirty.pop().flush()
+
+    def register(self, sock, handler):
+        self.selector.register(sock, selectors.EVENT_READ, handler)
+
+    def modify(self, sock, handler, reading, writing):
+        events = 0
+        if reading:
+            events |= selectors.EVENT_READ
+        if writing:
+            events |= selectors.EVENT_WRITE
+        # selectors won't take an empty event mask so a fully paused socket is unregistered
+        if events == 0:
+            self.unregister(sock)
+        elif sock in self.selector.get_map():
+            self.selector.modify(sock, events, handler)
+        else:
+            self.selector.register(sock, events, handler)
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def callLater(self, delay, callback):
+        "run callback() from the event loop in delay seconds, returns a Timer"
+        timer = Timer(time.monotonic() + delay, callback)
+        self.timers.add(timer)
+        return timer
+
+    def pollTimeout(self):
+        timeout = self.loopTimeout
+        untilNext = self.timers.nextTimeout(time.monotonic())
+        if untilNext is not None and (timeout is None or untilNext < timeout):
+            timeout = untilNext
+        return timeout
+
+    def runTimers(self):
+        self.timers.advance(time.monotonic())
+
+    def read(self):
+        self.accept(self.listenSocket)
+
+    def accept(self, listenSocket):
+        """
+        take up to AcceptBatch of the connections waiting on listenSocket, the rest wait for the
+        next pass so a storm of them can't starve the clients we already have.  Edge triggered
+        there won't be another wakeup for them so they're all taken
+        """
+        global ClientConnections
+
+        for i in itertools.count():
+            if i == AcceptBatch and not self.edgeTriggered:
+                return
+            try:
+                newSock, addr = listenSocket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                continue
+            except OSError as e:
+                if e.errno not in AcceptErrors:
+                    raise
+                # the connections left in the backlog wait for a later pass unless the spare fd
+                # lets us take them one at a time to turn them away
+                if not self.shedConnection(listenSocket):
+                    return
+                continue
+            if newSock.family == socket.AF_UNIX:
+                addr = "unix:%s"%listenSocket.getsockname()
+                peer = addr
+            else:
+                # replies to pipelined requests go out over several writes, don't let nagle hold them up
+                newSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                peer = addr[0]
+            if ((MaxConnections is not None and ClientConnections >= MaxConnections) or
+                    (MaxHostConnections is not None and HostConnections.get(peer, 0) >= MaxHostConnections)):
+                self.turnAway(newSock)
+                continue
+            conn = self.connectionClass(newSock, addr, self)
+            conn.peer = peer
+            ClientConnections += 1
+            HostConnections[peer] = HostConnections.get(peer, 0) + 1
+
+    def shedConnection(self, listenSocket):
+        "we're out of fds, accept a connection using the spare one and turn it away.  False if we couldn't"
+        if self.spareFd is not None:
+            os.close(self.spareFd)
+            self.spareFd = None
+        try:
+            newSock, addr = listenSocket.accept()
+        except OSError:
+            newSock = None
+        if newSock is not None:
+            self.turnAway(newSock)
+        try:
+            self.spareFd = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            pass  # try again next time
+        return newSock is not None
+
+    def turnAway(self, sock):
+        "tell a connection we're not taking that we're busy and hang up on it"
+        global BusyReplies
+
+        BusyReplies += 1
+        try:
+            sock.setblocking(0)
+            sock.send(b"! BUSY retry=%g\n"%BusyRetry)
+        except OSError:
+            pass
+        sock.close()
+
+    def socketError(self):
+        # something has gone to hell with the server.  Just shut down
+        sys.exit()
+
+    def stats(self):
+        "the figures for stats server and the metrics listener"
+        conns = [conn for conn in ClientDict.values()
+                 if isinstance(conn, LockConnection) and not isinstance(conn, ShardLink)]
+        return {"uptime": time.monotonic() - self.started,
+                "connections": len(conns),
+                "detached": sum(1 for conn in SessionDict.values() if conn.detached),
+                "locks": len(LockDict),
+                "waiters": (sum(len(lock.waitQueue) for lock in LockDict.values()) +
+                            sum(len(sync.waiting) for sync in itertools.chain(BarrierDict.values(), LatchDict.values()))),
+                "msgs": len(MsgDict),
+                "msgBytes": MsgBytes,
+                "evictedMsgs": EvictedMsgs,
+                "busy": BusyReplies,
+                "commands": {cmd: {"count": count, "seconds": CommandTimes[cmd].summary(1e9)}
+                             for cmd, count in CommandCounts.items() if count},
+                "waitSeconds": WaitTimes.summary(1e9),
+                "holdSeconds": HoldTimes.summary(1e9),
+                "queueDepth": QueueDepths.summary()}
+
+    def metricsText(self):
+        "the stats in the Prometheus text exposition format"
+        stats = self.stats()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP lockserver_%s %s"%(name, help))
+            lines.append("# TYPE lockserver_%s %s"%(name, kind))
+            for labels, value in samples:
+                lines.append("lockserver_%s%s %s"%(name, labels, value))
+
+        def histogram(name, help, series, scale):
+            samples = []
+            for labels, hist in series:
+                for top, count in hist.powerBuckets():
+                    samples.append(('_bucket{%sle="%.9g"}'%(labels, top / scale), count))
+                samples.append(('_bucket{%sle="+Inf"}'%labels, hist.count))
+                samples.append(('_sum' + ('{%s}'%labels.rstrip(',') if labels else ''), hist.total / scale))
+                samples.append(('_count' + ('{%s}'%labels.rstrip(',') if labels else ''), hist.count))
+            metric(name, "histogram", help, samples)
+
+        for name, key, help in (("connections", "connections", "Client connections."),
+                                ("detached", "detached", "Sessions waiting for their client to resume them."),
+                                ("locks", "locks", "Locks held or waited for."),
+                                ("waiters", "waiters", "Requests waiting for locks."),
+                                ("msgs", "msgs", "Messages stored."),
+                                ("msg_bytes", "msgBytes", "Size of the stored messages and their names.")):
+            metric(name, "gauge", help, [("", stats[key])])
+        metric("evicted_msgs_total", "counter", "Messages dropped to keep under the size cap.",
+               [("", EvictedMsgs)])
+        metric("busy_total", "counter", "Connections and waits turned away with BUSY.", [("", BusyReplies)])
+        metric("commands_total", "counter", "Commands run.",
+               [('{cmd="%s"}'%cmd, count) for cmd, count in CommandCounts.items() if count])
+        histogram("command_seconds", "Time taken to run a sample of each command.",
+                  [('cmd="%s",'%cmd, times) for cmd, times in CommandTimes.items() if times.count], 1e9)
+        histogram("wait_seconds", "Time lock requests waited before they were granted.", [("", WaitTimes)], 1e9)
+        histogram("hold_seconds", "Time locks were held.", [("", HoldTimes)], 1e9)
+        histogram("queue_depth", "Length of the wait queue a request joined.", [("", QueueDepths)], 1)
+
+        hot = sorted(LockStatsDict.values(), key=lambda entry: (entry.waitTimes.total, entry.acquisitions),
+                     reverse=True)[:DefaultStatsLocks]
+        labels = ['{lock="%s"}'%entry.lName.replace('\\', '\\\\').replace('"', '\\"') for entry in hot]
+        metric("lock_acquisitions_total", "counter", "Times each of the most contended locks was acquired.",
+               [(label, entry.acquisitions) for label, entry in zip(labels, hot)])
+        metric("lock_waited_total", "counter", "Acquisitions of each of the most contended locks that had to wait.",
+               [(label, entry.waited) for label, entry in zip(labels, hot)])
+        metric("lock_failed_total", "counter", "Requests for each of the most contended locks that failed.",
+               [(label, entry.failed) for label, entry in zip(labels, hot)])
+        metric("lock_wait_seconds_total", "counter", "Time spent waiting for each of the most contended locks.",
+               [(label, entry.waitTimes.total / 1e9) for label, entry in zip(labels, hot)])
+        metric("lock_max_queue", "gauge", "Deepest the wait queue of each of the most contended locks has been.",
+               [(label, entry.maxQueue) for label, entry in zip(labels, hot)])
+        return "\n".join(lines) + "\n"
+
+
+def bindUnixSocket(path, backlog):
+    "a listening unix domain socket at path.  A socket file left there by a server that's gone is replaced"
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError("a server is already listening on %s"%path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+def removeUnixSocket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class UnixListener(object):
+    "takes the connections to the server's unix domain socket"
+    def __init__(self, server, sock):
+        self.server = server
+        self.listenSocket = sock
+        sock.setblocking(0)
+        ClientDict[sock.fileno()] = self
+        server.register(sock, self)
+
+    def read(self):
+        self.server.accept(self.listenSocket)
+
+    def write(self):
+        pass
+
+
+class MetricsListener(object):
+    "listens for Prometheus (or anyone else) asking for the stats over http"
+    def __init__(self, server, host, port):
+        self.server = server
+        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSocket.bind((host, port))
+        self.listenSocket.listen(5)
+        self.listenSocket.setblocking(0)
+        ClientDict[self.listenSocket.fileno()] = self
+        server.register(self.listenSocket, self)
+
+    def read(self):
+        # take everyone waiting, edge triggered there's no other wakeup for them
+        while True:
+            try:
+                newSock, addr = self.listenSocket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno not in AcceptErrors:
+                    raise
+                return
+            MetricsConnection(newSock, self.server)
+
+    def write(self):
+        pass
+
+
+class MetricsConnection(object):
+    "answers a single http request, whatever it is, with the stats and hangs up"
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.fileno = sock.fileno()
+        self.readBuf = bytearray()
+        self.writeBuf = None
+        sock.setblocking(0)
+        ClientDict[self.fileno] = self
+        server.register(sock, self)
+
+    def read(self):
+        # read until there's nothing left, edge triggered we won't hear about it again
+        while self.writeBuf is None:
+            try:
+                data = self.sock.recv(ClientReadSize)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            self.readBuf += data
+            if len(data) == 0 or len(self.readBuf) > ClientReadSize:
+                self.close()
+                return
+            if b"\r\n\r\n" in self.readBuf or b"\n\n" in self.readBuf:
+                body = bytes(self.server.metricsText(), 'ascii')
+                self.writeBuf = b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n" + \
+                    b"Content-Length: %d\r\nConnection: close\r\n\r\n"%len(body) + body
+                self.server.modify(self.sock, self, False, True)
+                self.write()
+
+    def write(self):
+        while self.writeBuf:
+            try:
+                sent = self.sock.send(self.writeBuf)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            self.writeBuf = self.writeBuf[sent:]
+        self.close()
+
+    def close(self):
+        self.server.unregister(self.sock)
+        self.sock.close()
+        del(ClientDict[self.fileno])
+
+
+class GhostConnection(LockConnection):
+    """
+    stands in for a client that held locks or messages when the server went down, so that nobody
+    else is handed them the moment the server restarts.  Everything is given up after the grace
+    period
+    """
+    def __init__(self, server, ownerId):
+        self.server = server
+        self.initState()
+        self.ownerId = ownerId
+
+    def send(self, data, tag=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def updateInterest(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class Journal(object):
+    """
+    Write-ahead log of the lock and message state.  Each change is a line:
+
+        G <owner> <lName> s|x   lock granted        R <owner> <lName>       lock released
+        G <owner> <lName> <count>/<permits>         permits held on a semaphore
+        G <owner> <lName> S|X   hierarchical lock granted, the intention locks above it go with it
+        M <owner> <mName> <text> message set        D <owner> <mName>       message released
+        C <owner>               owner disconnected, everything it had is released
+
+    Lines are collected as commands run and written in one go at the end of each pass of the
+    server loop, before any replies are flushed, so a client is never told about anything that
+    isn't in the log (group commit).  fsync is "always" (sync each of those writes), "never"
+    (leave it to the OS) or a number of seconds to sync at most that often.
+
+    The log is kept in numbered segments, wal.<seq>.  Every so often the current state is written
+    to snapshot.<seq> as G and M lines (by a forked child where possible so the server doesn't
+    stop), it covers everything before wal.<seq>, and the older files are removed.  Recovery loads
+    the newest snapshot and replays the segments after it.
+    """
+    def __init__(self, server, directory, fsync="always"):
+        if fsync not in ("always", "never"):
+            fsync = float(fsync)
+        self.server = server
+        self.directory = directory
+        self.fsync = fsync
+        self.buf = bytearray()
+        self.live = {}  # key is ownerId, val is the connection, for everyone with something logged
+        self.nextOwner = itertools.count()
+        self.bootId = "%x"%int(time.time() * 1000)
+        self.seq = 0
+        self.fd = None
+        self.walBytes = 0  # written since the last snapshot
+        self.lastSync = time.monotonic()
+        self.syncTimer = None
+        self.snapshotPid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def owner(self, conn):
+        if conn.ownerId is None:
+            conn.ownerId = "%s.%d"%(self.bootId, next(self.nextOwner))
+        self.live[conn.ownerId] = conn
+        return conn.ownerId
+
+    @staticmethod
+    def modeText(lName, mode):
+        lock = LockDict[lName]
+        if lock.permits is not None:
+            return "%d/%d"%(mode, lock.permits)
+        if lock.kind == "hierarchical lock":
+            return mode
+        return "s" if mode else "x"
+
+    def grant(self, conn, lName, mode):
+        self.buf += bytes("G %s %s %s\n"%(self.owner(conn), lName, self.modeText(lName, mode)), 'ascii')
+
+    def release(self, conn, lName):
+        self.buf += bytes("R %s %s\n"%(self.owner(conn), lName), 'ascii')
+
+    def setMsg(self, conn, mName, text):
+        self.buf += bytes("M %s %s %s\n"%(self.owner(conn), mName, text), 'ascii')
+
+    def relMsg(self, conn, mName):
+        self.buf += bytes("D %s %s\n"%(self.owner(conn), mName), 'ascii')
+
+    def closed(self, conn):
+        if conn.ownerId is not None and self.live.pop(conn.ownerId, None) is not None:
+            self.buf += bytes("C %s\n"%conn.ownerId, 'ascii')
+
+    def commit(self):
+        if self.buf:
+            written = os.write(self.fd, self.buf)
+            while written < len(self.buf):
+                written += os.write(self.fd, memoryview(self.buf)[written:])
+            self.walBytes += len(self.buf)
+            self.buf.clear()
+            if self.fsync == "always":
+                os.fsync(self.fd)
+            elif self.fsync != "never" and self.syncTimer is None:
+                delay = max(0, self.lastSync + self.fsync - time.monotonic())
+                self.syncTimer = self.server.callLater(delay, self.sync)
+            if self.walBytes > JournalSnapshotBytes:
+                self.snapshot()
+
+    def sync(self):
+        self.syncTimer = None
+        os.fsync(self.fd)
+        self.lastSync = time.monotonic()
+
+    def openSegment(self, seq):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+        self.seq = seq
+        self.fd = os.open(self.path("wal.%d"%seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.walBytes = 0
+
+    def stateLines(self):
+        for ownerId, conn in self.live.items():
+            for lName, mode in conn.locks.items():
+                yield "G %s %s %s\n"%(ownerId, lName, self.modeText(lName, mode))
+            for mName in conn.msgs:
+                msg = MsgDict.get(mName)
+                if msg is not None and msg.owner is conn:
+                    yield "M %s %s %s\n"%(ownerId, mName, msg.text)
+
+    def snapshot(self):
+        "start writing a snapshot, the log carries on in a new segment"
+        if self.snapshotPid is not None:
+            try:
+                pid, status = os.waitpid(self.snapshotPid, os.WNOHANG)
+            except ChildProcessError:
+                pid = self.snapshotPid
+            if pid == 0:
+                # the last one is still being written
+                return
+            self.snapshotPid = None
+
+        self.commit()
+        seq = self.seq + 1
+        self.openSegment(seq)
+        if not hasattr(os, 'fork'):
+            self.writeSnapshot(seq)
+            return
+        pid = os.fork()
+        if pid:
+            self.snapshotPid = pid
+            return
+        status = 1
+        try:
+            self.writeSnapshot(seq)
+            status = 0
+        finally:
+            os._exit(status)
+
+    def writeSnapshot(self, seq):
+        tmp = self.path("snapshot.%d.tmp"%seq)
+        with open(tmp, "w") as f:
+            for line in self.stateLines():
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path("snapshot.%d"%seq))
+        self.syncDirectory()
+        for name, fileSeq in self.files():
+            if fileSeq < seq or (name.startswith("snapshot.") and fileSeq == seq and name.endswith(".tmp")):
+                os.remove(self.path(name))
+
+    def syncDirectory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def files(self):
+        "[(name, seq)] of the snapshots and log segments in the directory"
+        found = []
+        for name in os.listdir(self.directory):
+            kind, dot, rest = name.partition('.')
+            if kind in ("wal", "snapshot"):
+                seqText = rest.partition('.')[0]
+                if seqText.isdigit():
+                    found.append((name, int(seqText)))
+        return found
+
+    def recover(self, grace=None):
+        """
+        rebuild LockDict and MsgDict from the newest snapshot and the log after it.  The recovered
+        owners are held by GhostConnections until grace seconds are up
+        """
+        if grace is None:
+            grace = DefaultRecoveryGrace
+        files = self.files()
+        snapshots = [seq for name, seq in files if name == "snapshot.%d"%seq]
+        start = max(snapshots) if snapshots else 0
+        segments = sorted(seq for name, seq in files if name == "wal.%d"%seq and seq >= start)
+
+        owners = {}  # key is ownerId, val is {lName: shared, (count, permits) or S|X for a hierarchical lock}
+        msgs = {}  # key is mName, val is (ownerId, text)
+        ownerMsgs = {}  # key is ownerId, val is the set of mNames it has set
+        if snapshots:
+            self.replay(self.path("snapshot.%d"%start), owners, msgs, ownerMsgs)
+        for seq in segments:
+            self.replay(self.path("wal.%d"%seq), owners, msgs, ownerMsgs)
+
+        ghosts = {}
+        for ownerId, locks in owners.items():
+            if not locks:
+                continue
+            ghost = ghosts[ownerId] = GhostConnection(self.server, ownerId)
+            for lName, mode in locks.items():
+                if isinstance(mode, tuple):
+                    mode, permits = mode
+                    if lName not in LockDict:
+                        ServerSemaphore(lName, permits)
+                elif isinstance(mode, str):
+                    for parent, intent in intentsFor(lName, mode):
+                        if parent not in LockDict:
+                            IntentLock(parent)
+                        LockDict[parent].tryRequest(intent)
+                        modes = ghost.intents.setdefault(parent, {})
+                        modes[intent] = modes.get(intent, 0) + 1
+                    if lName not in LockDict:
+                        IntentLock(lName)
+                LockDict[lName].tryRequest(mode)
+                ghost.locks[lName] = mode
+        for mName, (ownerId, text) in msgs.items():
+            ghost = ghosts.get(ownerId)
+            if ghost is None:
+                ghost = ghosts[ownerId] = GhostConnection(self.server, ownerId)
+            MsgDict[mName].set(text, ghost)
+            ghost.msgs.add(mName)
+        for ownerId, ghost in ghosts.items():
+            self.live[ownerId] = ghost
+            self.server.callLater(grace, ghost.killClient)
+        if ghosts:
+            print("recovered %d locks and %d messages held by %d clients"%
+                  (sum(len(ghost.locks) for ghost in ghosts.values()), len(msgs), len(ghosts)))
+
+        # never append to an old segment, its last line might be torn
+        self.openSegment(max([start] + segments) + 1)
+        self.server.callLater(JournalSnapshotInterval, self.periodicSnapshot)
+
+    def periodicSnapshot(self):
+        if self.walBytes or self.buf:
+            self.snapshot()
+        self.server.callLater(JournalSnapshotInterval, self.periodicSnapshot)
+
+    @staticmethod
+    def replay(fileName, owners, msgs, ownerMsgs):
+        with open(fileName, "rb") as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # a partly written last line is dropped
+        for line in data[:end].decode('ascii').splitlines():
+            op, sp, rest = line.partition(' ')
+            # lock names can have spaces in them, owner ids, message names and modes never do
+            try:
+                if op == "G":
+                    ownerId, lName = rest.split(' ', 1)
+                    lName, mode = lName.rsplit(' ', 1)
+                    if '/' in mode:
+                        count, slash, permits = mode.partition('/')
+                        mode = (int(count), int(permits))
+                    elif mode not in ("S", "X"):
+                        mode = mode == "s"
+                    owners.setdefault(ownerId, {})[lName] = mode
+                elif op == "R":
+                    ownerId, lName = rest.split(' ', 1)
+                    owners.get(ownerId, {}).pop(lName, None)
+                elif op == "M":
+                    ownerId, mName, text = rest.split(' ', 2)
+                    msgs[mName] = (ownerId, text)
+                    ownerMsgs.setdefault(ownerId, set()).add(mName)
+                elif op == "D":
+                    ownerId, mName = rest.split(' ', 1)
+                    if msgs.get(mName, (None,))[0] == ownerId:
+                        del msgs[mName]
+            except ValueError:
+                print("skipping bad line in %s: %s"%(fileName, line))
+                continue
+            if op == "C":
+                owners.pop(rest, None)
+                for mName in ownerMsgs.pop(rest, ()):
+                    if msgs.get(mName, (None,))[0] == rest:
+                        del msgs[mName]
+
+    def close(self):
+        self.commit()
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+################################################################
+#
+# Multi-process server
+#
+# ShardedLockServer splits the lock and message names between
+# a number of shard processes, each of them an ordinary single
+# threaded LockServer with its own LockDict and MsgDict.  Client
+# connections are taken by router processes which pass each
+# command on to the shard that owns the name it's about and put
+# the replies back in order.
+#
+# Routers and shards talk over socketpairs.  Each line on one is
+# a frame, "<connId> <line>" carries a command or a reply for
+# one client connection and "<connId>" on its own says that
+# connection is gone.
+#
+################################################################
+
+
+def shardKey(name):
+    """
+    the part of a name that decides its shard.  Names with a {tag} in them go by just the tag so
+    "{job1}.in" and "{job1}.out" always end up on the same shard and can be mlocked together
+    """
+    start = name.find('{')
+    if start >= 0:
+        end = name.find('}', start + 1)
+        if end > start + 1:
+            return name[start + 1:end]
+    return name
+
+
+def shardOf(name, shards):
+    return zlib.crc32(bytes(shardKey(name), 'ascii')) % shards
+
+
+class ShardLink(LockConnection):
+    "one end of the socketpair between a router and a shard"
+    def __init__(self, sock, name, server, index):
+        self.index = index
+        super(ShardLink, self).__init__(sock, name, server)
+
+    def processLine(self, line):
+        connId, sp, line = line.partition(' ')
+        self.server.frame(self, connId, line if sp == ' ' else None)
+
+    def overflowed(self):
+        # the other end is just busy, it'll catch up
+        pass
+
+    def killClient(self):
+        if not self.closed:
+            super(ShardLink, self).killClient()
+            self.server.linkLost(self)
+
+
+class VirtualConnection(LockConnection):
+    """
+    a client of a shard.  Its commands come in, and its replies go back out, over the link from the
+    router the client is actually connected to
+    """
+    def __init__(self, connId, link):
+        self.connId = connId
+        self.link = link
+        self.server = link.server
+        self.lines = collections.deque()  # commands waiting to be run
+        self.hungUp = False  # True once the router has said the client is gone
+        self.initState()
+
+    def feed(self, line):
+        self.lines.append(line)
+        if self.waiting is False:
+            self.processReadBuf()
+
+    def processReadBuf(self):
+        while self.lines and self.waiting is False and not self.closed:
+            self.processLine(self.lines.popleft())
+
+    def send(self, data, tag=None):
+        if tag is not None:
+            data = "@%s %s"%(tag, data)
+        for line in data.splitlines():
+            self.link.send("%s %s\n"%(self.connId, line))
+
+    def flush(self):
+        pass
+
+    def updateInterest(self):
+        pass
+
+    def disconnect(self):
+        del self.server.conns[(self.link, self.connId)]
+        if not self.hungUp:
+            # we dropped the client so the router has to as well
+            self.link.send("%s\n"%self.connId)
+
+
+class ShardServer(LockServer):
+    "one shard of a ShardedLockServer, it has no listening socket and only talks to the routers"
+    def __init__(self, linkSockets, **kwargs):
+        self.linkSockets = linkSockets
+        self.conns = {}  # key is (link, connId), val is VirtualConnection
+        super(ShardServer, self).__init__(**kwargs)
+
+    def listen(self):
+        self.links = [ShardLink(sock, "router %d"%i, self, i) for i, sock in enumerate(self.linkSockets)]
+
+    def frame(self, link, connId, line):
+        conn = self.conns.get((link, connId))
+        if line is None:
+            if conn is not None:
+                conn.hungUp = True
+                conn.killClient()
+            return
+        if conn is None:
+            conn = self.conns[(link, connId)] = VirtualConnection(connId, link)
+        conn.feed(line)
+
+    def linkLost(self, link):
+        print("lost link to %s, shutting down"%link.address)
+        self.running = False
+
+
+class RoutedConnection(LockConnection):
+    """
+    a client connection to a router.  Commands are checked and passed to the shard that owns their
+    name rather than run here.  Replies to tagged commands go straight back to the client as they
+    arrive, untagged ones are held until everything sent before them has been answered so the client
+    sees them in order.  An untagged wait stops any more commands being passed on until it's granted,
+    same as it would on a single server.  A scan only looks at one shard so its prefix has to
+    include a {tag}, and a hierarchical lock has to be on the same shard as the names above it so
+    its root needs one ({db}/table/partition).
+    """
+    silentCmds = {"set", "setex", "relmsg"}  # commands with no reply
+    blockingCmds = {"xlockwait", "slockwait", "mlockwait", "acquirewait", "hlockwait", "upgrade",
+                    "barrier", "await"}  # untagged these hold up the connection
+
+    def __init__(self, clientSocket, address, server):
+        self.connId = str(next(server.connIds))
+        server.conns[self.connId] = self
+        self.slots = collections.deque()  # [reply, blocking] for each untagged command still to reply
+        self.shardSlots = {}  # key is shard index, val is the deque of its slots, one per shard used
+        super(RoutedConnection, self).__init__(clientSocket, address, server)
+
+    def shardFor(self, cmd, arg):
+        "the index of the shard that gets the command, None if its names don't all live on one shard"
+        if cmd == "stats":
+            words = arg.split()
+            for word in words:
+                if word.startswith("shard="):
+                    shard = word[6:]
+                    if not shard.isdigit() or int(shard) >= len(self.server.links):
+                        return None
+                    return int(shard)
+            if len(words) != 2 or words[0] != "lock":
+                return 0
+            names = words[1:]
+        elif cmd in ("mrelease", "mget"):
+            names = arg.split()
+        elif cmd in ("hlock", "hlockwait"):
+            path = arg.partition(' ')[0]
+            names = [path] + [parent for parent, intent in intentsFor(path, "S")]
+        elif cmd == "scan":
+            prefix = arg.partition(' ')[0]
+            if shardKey(prefix) == prefix:
+                return None
+            names = [prefix]
+        elif cmd in ("mlock", "mlockwait"):
+            items = arg.split()
+            while items and items[-1].partition('=')[0] in LockConnection.lockOptions:
+                items.pop()
+            names = [item.partition(':')[2] for item in items]
+        else:
+            names = [arg.partition(' ')[0]]
+        shards = {shardOf(name, len(self.server.links)) for name in names}
+        if len(shards) != 1:
+            return None
+        return shards.pop()
+
+    def processLine(self, line):
+        parsed = self.parseLine(line)
+        if parsed is None:
+            self.killClient()
+            return
+        tag, cmd, arg = parsed
+        if cmd in ("session", "resume"):
+            # sessions belong to the client's connection to us, the shards never see them
+            LockConnection.processLine(self, line)
+            return
+        shard = self.shardFor(cmd, arg)
+        if shard is None:
+            if cmd == "scan":
+                reply = "ERROR scan %s needs a {tag} in the prefix"%arg
+            elif cmd in ("hlock", "hlockwait"):
+                reply = "ERROR %s needs a {tag} at its root"%arg.partition(' ')[0]
+            else:
+                reply = "ERROR %s are on different shards"%arg
+            if tag is None:
+                self.slots.append([reply, False])
+                self.sendReady()
+            else:
+                self.send(reply + "\n", tag)
+            return
+
+        self.server.links[shard].send("%s %s\n"%(self.connId, line.strip()))
+        slots = self.shardSlots.get(shard)
+        if slots is None:
+            slots = self.shardSlots[shard] = collections.deque()
+        if tag is None and cmd not in RoutedConnection.silentCmds:
+            slot = [None, cmd in RoutedConnection.blockingCmds]
+            self.slots.append(slot)
+            slots.append(slot)
+            self.waiting = slot[1]
+
+    def shardReply(self, shard, line):
+        if line.startswith('@') or line.startswith('!'):
+            self.send(line + "\n")
+            return
+        slot = self.shardSlots[shard].popleft()
+        slot[0] = line
+        if slot[1]:
+            self.waiting = False
+            self.server.schedule(self)
+        self.sendReady()
+
+    def sendReady(self):
+        while self.slots and self.slots[0][0] is not None:
+            self.send(self.slots.popleft()[0] + "\n")
+
+    def dropState(self):
+        for shard in self.shardSlots:
+            self.server.links[shard].send("%s\n"%self.connId)
+        del self.server.conns[self.connId]
+
+
+class RouterServer(LockServer):
+    "takes client connections for a ShardedLockServer and routes their commands to the shards"
+    connectionClass = RoutedConnection
+
+    def __init__(self, listenSocket, linkSockets, unixListenSocket=None, **kwargs):
+        self.listenSocket = listenSocket
+        self.unixListenSocket = unixListenSocket
+        self.linkSockets = linkSockets
+        self.conns = {}  # key is connId, val is RoutedConnection
+        self.connIds = itertools.count()
+        super(RouterServer, self).__init__(**kwargs)
+
+    def listen(self):
+        self.links = [ShardLink(sock, "shard %d"%i, self, i) for i, sock in enumerate(self.linkSockets)]
+        self.listenSocket.setblocking(0)
+        ClientDict[self.listenSocket.fileno()] = self
+        self.register(self.listenSocket, self)
+        if self.unixListenSocket is not None:
+            UnixListener(self, self.unixListenSocket)
+
+    def frame(self, link, connId, line):
+        conn = self.conns.get(connId)
+        if conn is None:
+            return
+        if line is None:
+            conn.killClient()
+        else:
+            conn.shardReply(link.index, line)
+
+    def linkLost(self, link):
+        print("lost link to %s, shutting down"%link.address)
+        self.running = False
+
+
+class ParentWatch(object):
+    "our end of a socket from the parent process, it only turns readable once the parent is gone"
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        ClientDict[sock.fileno()] = self
+        server.register(sock, self)
+
+    def read(self):
+        self.server.running = False
+
+    def write(self):
+        pass
+
+
+class ShardedLockServer(object):
+    """
+    runs the lock server as shards processes owning a slice of the names each plus routers processes
+    (one per shard by default) sharing the listening socket.  Commands that don't name anything in
+    particular still need one name to route by, and mlock/mrelease only work on names that are all
+    on the same shard (use {tags} to keep names that are locked together on one shard).
+
+    stats other than for a single lock come from one shard, shard 0 unless there's a shard=<n>
+    argument.  stats server is that shard's own view: its uptime, and no connections or detached
+    sessions since those are all in the routers, nor the connections they turn away as busy.  With
+    metricsPort each shard serves its metrics on metricsPort + its index.  maxMsgBytes applies to
+    each shard separately, and so do maxWaiters and maxClientWaiters.  The connection limits apply
+    to each router.
+
+    With unixSocket the routers share a unix domain socket at that path as well as the TCP port.
+
+    Sessions live in the router the client is connected to, so a resume only finds its session if
+    the new connection lands on the same router, which is only certain with a single router.
+
+    The parent process just watches over the rest, if any of them dies they're all shut down.
+    """
+    def __init__(self, host='', port=29292, shards=2, routers=None, edgeTriggered=False, loopTimeout=None,
+                 policy=None, start=True, journal=None, fsync="always", recoveryGrace=None, sessionGrace=None,
+                 metricsPort=None, maxMsgBytes=None, unixSocket=None, backlog=None, maxConnections=None,
+                 maxHostConnections=None, maxWaiters=None, maxClientWaiters=None, verbose=None):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("ShardedLockServer needs os.fork()")
+        if policy is not None and policy not in LockPolicies:
+            raise ValueError("unknown lock policy %s"%policy)
+        self.host = host
+        self.port = port
+        self.shards = shards
+        self.routers = routers if routers is not None else shards
+        self.unixSocket = unixSocket
+        self.backlog = backlog if backlog is not None else DefaultListenBacklog
+        self.serverArgs = dict(edgeTriggered=edgeTriggered, loopTimeout=loopTimeout, policy=policy,
+                               sessionGrace=sessionGrace, maxMsgBytes=maxMsgBytes, maxConnections=maxConnections,
+                               maxHostConnections=maxHostConnections, maxWaiters=maxWaiters,
+                               maxClientWaiters=maxClientWaiters, verbose=verbose)
+        self.journal = journal
+        self.journalArgs = dict(fsync=fsync, recoveryGrace=recoveryGrace)
+        self.metricsPort = metricsPort
+        self.pids = []
+
+        if start:
+            self.serve()
+
+    def start(self):
+        "bind and fork off the shards and routers, returns once they're running"
+        listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listenSocket.bind((self.host, self.port))
+        listenSocket.listen(self.backlog)
+        listeners = [listenSocket]
+        unixListenSocket = None
+        if self.unixSocket is not None:
+            unixListenSocket = bindUnixSocket(self.unixSocket, self.backlog)
+            listeners.append(unixListenSocket)
+
+        # pairs[router][shard] is the (router end, shard end) of the link between them
+        pairs = [[socket.socketpair() for s in range(self.shards)] for r in range(self.routers)]
+        self.lifeline, childEnd = socket.socketpair()
+        # each process closes every end that isn't its own so a dead one shows up as EOF on its links
+        for shard in range(self.shards):
+            mine = [pairs[r][shard][1] for r in range(self.routers)]
+            self.fork(lambda: ShardServer(mine, start=False, journal=self.shardJournal(shard), **self.journalArgs,
+                                          metricsPort=self.shardMetricsPort(shard), **self.serverArgs), childEnd,
+                      listeners + [sock for row in pairs for pair in row for sock in pair if sock not in mine])
+        for router in range(self.routers):
+            mine = [pair[0] for pair in pairs[router]]
+            self.fork(lambda: RouterServer(listenSocket, mine, unixListenSocket, start=False, **self.serverArgs),
+                      childEnd, [sock for row in pairs for pair in row for sock in pair if sock not in mine])
+
+        for sock in listeners:
+            sock.close()
+        childEnd.close()
+        for row in pairs:
+            for a, b in row:
+                a.close()
+                b.close()
+
+    def shardJournal(self, shard):
+        "each shard keeps its own journal, the number of shards has to stay the same across restarts"
+        if self.journal is None:
+            return None
+        return os.path.join(self.journal, "shard%d"%shard)
+
+    def shardMetricsPort(self, shard):
+        if self.metricsPort is None:
+            return None
+        return self.metricsPort + shard
+
+    def fork(self, makeServer, lifeline, unused):
+        pid = os.fork()
+        if pid:
+            self.pids.append(pid)
+            return
+        status = 1
+        try:
+            for sock in unused + [self.lifeline]:
+                sock.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            server = makeServer()
+            # nothing is ever sent on the lifeline, it closing means the parent has died
+            ParentWatch(lifeline, server)
+            server.serve()
+            status = 0
+        finally:
+            os._exit(status)
+
+    def serve(self):
+        self.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            os.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+        self.lifeline.close()
+        if self.unixSocket is not None:
+            removeUnixSocket(self.unixSocket)
+
+
+LockDict = DefaultDict(lambda dd,key: ServerLock(key)) # key is name of lock, val is ServerLock
+MsgDict = DefaultDict(lambda dd,key: ServerMsg(key)) # key is name of the message, val is ServerMsg
+ClientDict = {} # key is fileno of clientsocket, val is LockConnection
+SessionDict = {} # key is session token, val is LockConnection
+WatchDict = {} # key is name of a message, val is dict with a key for each LockConnection watching it
+BarrierDict = {} # key is name of a barrier, val is ServerBarrier
+LatchDict = {} # key is name of a latch, val is ServerLatch
+CachedLocks = {} # key is name of a lock, val is dict with a key for each LockConnection holding it with cache=1
+MsgIndex = SortedIndex() # names of the set messages in order, for scan
+MsgLRU = collections.OrderedDict() # key is name of a set message, least recently set or read first
+MsgBytes = 0 # size of the set messages and their names
+EvictedMsgs = 0 # messages dropped to keep MsgBytes under MaxMsgBytes
+LockStatsDict = collections.OrderedDict() # key is name of lock, val is LockStats, least recently used first
+CommandCounts = {cmd: 0 for cmd in LockConnection.cmdDict} # how many times each command has been run
+CommandTimes = {cmd: Histogram() for cmd in LockConnection.cmdDict} # nanoseconds a sample of each command took
+WaitTimes = Histogram() # nanoseconds lock requests waited before they were granted
+HoldTimes = Histogram() # nanoseconds locks were held for
+QueueDepths = Histogram() # length of a wait queue each time a request joined it
+
+LockPolicies = ("batch", "fifo", "writer")  # see ServerLock
+LockPolicy = "batch"
+
+JournalSnapshotBytes = 64<<20  # snapshot once the journal's log has grown by this much
+JournalSnapshotInterval = 300.0  # or after this many seconds if there's been any change at all
+DefaultRecoveryGrace = 30.0  # seconds recovered locks are held for their old owners after a restart
+DefaultListenBacklog = 4096  # connections the kernel queues on a listening socket for us to accept (capped by somaxconn)
+AcceptBatch = 64  # most connections taken from a listening socket per pass of the server loop
+AcceptErrors = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)  # accept() failing for want of resources
+MaxConnections = None  # client connections the server takes before answering BUSY, None for no limit
+MaxHostConnections = None  # client connections from any one host before answering BUSY
+MaxWaiters = None  # requests that can be waiting before new waits are answered BUSY
+MaxClientWaiters = None  # requests any one connection can have waiting before BUSY
+BusyRetry = 1.0  # seconds a BUSY reply tells the client to wait before trying again
+ClientConnections = 0  # client connections accepted and still open
+HostConnections = {}  # key is the address a client connected from, val is how many of its connections are open
+QueuedWaiters = 0  # requests waiting for locks, barriers or latches
+BusyReplies = 0  # connections and waits turned away with BUSY
+Verbose = False  # log every connection coming and going
+MaxSessionGrace = 300.0  # longest a server holds a dropped session for by default
+SessionReplayLines = 4096  # replies kept per session to send again after a resume
+HistogramBits = 5  # values up to 2**5 are counted exactly, larger ones to within 1/2**4
+MaxLockStats = 10000  # most lock names contention figures are kept for
+CommandSampleRate = 16  # time one command in this many on each connection
+DefaultStatsLocks = 20  # how many of the most contended locks stats and the metrics listener show
+MaxMsgBytes = None  # evict the least recently used messages past this many bytes, None for no cap
+MaxScanMsgs = 1000  # most messages a scan returns when it isn't given a count
+ReadBufSize = 1<<12  # initial size of each client's read buffer, it grows as needed
+MaxReadBuf = 1<<20  # stop reading from a client with this much unprocessed input
+MaxWriteBuf = 16<<20  # disconnect a client that lets this much output pile up
+
+################################################################
+#
+# This section is to set up a few defaults and make the server
+# easily findable in many environments.
+#
+################################################################
+
+DefaultLockHost = 'localhost'
+DefaultLockPort = 29292
+DefaultLockFile = 'lockserver.info'
+ClientReadSize = 1<<16  # read up to this much of the server's replies at a time
+DefaultPoolSize = 64  # most connections a process keeps open to one server
+DefaultPoolIdle = 60.0  # seconds an unused pooled connection is kept before closing it
+DefaultSessionGrace = 30.0  # seconds pooled connections ask the server to hold their locks for if they drop
+ClientResendLines = 4096  # lines kept to send again after resuming a session
+ClientResumeDelay = 0.5  # seconds between attempts to reconnect to resume a session
+ConnectRetryDelay = 0.05  # seconds before the first retry when the server can't be reached, doubling each time
+ConnectRetryMaxDelay = 5.0  # longest between retries
+ConnectRetryTime = 150.0  # seconds to keep trying to reach the server before giving up
+CacheRevokeInterval = 0.1  # longest before an idle pooled connection notices a cached lock has been revoked
+DefaultVirtualNodes = 160  # points each server gets on the hash ring when there are several
+HashRings = {}  # key is tuple of (host, port), val is HashRing
+UnixSockets = {}  # key is (host, port) of a server on this host, val is the path of its unix domain socket
+DiscoveredServers = {}  # key is info file name, val is (its mtime and so on, its servers), see discoverLockServers()
+LocalAddresses = None  # names and addresses of this host, see isLocalHost()
+LockClientPools = {}  # key is (host, port), val is LockClientPool
+LockClientPoolsLock = threading.Lock()
+
+def setDefaultLockServer(host, port):
+    global DefaultLockHost
+    global DefaultLockPort
+
+    DefaultLockHost = host
+    DefaultLockPort = port
+
+
+def isLocalHost(host):
+    "True if host is this machine, as far as we can tell without a lookup"
+    global LocalAddresses
+
+    if LocalAddresses is None:
+        LocalAddresses = {'', 'localhost', socket.gethostname(), socket.getfqdn(), getIp()}
+    return host in LocalAddresses or host.startswith('127.')
+
+def discoverLockServers(fileName = None):
+    """
+    returns the list of (host, port) servers in the info file.  Either it has a single server as
+    host = and port = lines or it has a "server = host:port" line for each of several servers.
+
+    A server on this host can also give the path of its unix domain socket, as a unix = line or
+    after the host:port on its server = line.  It's remembered in UnixSockets for LockClient to
+    connect to instead
+
+    What's in the file is kept in DiscoveredServers and only read again once the file changes or
+    forgetLockServers() is called because we couldn't connect
+    """
+    if fileName is None:
+        fileName = DefaultLockFile
+
+    st = os.stat(fileName)
+    version = (st.st_mtime_ns, st.st_size, st.st_ino, DefaultLockHost, DefaultLockPort)
+    known = DiscoveredServers.get(fileName)
+    if known is not None and known[0] == version:
+        return list(known[1])
+
+    host = DefaultLockHost
+    port = DefaultLockPort
+    unixSocket = None
+    servers = []
+    unixSockets = {}
+
+    with open(fileName) as f:
+        lines = f.readlines()
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#') or line == '':
+            continue
+        key,eq,val = line.partition('=')
+        if eq != '=':
+            raise RuntimeError("invalid line %s in lockfile pointer %s"%(line, fileName))
+        key = key.strip()
+        val = val.strip()
+        if key == 'host':
+            host = val
+        elif key == 'port':
+            port = int(val)
+        elif key == 'unix':
+            unixSocket = val
+        elif key == 'server':
+            val, sp, path = val.partition(' ')
+            sHost, colon, sPort = val.rpartition(':')
+            if colon != ':':
+                raise RuntimeError("invalid line %s in lockfile pointer %s"%(line, fileName))
+            servers.append((sHost, int(sPort)))
+            if path.strip():
+                unixSockets[servers[-1]] = path.strip()
+
+    if not servers:
+        servers.append((host, port))
+        if unixSocket is not None:
+            unixSockets[(host, port)] = unixSocket
+    for server, path in unixSockets.items():
+        if UnixSockets.get(server) != path and isLocalHost(server[0]):
+            UnixSockets[server] = path
+    DiscoveredServers[fileName] = (version, servers)
+    return list(servers)
+
+def forgetLockServers(fileName=None):
+    "have the next discoverLockServers() read the info file again even if it hasn't changed"
+    DiscoveredServers.pop(DefaultLockFile if fileName is None else fileName, None)
+
+def discoverLockServer(fileName = None):
+    return discoverLockServers(fileName)[0]
+
+def findLockServer(fileName=None, names=None):
+    """
+    returns the (host, port) from the info file that names lives on.  names is a lock or message
+    name, or a list of them that have to all be on the same server
+    """
+    servers = discoverLockServers(fileName)
+    if len(servers) == 1 or names is None:
+        return servers[0]
+    if isinstance(names, str):
+        names = [names]
+    ring = getHashRing(servers)
+    nodes = {ring.nodeFor(name) for name in names}
+    if len(nodes) != 1:
+        raise ValueError("%s are on different lock servers"%" ".join(names))
+    return nodes.pop()
+
+def writeLockServerHostFile(fileName=None, host=None, port=None, servers=None, unixSocket=None):
+    """
+    servers is a list of (host, port) to write a file for several servers instead.  unixSocket is
+    the path of the server's unix domain socket for clients on the same host to use
+    """
+    if fileName is None:
+        fileName = DefaultLockFile
+    if host is None and servers is None:
+        host = getIp()
+    if port is None:
+        port = DefaultLockPort
+
+    with open(fileName, "w") as f:
+        if servers is not None:
+            for sHost, sPort in servers:
+                f.write("server = %s:%s\n"%(sHost, sPort))
+            return
+        f.write("host = %s\n"%host)
+        f.write("port = %s\n"%port)
+        if unixSocket is not None:
+            f.write("unix = %s\n"%unixSocket)
+
+
+def ringHash(key):
+    return int.from_bytes(hashlib.md5(bytes(key, 'ascii')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    consistent hash ring over a list of (host, port) servers.  Each server gets vnodes points on the
+    ring and a name belongs to the server with the first point at or after the name's own hash, so
+    adding or removing a server only moves about 1/N of the names.  Names go by shardKey() so ones
+    sharing a {tag} stay together.
+    """
+    def __init__(self, nodes, vnodes=None):
+        if vnodes is None:
+            vnodes = DefaultVirtualNodes
+        self.nodes = list(nodes)
+        points = sorted((ringHash("%s:%s#%d"%(host, port, i)), (host, port))
+                        for host, port in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, node in points]
+        self.points = [node for h, node in points]
+
+    def nodeFor(self, name):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        i = bisect.bisect_left(self.hashes, ringHash(shardKey(name)))
+        return self.points[i % len(self.points)]
+
+
+def getHashRing(servers):
+    key = tuple(servers)
+    ring = HashRings.get(key)
+    if ring is None:
+        if len(HashRings) > 16:
+            HashRings.clear()
+        ring = HashRings[key] = HashRing(servers)
+    return ring
+
+
+def lockServersFor(names, discoverServer=True, host=None, port=None, lockClient=None):
+    """
+    splits names up by the server each one lives on, returns [(discoverServer, host, port, names)]
+    with the arguments to get a connection to that server
+    """
+    if lockClient is not None or discoverServer is False:
+        return [(discoverServer, host, port, list(names))]
+    servers = discoverLockServers(None if discoverServer is True else discoverServer)
+    ring = getHashRing(servers)
+    groups = {}
+    for name in names:
+        groups.setdefault(ring.nodeFor(name), []).append(name)
+    return [(False, sHost, sPort, group) for (sHost, sPort), group in groups.items()]
+    
+################################################################
+#
+# This is the client code
+#
+# use Lock() and SharedLock() as the main classes and it's
+# easiest to use them in the form of a context manager ie:
+#
+# with Lock("someName"):
+#     some code that needs exclusive access
+#
+#   or
+#
+# with SharedLock("someName"):
+#     some code that needs shared lock access
+#
+################################################################
+
+
+class LockServerBusy(RuntimeError):
+    "the server turned a connection or a wait away because it's overloaded, try again after retry seconds"
+    def __init__(self, retry):
+        super(LockServerBusy, self).__init__("lockserver busy, retry in %s seconds"%retry)
+        self.retry = retry
+
+    @classmethod
+    def fromReply(cls, reply):
+        return cls(float(reply.partition("retry=")[2] or BusyRetry))
+
+
+class LockClient(object):
+    """
+    handles communications with lock server.  Not intended to be directly used by user
+
+    Besides the plain blocking calls, requests can be tagged (sendRequest()/requestLock()) so that
+    any number of them are outstanding on the one connection.  Replies are matched back up to
+    their request by tag whatever order they arrive in.
+
+    With session set to a number of seconds the server holds on to our locks and waits for that
+    long if the connection drops, and we reconnect and pick up where we left off without the
+    caller noticing.
+
+    unixSocket is the path of the server's unix domain socket, connected to instead of host:port
+    when it's there.  By default it's whatever the info file gave for the server (see UnixSockets)
+    """
+    def __init__(self, host=None, port=None, session=None, unixSocket=None):
+        if port is None:
+            port = DefaultLockPort
+        if host is None:
+            host = DefaultLockHost
+        self.host = host
+        self.port = port
+        self.unixSocket = unixSocket if unixSocket is not None else UnixSockets.get((host, port))
+        self.sock = self.connect()
+        self.pool = None  # the LockClientPool this came from, if any
+        self.readBuf = bytearray()
+        self.readPos = 0  # start of the unread part of readBuf
+        self.replies = {}  # key is tag, val is a reply that came in while we were reading for something else
+        self.ignored = set()  # tags of requests nobody is going to ask for the replies to
+        self.nextTag = 0
+        self.expired = set()  # locks the server took back because their lease ran out
+        self.cachedLocks = {}  # key is name of a lock we still hold with cache=1 but aren't using, val is shared
+        self.revoked = set()  # locks taken with cache=1 that the server wants back once we're done with them
+        self.watching = {}  # key is name of a message we're watching, val is its callback or None
+        self.msgUpdates = {}  # key is name of a watched message, val is its latest text (False if cleared)
+        self.msgsSet = {}  # key is name of a message we've set, val is monotonic() when its ttl runs out or None
+        self.latchesSet = set()  # names of the latches we've set
+        self.session = None  # our session token, see startSession()
+        if session is not None:
+            self.startSession(session)
+
+    def connect(self):
+        if self.unixSocket is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.unixSocket)
+                return sock
+            except OSError:
+                # the server may not be listening on it any more, it still has its port
+                sock.close()
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def startSession(self, grace):
+        "ask the server to hold our locks for grace seconds whenever the connection drops"
+        self.sendLines("session %s\n"%grace)
+        result, sp, arg = self.getReply().partition(' ')
+        assert result=="SESSION", "invalid response to session from lock server"
+        token, sp, grace = arg.partition(' ')
+        self.grace = float(grace)
+        self.session = token
+        # both ends count lines from here on so a resume can tell what went missing
+        self.linesRead = 0
+        self.linesSent = 0
+        self.sent = collections.deque()  # the last lines we sent, for sending again after a resume
+
+    def sendLines(self, req):
+        "send one or more lines to the server, if the connection has dropped resume the session"
+        data = bytes(req, 'ascii')
+        if self.session is not None:
+            lines = data.splitlines(True)
+            self.sent.extend(lines)
+            self.linesSent += len(lines)
+            while len(self.sent) > max(ClientResendLines, len(lines)):
+                self.sent.popleft()
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            if self.session is None:
+                raise
+            self.resume()
+
+    def resume(self):
+        """
+        reconnect and take our session back.  Replies we hadn't read yet are sent again by the
+        server and we send again whatever it hadn't received, so nothing is lost or done twice.
+        A server too busy to take the connection is tried again when it says to.  Raises
+        RuntimeError if the server can't be reached within the grace period or doesn't have the
+        session any more
+        """
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        deadline = time.monotonic() + self.grace
+        while True:
+            sock = None
+            try:
+                sock = self.connect()
+                sock.sendall(bytes("resume %s %d\n"%(self.session, self.linesRead), 'ascii'))
+                buf = bytearray()
+                while b'\n' not in buf:
+                    data = sock.recv(ClientReadSize)
+                    if len(data) == 0:
+                        raise ConnectionError("lockserver closed the connection")
+                    buf += data
+                line, sp, buf = buf.partition(b'\n')
+                result, token, received = (line.decode('ascii').split() + [None, None])[:3]
+                if result == "!" and token == "BUSY":
+                    # turned away before the server even read the resume, the session's still there
+                    raise LockServerBusy.fromReply(received or "")
+                if result != "RESUMED":
+                    token = self.session
+                    self.session = None
+                    sock.close()
+                    raise RuntimeError("lockserver lost session %s"%token)
+                resend = self.linesSent - int(received)
+                if resend > len(self.sent):
+                    self.session = None
+                    sock.close()
+                    raise RuntimeError("lockserver session %s missed more than can be sent again"%token)
+                if resend:
+                    sock.sendall(b"".join(itertools.islice(self.sent, len(self.sent) - resend, None)))
+            except (OSError, LockServerBusy) as e:
+                if sock is not None:
+                    sock.close()
+                now = time.monotonic()
+                if now > deadline:
+                    raise RuntimeError("Can't reach lockserver to resume session %s"%self.session)
+                delay = ClientResumeDelay
+                if isinstance(e, LockServerBusy):
+                    # wait as long as the server asked, but not past the end of the grace period
+                    delay = min(e.retry * random.uniform(0.5, 1.5), deadline - now)
+                time.sleep(delay)
+                continue
+            self.sock = sock
+            # anything left in readBuf is coming again
+            self.readBuf = buf
+            self.readPos = 0
+            return
+
+    def readLine(self):
+        "returns the next line from the server, anything read past it is kept for the next call"
+        while True:
+            end = self.readBuf.find(b'\n', self.readPos)
+            if end >= 0:
+                line = self.readBuf[self.readPos:end].decode('ascii').rstrip()
+                self.readPos = end + 1
+                if self.session is not None:
+                    self.linesRead += 1
+                return line
+            del self.readBuf[:self.readPos]
+            self.readPos = 0
+            try:
+                data = self.sock.recv(ClientReadSize)
+            except OSError:
+                if self.session is None:
+                    raise
+                data = b""
+            if len(data) == 0:
+                if self.session is None:
+                    raise RuntimeError("lockserver closed the connection")
+                self.resume()
+                continue
+            self.readBuf += data
+
+    def getReply(self, tag=None):
+        """
+        returns the reply to the request with this tag, or the next untagged reply if tag is None.
+        Replies to other tags that arrive in the meantime are saved for whoever asks for them.
+        Raises LockServerBusy if the server was too busy to take the request
+        """
+        if tag is not None and tag in self.replies:
+            line = self.replies.pop(tag)
+        else:
+            while True:
+                line = self.readLine()
+                if line.startswith('!'):
+                    self.handlePush(line[1:].strip())
+                elif line.startswith('@'):
+                    t, sp, line = line[1:].partition(' ')
+                    if t == tag:
+                        break
+                    self.keepReply(t, line)
+                elif tag is None:
+                    break
+                else:
+                    raise RuntimeError("unexpected untagged response from lockserver")
+        if line.startswith("BUSY"):
+            raise LockServerBusy.fromReply(line)
+        return line
+
+    def nextReply(self):
+        "returns (tag, reply) for whichever outstanding tagged request is answered next"
+        if self.replies:
+            tag = next(iter(self.replies))
+            return tag, self.replies.pop(tag)
+        while True:
+            line = self.readLine()
+            if line.startswith('!'):
+                self.handlePush(line[1:].strip())
+                continue
+            if not line.startswith('@'):
+                raise RuntimeError("unexpected untagged response from lockserver")
+            tag, sp, line = line[1:].partition(' ')
+            if tag in self.ignored:
+                self.ignored.discard(tag)
+                continue
+            return tag, line
+
+    def keepReply(self, tag, line):
+        "save a tagged reply for whoever asks for it"
+        if tag in self.ignored:
+            self.ignored.discard(tag)
+            return
+        self.replies[tag] = line
+
+    def handlePush(self, line):
+        "deal with a line the server sent on its own accord rather than in reply to a request"
+        event, sp, name = line.partition(' ')
+        if event == "EXPIRED":
+            if name in self.cachedLocks:
+                del self.cachedLocks[name]
+            else:
+                self.expired.add(name)
+        elif event == "REVOKE":
+            if name in self.cachedLocks:
+                # nobody's using it so let it go now, without waiting around for the reply
+                del self.cachedLocks[name]
+                self.ignored.add(self.sendRequest("release", name))
+            else:
+                self.revoked.add(name)
+        elif event == "BUSY":
+            # the server is closing the connection rather than take it
+            raise LockServerBusy.fromReply(name)
+        elif event in ("SET", "CLEARED"):
+            mName, sp, text = name.partition(' ')
+            if mName not in self.watching:
+                return  # one that was still on its way when we unwatched
+            if event == "CLEARED":
+                text = False
+            self.msgUpdates[mName] = text
+            callback = self.watching[mName]
+            if callback is not None:
+                callback(mName, text)
+
+    def waitPushes(self, timeout=None):
+        """
+        read whatever the server sends on its own accord for up to timeout seconds (forever if None),
+        returns as soon as something has been dealt with.  This is what calls the watchMsg()
+        callbacks when there's nothing else to do
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        handled = False
+        while True:
+            if self.readBuf.find(b'\n', self.readPos) < 0:
+                if handled:
+                    return True
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                if not select.select([self.sock], [], [], remaining)[0]:
+                    return False
+            line = self.readLine()
+            if line.startswith('!'):
+                self.handlePush(line[1:].strip())
+                handled = True
+            elif line.startswith('@'):
+                t, sp, line = line[1:].partition(' ')
+                self.keepReply(t, line)
+            else:
+                raise RuntimeError("unexpected untagged response from lockserver")
+
+    def pollPushes(self):
+        """
+        deal with whatever the server has already sent on its own accord, without waiting for
+        anything or trying to resume the session.  Returns False if the connection has gone or
+        there was something else waiting that shouldn't have been
+        """
+        while True:
+            try:
+                data = self.sock.recv(ClientReadSize, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError:
+                return False
+            if len(data) == 0:
+                return False
+            self.readBuf += data
+        while self.readBuf.find(b'\n', self.readPos) >= 0:
+            line = self.readLine()
+            if line.startswith('!'):
+                self.handlePush(line[1:].strip())
+            elif line.startswith('@'):
+                t, sp, line = line[1:].partition(' ')
+                self.keepReply(t, line)
+            else:
+                return False
+        return True
+
+    def newTag(self):
+        tag = str(self.nextTag)
+        self.nextTag += 1
+        return tag
+
+    def sendRequest(self, cmd, arg):
+        "send a tagged request without waiting for the reply, returns the tag to pass to getReply()"
+        tag = self.newTag()
+        req = "@%s %s %s\n"%(tag, cmd, arg)
+        self.sendLines(req)
+        return tag
+
+    def batch(self, requests):
+        """
+        sends a list of (cmd, arg) requests in a single write and returns their replies in the same
+        order, so the whole lot costs one round trip.  They're tagged so they can't get mixed up with
+        anything else outstanding.  set has no reply, its slot is None
+        """
+        tags = []
+        req = []
+        for cmd, arg in requests:
+            if cmd == "set":
+                tags.append(None)
+                req.append("%s %s\n"%(cmd, arg))
+            else:
+                tag = self.newTag()
+                tags.append(tag)
+                req.append("@%s %s %s\n"%(tag, cmd, arg))
+        self.sendLines("".join(req))
+        return [None if tag is None else self.getReply(tag) for tag in tags]
+
+    def requestLock(self, cmd, lName):
+        "start any of the lock commands without waiting, returns a tag to pass to lockResult()"
+        if self.cachedLocks:
+            self.dropCached(lName)
+        return self.sendRequest(cmd, lName)
+
+    def lockResult(self, tag):
+        "waits for the result of a lock requested with requestLock()"
+        return self.parseLockReply(self.getReply(tag))
+
+    @staticmethod
+    def parseLockReply(s):
+        result, sp, msg = s.partition(' ')
+        if result == "ACQUIRED":
+            return True
+        if result == "FAILED":
+            return False
+        if result == "ERROR":
+            raise ValueError(msg)
+        # anything else is an error
+        raise RuntimeError("invalid respone from lockserver")
+
+    @staticmethod
+    def lockOptions(timeout=None, lease=None, cache=False):
+        options = ""
+        if timeout is not None:
+            options += " timeout=%s"%timeout
+        if lease is not None:
+            options += " lease=%s"%lease
+        if cache:
+            options += " cache=1"
+        return options
+
+    def getLock(self, cmd, lName, timeout=None, lease=None, cache=False):
+        """
+        issue any of the lock commands, responses are same.  timeout gives up waiting after that many
+        seconds, lease has the server take the lock back if it's held for longer than that.  cache
+        tells the server we'll be keeping it after we're done with it (see keepCached()).  A lock we
+        already have cached is used again if it's in a mode that will do
+        """
+        if self.cachedLocks:
+            if cmd in Lock.cmdDict.values() and self.takeCached(lName, cmd[0] == "s"):
+                return True
+            self.dropCached(lName)
+        self.expired.discard(lName)
+        self.revoked.discard(lName)
+        req = cmd + " " + lName + self.lockOptions(timeout, lease, cache) + "\n"
+        self.sendLines(req)
+        return self.parseLockReply(self.getReply())
+
+    def releaseLock(self, lName, count=None):
+        """
+        returns False if the lease on the lock had already run out.  count gives back just that many
+        of the permits held on a semaphore
+        """
+        req = "release %s\n"%lName if count is None else "release %s %d\n"%(lName, count)
+        self.sendLines(req)
+        s = self.getReply()
+        result, sp, msg = s.partition(' ')
+
+        if lName in self.expired:
+            self.expired.discard(lName)
+            return False
+        assert result=="RELEASED", "invalid response to release from lock server"
+        return True
+
+    def takeCached(self, lName, shared):
+        """
+        use a lock kept by keepCached() again, returns True if we still had it.  That costs no round
+        trip, only a look at what the server has already sent in case it asked for the lock back.
+        Held exclusive it's downgraded if we want it shared, held shared it's let go if we want it
+        exclusive
+        """
+        if not self.pollPushes():
+            raise ConnectionError("lost connection to lockserver")
+        if lName not in self.cachedLocks:
+            return False
+        if self.cachedLocks[lName] != shared and not shared:
+            self.dropCached(lName)
+            return False
+        if self.cachedLocks.pop(lName) != shared:
+            return self.downgradeLock(lName)
+        return True
+
+    def dropCached(self, arg):
+        """
+        let go of any lock named in the arguments of a lock command that we have cached, before the
+        command asks for it some other way.  Names in an mlock list come after the mode
+        """
+        for item in arg.split():
+            name = item if item in self.cachedLocks else item.partition(':')[2]
+            if name in self.cachedLocks:
+                del self.cachedLocks[name]
+                # pipelined ahead of the request that wants it, without waiting for the reply
+                self.ignored.add(self.sendRequest("release", name))
+
+    def keepCached(self, lName, shared):
+        """
+        done with a lock taken with cache, hang on to it rather than releasing it unless the server
+        has already asked for it back.  Returns False if its lease had run out
+        """
+        if not self.pollPushes():
+            raise ConnectionError("lost connection to lockserver")
+        if lName in self.revoked or lName in self.expired:
+            self.revoked.discard(lName)
+            return self.releaseLock(lName)
+        self.cachedLocks[lName] = shared
+        return True
+
+    def upgradeLock(self, lName, timeout=None):
+        """
+        make a shared lock we hold exclusive without letting go of it, returns False if another
+        holder is already waiting to upgrade or it times out (the lock is still held shared)
+        """
+        self.sendLines("upgrade %s%s\n"%(lName, self.lockOptions(timeout)))
+        result, sp, msg = self.getReply().partition(' ')
+        if result == "ERROR":
+            raise ValueError(msg)
+        assert result in ("UPGRADED", "FAILED"), "invalid response to upgrade from lock server"
+        return result == "UPGRADED"
+
+    def downgradeLock(self, lName):
+        "make an exclusive lock we hold shared"
+        self.sendLines("downgrade %s\n"%lName)
+        result, sp, msg = self.getReply().partition(' ')
+        if result == "ERROR":
+            raise ValueError(msg)
+        assert result == "DOWNGRADED", "invalid response to downgrade from lock server"
+        return True
+
+    def renewLock(self, lName, lease=None):
+        "restarts the lease on a lock we hold, returns False if it had already run out"
+        req = "renew %s%s\n"%(lName, self.lockOptions(lease=lease))
+        self.sendLines(req)
+        s = self.getReply()
+        result, sp, msg = s.partition(' ')
+
+        if lName in self.expired:
+            self.expired.discard(lName)
+            return False
+        assert result=="RENEWED", "invalid response to renew from lock server"
+        return True
+
+    def releaseLocks(self, lNames):
+        "releases several locks in one round trip"
+        req = "mrelease %s\n"%" ".join(lNames)
+        self.sendLines(req)
+        s = self.getReply()
+        result, sp, msg = s.partition(' ')
+
+        assert result=="RELEASED", "invalid response to release from lock server"
+        return True
+
+    @staticmethod
+    def parseAccessCount(lName, s):
+        result, name, count = s.split(' ', 2)
+        assert result=="ACCESSCOUNT", "invalid response to requesting a lock count"
+        assert name == lName, "lock name in access count invalid"
+        assert count[0].isdigit(), "lock count is not a number" #not a complete check but I'm probably already excessive
+        return int(count)
+
+    def getAccessCount(self, lName):
+        req = "count %s\n"%lName
+        self.sendLines(req)
+        return self.parseAccessCount(lName, self.getReply())
+
+    def getAccessCounts(self, lNames):
+        "returns {lName: count} for a whole list of locks in one round trip"
+        replies = self.batch([("count", lName) for lName in lNames])
+        return {lName: self.parseAccessCount(lName, s) for lName, s in zip(lNames, replies)}
+
+    def setMsg(self, mName, msg, ttl=None):
+        "with ttl the server drops the message by itself after ttl seconds"
+        if ttl is None:
+            req = f"set {mName} {msg}\n"
+            self.msgsSet[mName] = None
+        else:
+            req = f"setex {mName} {ttl} {msg}\n"
+            self.msgsSet[mName] = time.monotonic() + float(ttl)
+        self.sendLines(req)
+        # don't wait for a response, as there will be none
+
+    def setMsgs(self, msgs):
+        "sets every message in a {mName: msg} dict with a single write"
+        self.sendLines("".join(f"set {mName} {msg}\n" for mName, msg in msgs.items()))
+        self.msgsSet.update(dict.fromkeys(msgs))
+
+    @staticmethod
+    def parseMsg(mName, s):
+        if s == "NOMSG":
+            return False
+
+        result, name, msg = s.split(' ', 2)
+        assert result=="MSG", "invalid response to get message"
+        assert name == mName, "message name in get message invalid"
+        return msg
+
+    def getMsg(self, mName):
+        req = f"get {mName}\n"
+        self.sendLines(req)
+        return self.parseMsg(mName, self.getReply())
+
+    def getMsgs(self, mNames):
+        "returns {mName: msg or False} for a whole list of messages in one round trip"
+        replies = self.batch([("get", mName) for mName in mNames])
+        return {mName: self.parseMsg(mName, s) for mName, s in zip(mNames, replies)}
+
+    def parseMsgs(self, cmd, reply):
+        result, sp, msgs = reply.partition(' ')
+        if result == "ERROR":
+            raise ValueError(msgs)
+        assert result=="MSGS", "invalid response to %s from lock server"%cmd
+        return json.loads(msgs)
+
+    def mgetMsgs(self, mNames):
+        """
+        getMsgs() as a single mget command, so the server has one line to answer rather than one
+        per name.  With a sharded server the names all have to be on one shard
+        """
+        self.sendLines("mget %s\n"%" ".join(mNames))
+        msgs = self.parseMsgs("mget", self.getReply())
+        return {mName: False if msg is None else msg for mName, msg in msgs.items()}
+
+    def scanMsgs(self, prefix, count=None, after=None):
+        """
+        returns {mName: msg} for the messages whose names start with prefix, in name order.  The
+        server returns at most count (MaxScanMsgs by default), pass the last name as after to get
+        the next lot.  With a sharded server the prefix has to include a {tag}
+        """
+        words = [prefix]
+        if count is not None or after is not None:
+            words.append(str(count if count is not None else MaxScanMsgs))
+        if after is not None:
+            words.append(after)
+        self.sendLines("scan %s\n"%" ".join(words))
+        return self.parseMsgs("scan", self.getReply())
+
+    def watchMsg(self, mName, callback=None):
+        """
+        have the server tell us whenever message mName is set or cleared.  callback(mName, text) is
+        called with the new text, or False when it's cleared, as the news is read (see waitPushes())
+        """
+        self.watching[mName] = callback
+        reply = self.batch([("watch", mName)])[0]
+        assert reply.startswith("WATCHING "), "invalid response to watch from lock server"
+
+    def unwatchMsg(self, mName):
+        del self.watching[mName]
+        self.msgUpdates.pop(mName, None)
+        reply = self.batch([("unwatch", mName)])[0]
+        assert reply.startswith("UNWATCHED "), "invalid response to unwatch from lock server"
+
+    def waitMsg(self, mName, timeout=None):
+        """
+        waits for message mName to be set and returns its text, or False if that takes longer than
+        timeout seconds.  Returns straight away if it's already there
+        """
+        watched = mName in self.watching
+        if watched:
+            reply = self.batch([("get", mName)])[0]
+        else:
+            self.watching[mName] = None
+            reply = self.batch([("watch", mName), ("get", mName)])[1]
+        # anything pushed before the reply is older than it
+        self.msgUpdates.pop(mName, None)
+        try:
+            msg = self.parseMsg(mName, reply)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while msg is False:
+                if mName in self.msgUpdates:
+                    msg = self.msgUpdates.pop(mName)
+                    continue
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self.waitPushes(remaining)
+            return msg
+        finally:
+            if not watched:
+                self.unwatchMsg(mName)
+
+    @staticmethod
+    def parseSyncReply(expect, s):
+        result, sp, msg = s.partition(' ')
+        if result == "ERROR":
+            raise ValueError(msg)
+        assert result in (expect, "FAILED"), "invalid response from lock server"
+        return result == expect
+
+    def barrier(self, name, parties, timeout=None):
+        """
+        waits at barrier name until parties clients have got there, returns False if that takes
+        longer than timeout seconds
+        """
+        self.sendLines("barrier %s %d%s\n"%(name, parties, self.lockOptions(timeout)))
+        return self.parseSyncReply("PASSED", self.getReply())
+
+    def setLatch(self, name, count):
+        "set latch name to count, the latch lasts for as long as this connection does"
+        self.sendLines("latch %s %d\n"%(name, count))
+        result, sp, msg = self.getReply().partition(' ')
+        if result == "ERROR":
+            raise ValueError(msg)
+        assert result == "LATCH", "invalid response to latch from lock server"
+        self.latchesSet.add(name)
+
+    def countDown(self, name, count=1):
+        "take count off latch name, returns what's left"
+        self.sendLines("countdown %s %d\n"%(name, count))
+        result, sp, msg = self.getReply().partition(' ')
+        if result == "ERROR":
+            raise ValueError(msg)
+        assert result == "LATCH", "invalid response to countdown from lock server"
+        return int(msg.rpartition(' ')[2])
+
+    def awaitLatch(self, name, timeout=None):
+        "waits for latch name to get to 0, returns False if that takes longer than timeout seconds"
+        self.sendLines("await %s%s\n"%(name, self.lockOptions(timeout)))
+        return self.parseSyncReply("OPEN", self.getReply())
+
+    def getStats(self, what="server"):
+        "the server's stats (see LockConnection.doStats()) decoded from JSON"
+        self.sendLines("stats %s\n"%what)
+        result, sp, stats = self.getReply().partition(' ')
+        assert result=="STATS", "invalid response to stats from lock server"
+        return json.loads(stats)
+    
+    def close(self):
+        try:
+            if self.session is not None:
+                # nobody is going to resume it so have the server let go straight away
+                self.sock.sendall(b"session 0\n")
+            self.sock.close()
+        except:
+            pass
+
+    def ownsState(self):
+        """
+        True if closing the connection would lose something the server keeps for us: messages we've
+        set (until their ttl is up), latches we've set or locks we have cached
+        """
+        if self.latchesSet or self.cachedLocks:
+            return True
+        now = time.monotonic()
+        return any(expiry is None or expiry > now for expiry in self.msgsSet.values())
+
+    def healthy(self):
+        "True if the connection is still up and has nothing left over from a previous user"
+        # pushes are fine, stray replies or the server hanging up mean it's no good to the next user
+        if not self.pollPushes():
+            return False
+        return len(self.readBuf) == self.readPos and not self.replies
+
+
+class LockClientPool(object):
+    """
+    thread safe pool of LockClients for one server.  A LockClient is only ever used by one thread at
+    a time: a thread checking out connections gets the same one back each time until it has checked
+    them all back in, so nested use within a thread shares one connection (and the server sees them
+    as the same owner).  Checked in connections are kept for maxIdle seconds for reuse, or for good
+    if they own messages, latches or cached locks, and at most maxSize connections exist at once
+    after which checkout() waits for one to come back.
+
+    While idle connections have locks cached on them a thread watches them so a lock the server
+    asks for back is released straight away rather than whenever the connection is next used.
+    """
+    def __init__(self, host, port, maxSize=None, maxIdle=None):
+        self.host = host
+        self.port = port
+        self.maxSize = maxSize if maxSize is not None else DefaultPoolSize
+        self.maxIdle = maxIdle if maxIdle is not None else DefaultPoolIdle
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.idle = []  # [(lockClient, time checked in)], oldest first
+        self.size = 0  # connections checked out plus idle ones
+        self.owned = {}  # key is thread id, val is the LockClient checked out by that thread
+        self.refs = {}  # key is LockClient, val is how many times it's checked out
+        self.watcher = None  # thread watching idle connections with cached locks
+
+    def checkout(self):
+        me = threading.get_ident()
+        with self.cond:
+            lc = self.owned.get(me)
+            if lc is not None:
+                self.refs[lc] += 1
+                return lc
+            lc = self.take()
+            self.owned[me] = lc
+            self.refs[lc] = 1
+            return lc
+
+    def checkin(self, lc, broken=False):
+        """
+        give back a connection from checkout(), broken ones (anything that raised part way through
+        a request) are closed rather than reused
+        """
+        with self.cond:
+            if broken:
+                self.refs[lc] = 1
+            self.refs[lc] -= 1
+            if self.refs[lc] > 0:
+                return
+            del self.refs[lc]
+            for thread, owned in list(self.owned.items()):
+                if owned is lc:
+                    del self.owned[thread]
+            if broken or not lc.healthy():
+                lc.close()
+                self.size -= 1
+            else:
+                self.idle.append((lc, time.monotonic()))
+                if lc.cachedLocks and self.watcher is None:
+                    self.watcher = threading.Thread(target=self.watchCached, daemon=True)
+                    self.watcher.start()
+            self.cond.notify()
+
+    def watchCached(self):
+        "runs in its own thread for as long as any idle connection has locks cached on it"
+        while True:
+            with self.cond:
+                caching = {lc.sock: lc for lc, since in self.idle if lc.cachedLocks}
+                if not caching:
+                    self.watcher = None
+                    return
+            try:
+                ready = select.select(list(caching), [], [], CacheRevokeInterval)[0]
+            except (OSError, ValueError):
+                # one was closed under us
+                continue
+            for sock in ready:
+                lc = caching[sock]
+                with self.cond:
+                    # only if nobody has taken it in the meantime, and nobody can while we have it
+                    for i, (idle, since) in enumerate(self.idle):
+                        if idle is lc:
+                            del self.idle[i]
+                            break
+                    else:
+                        continue
+                    if lc.healthy():
+                        self.idle.append((lc, since))
+                    else:
+                        lc.close()
+                        self.size -= 1
+                    self.cond.notify()
+
+    def take(self):
+        "returns an idle connection or a new one, called with self.cond held"
+        while True:
+            self.evict()
+            while self.idle:
+                lc, since = self.idle.pop()
+                if lc.healthy():
+                    return lc
+                lc.close()
+                self.size -= 1
+            if self.size < self.maxSize:
+                break
+            self.cond.wait(self.maxIdle)
+
+        self.size += 1
+        self.cond.release()
+        try:
+            lc = LockClient(self.host, self.port, session=DefaultSessionGrace)
+        except:
+            self.cond.acquire()
+            self.size -= 1
+            self.cond.notify()
+            raise
+        self.cond.acquire()
+        lc.pool = self
+        return lc
+
+    def evict(self):
+        """
+        close the connections that have been idle too long, called with self.cond held.  Ones that
+        own messages, latches or locks are kept, the server would drop those along with them
+        """
+        cutoff = time.monotonic() - self.maxIdle
+        keep = []
+        for lc, since in self.idle:
+            if since < cutoff and not lc.ownsState():
+                lc.close()
+                self.size -= 1
+            else:
+                keep.append((lc, since))
+        self.idle = keep
+
+    def close(self):
+        with self.cond:
+            for lc, since in self.idle:
+                lc.close()
+                self.size -= 1
+            self.idle = []
+
+
+def getLockClientPool(host=None, port=None):
+    "returns the pool of connections to the lock server at host, port"
+    if port is None:
+        port = DefaultLockPort
+    if host is None:
+        host = DefaultLockHost
+    with LockClientPoolsLock:
+        pool = LockClientPools.get((host, port))
+        if pool is None or pool.pid != os.getpid():
+            # connections inherited over a fork belong to the parent
+            pool = LockClientPools[(host, port)] = LockClientPool(host, port)
+        return pool
+
+
+class Lock(object):
+    """
+    This is our basic client lock class.  If used with defaults it will read the 
+    """
+    
+    cmdDict = {(False, False): "xlock",
+               (False, True): "xlockwait",
+               (True, False): "slock",
+               (True, True): "slockwait"}
+
+    def __init__(self, lockName, shared=False, wait=True, discoverServer=True, host=None, port=None, lockClient=None,
+                 timeout=None, lease=None, cache=False):
+        """ 
+        wait can't be set to False if using this as a context manager
+
+        timeout is how many seconds to wait for the lock before giving up.  lease is how many seconds
+        the lock may be held before the server takes it back (see renew())
+
+        cache keeps hold of the lock on the connection after it's released until somebody else wants
+        it, so taking it again from the same thread doesn't need to ask the server.  A cached lock
+        that's taken again keeps its original lease
+        """
+        self.lName = lockName
+        self.shared = shared
+        self.wait = wait
+        self.timeout = timeout
+        self.lease = lease
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.discoverServer=discoverServer
+        self.lockClient = lockClient
+        self.client = None  # the connection the lock is held through
+
+    def __enter__(self):
+        if self.wait == False:
+            raise RuntimeError("Can't use Lock() in context manager with wait set to False")
+
+        if not self.lock():
+            raise RuntimeError("Failed to acquire lock %s"%self.lName)
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def lockArgs(self):
+        return Lock.cmdDict[(self.shared, self.wait)], self.lName
+
+    def names(self):
+        return self.lName
+
+    def lock(self):
+        """
+        a pooled connection stays checked out for as long as the lock is held.  If the server is
+        too busy to queue the request we try again when it says to, until timeout runs out
+        """
+        cmd, arg = self.lockArgs()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        attempts = 0
+        while attempts < 2:
+            lc = None
+            try:
+                lc = getLockConnection(self.discoverServer, self.host, self.port, self.lockClient,
+                                       self.names())
+                timeout = self.timeout if deadline is None else max(deadline - time.monotonic(), 0)
+                result = lc.getLock(cmd, arg, timeout, self.lease, self.cache)
+            except ValueError:
+                raise
+            except LockServerBusy as busy:
+                self.putConnection(lc)
+                wait = busy.retry * random.uniform(0.5, 1.5)
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    return False
+                time.sleep(wait)
+                continue
+            except:
+                if lc is not None:
+                    self.putConnection(lc, True)
+                attempts += 1
+                continue
+            if result:
+                self.client = lc
+            else:
+                self.putConnection(lc)
+            return result
+
+        raise RuntimeError("Can't reach lockserver")
+
+    def putConnection(self, lc, broken=False):
+        if lc is not self.lockClient:
+            lc.pool.checkin(lc, broken)
+
+    def release(self):
+        lc, self.client = self.client, None
+        broken = True
+        try:
+            result = self.releaseWith(lc)
+            broken = False
+            return result
+        finally:
+            self.putConnection(lc, broken)
+
+    def releaseWith(self, lc):
+        if self.cache:
+            return lc.keepCached(self.lName, self.shared)
+        return lc.releaseLock(self.lName)
+
+    def renew(self, lease=None):
+        "restart the lease on the lock, using the original lease time unless another is given"
+        if lease is None:
+            lease = self.lease
+        return self.client.renewLock(self.lName, lease)
+
+    def upgrade(self, timeout=None):
+        """
+        turn the shared lock exclusive without releasing it, waiting for the other shared holders to
+        finish first.  Returns False if someone else is already waiting to upgrade it (one of you
+        has to give up) or timeout seconds pass, it's still held shared then.  The Lock is
+        exclusive from then on, including the next time it's taken
+        """
+        result = self.client.upgradeLock(self.lName, timeout)
+        if result:
+            self.shared = False
+        return result
+
+    def downgrade(self):
+        "turn the exclusive lock shared without releasing it so that shared waiters can join in"
+        self.client.downgradeLock(self.lName)
+        self.shared = True
+        return True
+        
+
+class SharedLock(Lock):
+    def __init__(self, *args, **kwargs):
+        kwargs['shared']=True
+        super(SharedLock, self).__init__(*args, **kwargs)
+
+
+class MultiLock(Lock):
+    """
+    Takes a set of locks in one go.  The server grants them atomically, either all of them or
+    none, so there's a single round trip and no lock ordering deadlocks between jobs.
+
+    shared is either a bool that applies to all of the locks or a collection of the names that
+    should be taken shared (the rest are exclusive)
+    """
+    def __init__(self, lockNames, shared=False, wait=True, discoverServer=True, host=None, port=None, lockClient=None,
+                 timeout=None, lease=None):
+        if shared is True:
+            shared = lockNames
+        elif shared is False:
+            shared = ()
+        self.locks = [(lName, lName in shared) for lName in lockNames]
+        super(MultiLock, self).__init__(" ".join(lockNames), False, wait, discoverServer, host, port, lockClient,
+                                        timeout, lease)
+
+    def lockArgs(self):
+        arg = " ".join("%s:%s"%("s" if shared else "x", lName) for lName, shared in self.locks)
+        return "mlockwait" if self.wait else "mlock", arg
+
+    def names(self):
+        return [lName for lName, shared in self.locks]
+
+    def releaseWith(self, lc):
+        return lc.releaseLocks([lName for lName, shared in self.locks])
+
+    def renew(self, lease=None):
+        if lease is None:
+            lease = self.lease
+        return all([self.client.renewLock(lName, lease) for lName, shared in self.locks])
+
+class HierarchicalLock(Lock):
+    """
+    Locks a path like "db/table/partition" so that it conflicts with locks on the paths above and
+    beneath it.  Locking "db/table" exclusive waits for anyone holding any of its partitions and
+    keeps them out until it's released, but different partitions can still be locked at the same
+    time.  Hierarchical locks are kept apart from plain locks, a name can't be both.  With several
+    servers or shards the root needs a {tag} so the whole tree lives in one place
+    """
+    def lockArgs(self):
+        return "hlockwait" if self.wait else "hlock", "%s %s"%(self.lName, "s" if self.shared else "x")
+
+
+class Semaphore(Lock):
+    """
+    Takes count of the permits of a semaphore on the server, one that lets up to permits of them be
+    held at once (everyone using the name has to agree on permits).  Waiters are woken by the server
+    as soon as enough permits are free and are served in order.
+
+    with lockserver.Semaphore("volume1", 8):
+        print "one of at most 8 writers"
+    """
+    def __init__(self, name, permits, count=1, wait=True, discoverServer=True, host=None, port=None,
+                 lockClient=None, timeout=None, lease=None):
+        self.permits = permits
+        self.count = count
+        super(Semaphore, self).__init__(name, False, wait, discoverServer, host, port, lockClient, timeout, lease)
+
+    def lockArgs(self):
+        return "acquirewait" if self.wait else "acquire", "%s %d %d"%(self.lName, self.count, self.permits)
+
+    def releasePermits(self, count):
+        "give back count of the permits held but keep the rest, release() gives back whatever is left"
+        return self.client.releaseLock(self.lName, count)
+
+
+def setMsg(mName, msg, discoverServer=True, host=None, port=None, lockClient=None, ttl=None):
+    "sets a server message, with ttl it goes away by itself after ttl seconds"
+    for i in range(2):
+        try:
+            with lockConnection(discoverServer, host, port, lockClient, mName) as lc:
+                lc.setMsg(mName, msg, ttl)
+                return
+        except:
+            pass
+
+    raise RuntimeError("Can't reach lockserver")
+    
+
+def getMsg(mName, discoverServer=True, host=None, port=None, lockClient=None):
+    "returns the message text if message exists on the server or otherwise returns False"
+    for i in range(2):
+        try:
+            with lockConnection(discoverServer, host, port, lockClient, mName) as lc:
+                return lc.getMsg(mName)
+        except:
+            pass
+
+    raise RuntimeError("Can't reach lockserver")
+
+
+def lockAccessCount(lockName, discoverServer=True,
+                 host=None, port=None, lockClient=None):
+    for i in range(2):
+        try:
+            with lockConnection(discoverServer, host, port, lockClient, lockName) as lc:
+                return lc.getAccessCount(lockName)
+        except:
+            pass
 
-    def send(self, data):
-        """
-        send data back to the client.  For now I'm going to say that pipelining requests is 
-        not legal and if a send would block then the client is behaving badly and should die.
+    raise RuntimeError("Can't get access count from lock server")
 
-        this will fail on unicode strings
-        """
-        if len(data) != self.clientSocket.send(bytes(data, 'ascii')):
-            self.killClient()
 
-    def killClient(self):
-        for lName,share in self.locks.items():
-            LockDict[lName].release()
+def lockAccessCounts(lockNames, discoverServer=True, host=None, port=None, lockClient=None):
+    "returns {lockName: count} for all of lockNames in one round trip per server"
+    for i in range(2):
+        try:
+            counts = {}
+            for args in lockServersFor(lockNames, discoverServer, host, port, lockClient):
+                with lockConnection(*args[:3], lockClient=lockClient) as lc:
+                    counts.update(lc.getAccessCounts(args[3]))
+            return counts
+        except:
+            pass
 
-        for mName in self.msgs:
-            MsgDict[mName].release(self)
+    raise RuntimeError("Can't get access count from lock server")
 
-        if self.waiting:
-            LockDict[self.waitName].clearWaiting(self, self.waitShared)
 
+def setMsgs(msgs, discoverServer=True, host=None, port=None, lockClient=None):
+    "sets every message in a {mName: msg} dict"
+    for i in range(2):
         try:
-            self.clientSocket.close()
+            for args in lockServersFor(msgs, discoverServer, host, port, lockClient):
+                with lockConnection(*args[:3], lockClient=lockClient) as lc:
+                    lc.setMsgs({mName: msgs[mName] for mName in args[3]})
+            return
         except:
             pass
 
-        del(ClientDict[self.fileno])
+    raise RuntimeError("Can't reach lockserver")
 
-    def socketError(self):
-        self.killClient()
 
+def getMsgs(mNames, discoverServer=True, host=None, port=None, lockClient=None):
+    "returns {mName: msg} for all of mNames in one round trip per server, missing messages are False"
+    for i in range(2):
+        try:
+            msgs = {}
+            for args in lockServersFor(mNames, discoverServer, host, port, lockClient):
+                with lockConnection(*args[:3], lockClient=lockClient) as lc:
+                    msgs.update(lc.getMsgs(args[3]))
+            return msgs
+        except:
+            pass
 
+    raise RuntimeError("Can't reach lockserver")
 
-class LockServer(object):
-    def __init__(self, host='', port=29292):
-        self.host = host
-        self.port = port
 
-        self.serve()
+def scanMsgs(prefix, count=None, discoverServer=True, host=None, port=None, lockClient=None):
+    """
+    returns {mName: msg} for up to count messages whose names start with prefix, in name order.  With
+    several servers in the info file they're all asked unless the prefix has a {tag}
+    """
+    if count is None:
+        count = MaxScanMsgs
+    if lockClient is not None or discoverServer is False or shardKey(prefix) != prefix:
+        servers = [(discoverServer, host, port)]
+    else:
+        servers = [(False, sHost, sPort) for sHost, sPort in
+                   discoverLockServers(None if discoverServer is True else discoverServer)]
+    for i in range(2):
+        try:
+            msgs = {}
+            for args in servers:
+                with lockConnection(*args, lockClient=lockClient, names=prefix) as lc:
+                    msgs.update(lc.scanMsgs(prefix, count))
+            return {mName: msgs[mName] for mName in sorted(msgs)[:count]}
+        except ValueError:
+            raise
+        except:
+            pass
 
+    raise RuntimeError("Can't reach lockserver")
 
-    def serve(self):
-        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listenSocket.bind((self.host, self.port))
-        self.listenSocket.listen(5)
 
-        ClientDict[self.listenSocket.fileno()] = self
-        
-        while True:
-            readList, writeList, exceptList = select.select(ClientDict.keys(), [], ClientDict.keys())
-            for e in exceptList:
-                try:  # we're dealing with some error on the socket so just deal with it and stay alive
-                    ClientDict[e].socketError()
-                except:
-                    pass
-                
-            for r in readList:
-                if r in ClientDict:
-#                try:  # it's extremely possible that r has been expunged from ClientDict by now
-                    ClientDict[r].read()
-#                except:
-#                    pass
+def waitMsg(mName, timeout=None, discoverServer=True, host=None, port=None, lockClient=None):
+    """
+    waits for message mName to be set and returns its text, or False after timeout seconds.  The
+    server tells us when it's set so there's no polling
+    """
+    with lockConnection(discoverServer, host, port, lockClient, mName) as lc:
+        return lc.waitMsg(mName, timeout)
 
-    def read(self):
-        newSock, addr = self.listenSocket.accept()
-        LockConnection(newSock, addr)
 
-    def socketError(self):
-        # something has gone to hell with the server.  Just shut down
-        sys.exit()
-        
+def barrier(name, parties, timeout=None, discoverServer=True, host=None, port=None, lockClient=None):
+    """
+    waits until parties processes have called barrier() with this name then lets them all carry on
+    together.  Returns False if that takes longer than timeout seconds
+    """
+    with lockConnection(discoverServer, host, port, lockClient, name) as lc:
+        return lc.barrier(name, parties, timeout)
 
-LockDict = DefaultDict(lambda dd,key: ServerLock(key)) # key is name of lock, val is ServerLock
-MsgDict = DefaultDict(lambda dd,key: ServerMsg(key)) # key is name of the message, val is ServerMsg
-ClientDict = {} # key is fileno of clientsocket, val is LockConnection
 
-################################################################
-#
-# This section is to set up a few defaults and make the server
-# easily findable in many environments.
-#
-################################################################
+def countDown(name, count=1, discoverServer=True, host=None, port=None, lockClient=None):
+    "take count off latch name, returns what's left.  The latch has to have been set with setLatch()"
+    with lockConnection(discoverServer, host, port, lockClient, name) as lc:
+        return lc.countDown(name, count)
 
-DefaultLockHost = 'localhost'
-DefaultLockPort = 29292
-DefaultLockClient = None
-DefaultLockFile = 'lockserver.info'
 
-def setDefaultLockServer(host, port):
-    global DefaultLockHost
-    global DefaultLockPort
+def awaitLatch(name, timeout=None, discoverServer=True, host=None, port=None, lockClient=None):
+    "waits for latch name to count down to 0, returns False if that takes longer than timeout seconds"
+    with lockConnection(discoverServer, host, port, lockClient, name) as lc:
+        return lc.awaitLatch(name, timeout)
 
-    DefaultLockHost = host
-    DefaultLockPort = port
 
+def lockServerStats(what="server", discoverServer=True, host=None, port=None, lockClient=None):
+    """
+    returns the server's stats: what is "server", "locks" (the most contended ones), "locks <count>"
+    or "lock <name>".  With several servers in the info file the one the lock lives on answers
+    "lock <name>" and the first one everything else
+    """
+    names = what.split()[1:] if what.startswith("lock ") else None
+    with lockConnection(discoverServer, host, port, lockClient, names) as lc:
+        return lc.getStats(what)
 
-def discoverLockServer(fileName = None):
-    global DefaultLockFile
-    global DefaultLockHost
-    global DefaultLockPort
+    
+def getLockConnection(discoverServer=True, host=None, port=None, lockClient=None, names=None):
+    """
+    abstract out the code that chooses whether to connect to the lock server or use an existing 
+    connection, optionally makes the connection, and returns the connection that should be used.
+    this includes waiting some amount of time for the lock server to be started.
 
-    host = DefaultLockHost
-    port = DefaultLockPort
+    unless lockClient is given the connection is checked out of the pool for the server and has to
+    be given back with lc.pool.checkin(lc) (or use lockConnection() which does that).  Pooled
+    connections have a session so if the connection drops it's resumed on the next call
+
+    if the info file lists several servers, names (a name or list of names) picks which one
+    """
+    if lockClient is not None:
+        return lockClient
     
-    if fileName is None:
-        fileName = DefaultLockFile
+    # back off exponentially with some jitter so that a crowd of clients started together don't
+    # all come back at the same moment, and never sooner than a busy server asked
+    delay = ConnectRetryDelay
+    deadline = time.monotonic() + ConnectRetryTime
+    while True:
+        try:
+            if discoverServer is not False:
+                if discoverServer is True:
+                    filename = None
+                else:
+                    filename = discoverServer
+                host, port =  findLockServer(filename, names)
+            return getLockClientPool(host, port).checkout()
+        except ValueError:
+            raise
+        except LockServerBusy as busy:
+            wait = max(delay, busy.retry)
+        except:
+            wait = delay
+            if discoverServer is not False:
+                # the server may have moved without the file looking any different
+                forgetLockServers(filename)
 
-    with open(fileName) as f:
-        lines = f.readlines()
-    for line in lines:
-        line = line.strip()
-        if line.startswith('#'):
-            continue
-        key,eq,val = line.partition('=')
-        if eq != '=':
-            raise RuntimeError("invalid line %s in lockfile pointer %s"%(line, fileName))
-        key = key.strip()
-        val = val.strip()
-        if key == 'host':
-            host = val
-        elif key == 'port':
-            port = int(val)
+        wait *= random.uniform(0.5, 1.5)
+        if time.monotonic() + wait > deadline:
+            break
+        time.sleep(wait)
+        delay = min(delay * 2, ConnectRetryMaxDelay)
+    raise RuntimeError("Can't reach lockserver")
 
-    return host, port
 
-def writeLockServerHostFile(fileName=None, host=None, port=None):
-    global DefaultLockFile
-    global DefaultLockPort
+@contextlib.contextmanager
+def lockConnection(discoverServer=True, host=None, port=None, lockClient=None, names=None):
+    "getLockConnection() for a with block, the connection goes back to its pool at the end"
+    lc = getLockConnection(discoverServer, host, port, lockClient, names)
+    if lc is lockClient:
+        yield lc
+        return
+    try:
+        yield lc
+    except:
+        lc.pool.checkin(lc, True)
+        raise
+    lc.pool.checkin(lc)
 
-    if fileName is None:
-        fileName = DefaultLockFile
-    if host is None:
-        host = getIp()
-    if port is None:
-        port = DefaultLockPort
 
-    with open(fileName, "w") as f:
-        f.write("host = %s\n"%host)
-        f.write("port = %s\n"%port)
-    
 ################################################################
 #
-# This is the client code
+# asyncio client code
 #
-# use Lock() and SharedLock() as the main classes and it's
-# easiest to use them in the form of a context manager ie:
+# AsyncLock() and AsyncSharedLock() work like Lock() and
+# SharedLock() but as async context managers:
 #
-# with Lock("someName"):
+# async with AsyncLock("someName"):
 #     some code that needs exclusive access
 #
-#   or
-#
-# with SharedLock("someName"):
-#     some code that needs shared lock access
+# All of the coroutines in an event loop share one connection
+# to the server, every request on it is tagged so any number of
+# them can be waiting on locks at the same time.
 #
 ################################################################
 
 
-class LockClient(object):
-    "handles communications with lock server.  Not intended to be directly used by user"
-    def __init__(self, host=None, port=None):
+class AsyncGate(object):
+    """
+    the server keeps track of locks per connection, so the coroutines sharing one have to sort out
+    amongst themselves who gets to ask it for a lock.  Shared holders piggyback on the one shared
+    lock the connection has, everyone else waits here until the name is free again.
+    """
+    def __init__(self):
+        self.busy = False  # held exclusively or a request for it is still out at the server
+        self.shared = 0  # coroutines holding it shared
+        self.xWaiting = 0  # new shared holders don't get to jump ahead of these
+        self.waiters = 0
+        self.changed = asyncio.Event()
+
+    def ready(self, shared):
+        if self.busy:
+            return False
+        if shared and self.shared:
+            return not self.xWaiting
+        return not self.shared
+
+    def wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class AsyncLockClient(object):
+    "asyncio version of LockClient.  Not intended to be directly used by user"
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.nextTag = 0
+        self.futures = {}  # key is tag, val is the future waiting on its reply
+        self.abandoned = {}  # key is tag of a cancelled lock wait, val is the lock name
+        self.ignored = set()  # tags whose replies nobody wants
+        self.gates = {}  # key is lock name, val is AsyncGate
+        self.expired = set()
+        self.msgWaiters = {}  # key is name of a watched message, val is the set of futures waiting for it
+        self.closed = False
+        self.readTask = asyncio.ensure_future(self.readReplies())
+
+    @classmethod
+    async def connect(cls, host=None, port=None):
         if port is None:
             port = DefaultLockPort
         if host is None:
             host = DefaultLockHost
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
+        unixSocket = UnixSockets.get((host, port))
+        if unixSocket is not None:
+            try:
+                reader, writer = await asyncio.open_unix_connection(unixSocket, limit=MaxReadBuf)
+                return cls(reader, writer)
+            except OSError:
+                pass
+        reader, writer = await asyncio.open_connection(host, port, limit=MaxReadBuf)
+        return cls(reader, writer)
 
+    async def readReplies(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line.endswith(b'\n'):
+                    break
+                line = line.decode('ascii').rstrip()
+                if line.startswith('!'):
+                    self.handlePush(line[1:].strip())
+                    continue
+                if not line.startswith('@'):
+                    raise RuntimeError("unexpected untagged response from lockserver")
+                tag, sp, reply = line[1:].partition(' ')
+                if tag in self.ignored:
+                    self.ignored.discard(tag)
+                elif tag in self.abandoned:
+                    self.settleAbandoned(self.abandoned.pop(tag), reply)
+                else:
+                    future = self.futures.pop(tag, None)
+                    if future is not None and not future.done():
+                        future.set_result(reply)
+        finally:
+            self.closed = True
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("lost connection to lockserver"))
+            self.futures.clear()
+            for waiters in self.msgWaiters.values():
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(ConnectionError("lost connection to lockserver"))
+            for gate in self.gates.values():
+                gate.wake()
+            self.writer.close()
 
-    def getLock(self, cmd, lName):
-        "issue any of the lock commands, responses are same"
-        req = cmd + " " + lName + "\n"
-        self.sock.send(bytes(req, 'ascii'))
-        s = b''
+    def handlePush(self, line):
+        event, sp, name = line.partition(' ')
+        if event == "EXPIRED":
+            self.expired.add(name)
+        elif event == "SET":
+            mName, sp, text = name.partition(' ')
+            for future in self.msgWaiters.get(mName, ()):
+                if not future.done():
+                    future.set_result(text)
 
-        while b'\n' not in s:
-            s += self.sock.recv(select.PIPE_BUF)
-        assert s.endswith(b'\n'), "invalid strings coming from lock server"
+    def send(self, cmd, arg, wantReply=False):
+        "sends a tagged request, returns (tag, future for the reply) or (tag, None)"
+        if self.closed:
+            raise ConnectionError("lost connection to lockserver")
+        tag = str(self.nextTag)
+        self.nextTag += 1
+        future = None
+        if wantReply:
+            future = asyncio.get_running_loop().create_future()
+            self.futures[tag] = future
+        else:
+            self.ignored.add(tag)
+        self.writer.write(bytes("@%s %s %s\n"%(tag, cmd, arg), 'ascii'))
+        return tag, future
 
-        s = s.rstrip()
-        result, sp, msg = s.partition(b' ')
-        if result == b"ACQUIRED":
-            return True
-        if result == b"FAILED":
-            return False
-        # anything else is an error
-        raise RuntimeError("invalid respone from lockserver")
+    async def request(self, cmd, arg):
+        tag, future = self.send(cmd, arg, True)
+        await self.writer.drain()
+        return await future
 
-    def releaseLock(self, lName):
-        req = "release %s\n"%lName
-        self.sock.send(bytes(req, 'ascii'))
-        s = b""
-        while b"\n" not in s:
-            s += self.sock.recv(select.PIPE_BUF)
-
-        assert s.endswith(b'\n'), "invalid strings coming from lock server"
-        s = s.decode('ascii')
-        s = s.rstrip()
-        result, sp, msg = s.partition(' ')
+    def dropGate(self, lName):
+        gate = self.gates.get(lName)
+        if gate is not None and not (gate.busy or gate.shared or gate.waiters):
+            del self.gates[lName]
+
+    def settleAbandoned(self, lName, reply):
+        "the coroutine waiting on lName went away, give the lock straight back if it was granted"
+        if reply.startswith("ACQUIRED ") and not self.closed:
+            self.send("release", lName)
+        gate = self.gates[lName]
+        gate.busy = False
+        gate.wake()
+        self.dropGate(lName)
+
+    async def getLock(self, cmd, lName, timeout=None, lease=None):
+        "any of the single lock commands, same as LockClient.getLock()"
+        shared = cmd.startswith('s')
+        gate = self.gates.get(lName)
+        if gate is None:
+            gate = self.gates[lName] = AsyncGate()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + float(timeout)
+
+        gate.waiters += 1
+        gate.xWaiting += not shared
+        try:
+            while not gate.ready(shared):
+                if self.closed:
+                    raise ConnectionError("lost connection to lockserver")
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                if not cmd.endswith("wait") or (remaining is not None and remaining <= 0):
+                    return False
+                try:
+                    await asyncio.wait_for(gate.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return False
+
+            if gate.shared:
+                gate.shared += 1
+                return True
+            gate.busy = True
+        finally:
+            gate.waiters -= 1
+            gate.xWaiting -= not shared
+            self.dropGate(lName)
 
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic())
+        self.expired.discard(lName)
+        tag, future = self.send(cmd, lName + LockClient.lockOptions(timeout, lease), True)
+        try:
+            await self.writer.drain()
+            result = LockClient.parseLockReply(await future)
+        except asyncio.CancelledError:
+            # the server might still have us queued, the gate stays busy until it answers
+            if self.futures.pop(tag, None) is not None:
+                self.abandoned[tag] = lName
+            elif future.done() and future.exception() is None:
+                self.settleAbandoned(lName, future.result())
+            raise
+        except:
+            gate.busy = False
+            gate.wake()
+            self.dropGate(lName)
+            raise
+
+        if result and shared:
+            gate.shared = 1
+        gate.busy = result and not shared
+        gate.wake()
+        self.dropGate(lName)
+        return result
+
+    async def releaseLock(self, lName):
+        "returns False if the lease on the lock had already run out"
+        gate = self.gates.get(lName)
+        if gate is not None and gate.shared > 1:
+            # somebody else here still holds it shared
+            gate.shared -= 1
+            return lName not in self.expired
+
+        try:
+            s = await self.request("release", lName)
+        finally:
+            if gate is not None:
+                gate.shared = 0
+                gate.busy = False
+                gate.wake()
+                self.dropGate(lName)
+        result, sp, msg = s.partition(' ')
+        if lName in self.expired:
+            self.expired.discard(lName)
+            return False
         assert result=="RELEASED", "invalid response to release from lock server"
         return True
 
-    def getAccessCount(self, lName):
-        req = "count %s\n"%lName
-        self.sock.send(bytes(req, 'ascii'))
-        s = b""
-        while b"\n" not in s:
-            s += self.sock.recv(select.PIPE_BUF)
-
-        assert s.endswith(b'\n'), "invalid strings coming from lock server"
-        s = s.decode('ascii')
-        s = s.rstrip()
+    async def renewLock(self, lName, lease=None):
+        s = await self.request("renew", lName + LockClient.lockOptions(lease=lease))
+        result, sp, msg = s.partition(' ')
+        if lName in self.expired:
+            self.expired.discard(lName)
+            return False
+        assert result=="RENEWED", "invalid response to renew from lock server"
+        return True
 
+    async def getAccessCount(self, lName):
+        s = await self.request("count", lName)
         result, name, count = s.split(' ', 2)
         assert result=="ACCESSCOUNT", "invalid response to requesting a lock count"
         assert name == lName, "lock name in access count invalid"
-        assert count[0].isdigit(), "lock count is not a number" #not a complete check but I'm probably already excessive
         return int(count)
 
-    def setMsg(self, mName, msg):
-        req = f"set {mName} {msg}\n"
-        self.sock.send(bytes(req, 'ascii'))
-        # don't wait for a response, as there will be none
-
-    def getMsg(self, mName):
-        req = f"get {mName}\n"
-        self.sock.send(bytes(req, 'ascii'))
-
-        s = b""
-        while b"\n" not in s:
-            s += self.sock.recv(select.PIPE_BUF)
-
-        assert s.endswith(b'\n'), "invalid strings coming from lock server"
-        s = s.decode('ascii')
-        s = s.rstrip()
+    async def setMsg(self, mName, msg, ttl=None):
+        if ttl is None:
+            self.send("set", "%s %s"%(mName, msg))
+        else:
+            self.send("setex", "%s %s %s"%(mName, ttl, msg))
+        await self.writer.drain()
 
+    async def getMsg(self, mName):
+        s = await self.request("get", mName)
         if s == "NOMSG":
             return False
-
         result, name, msg = s.split(' ', 2)
         assert result=="MSG", "invalid response to get message"
         assert name == mName, "message name in get message invalid"
         return msg
-    
+
+    async def waitMsg(self, mName, timeout=None):
+        "same as LockClient.waitMsg(), the coroutines waiting on one message share the one watch"
+        future = asyncio.get_running_loop().create_future()
+        waiters = self.msgWaiters.get(mName)
+        if waiters is None:
+            waiters = self.msgWaiters[mName] = set()
+            self.send("watch", mName)
+        waiters.add(future)
+        try:
+            msg = await self.getMsg(mName)
+            if msg is not False:
+                return msg
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return False
+        finally:
+            waiters.discard(future)
+            if not waiters and self.msgWaiters.get(mName) is waiters:
+                del self.msgWaiters[mName]
+                if not self.closed:
+                    self.send("unwatch", mName)
+
     def close(self):
+        self.readTask.cancel()
         try:
-            self.sock.close()
+            self.writer.close()
         except:
             pass
 
-class Lock(object):
-    """
-    This is our basic client lock class.  If used with defaults it will read the 
-    """
-    
-    cmdDict = {(False, False): "xlock",
-               (False, True): "xlockwait",
-               (True, False): "slock",
-               (True, True): "slockwait"}
 
-    def __init__(self, lockName, shared=False, wait=True, discoverServer=True, host=None, port=None, lockClient=None):
-        """ 
-        wait can't be set to False if using this as a context manager
-        """
+class AsyncLock(object):
+    "asyncio version of Lock(), use it with async with or await lock()/release()"
+    def __init__(self, lockName, shared=False, wait=True, discoverServer=True, host=None, port=None, lockClient=None,
+                 timeout=None, lease=None):
         self.lName = lockName
         self.shared = shared
         self.wait = wait
+        self.timeout = timeout
+        self.lease = lease
         self.host = host
         self.port = port
-        self.discoverServer=discoverServer
+        self.discoverServer = discoverServer
         self.lockClient = lockClient
 
-    def __enter__(self):
+    async def __aenter__(self):
         if self.wait == False:
-            raise RuntimeError("Can't use Lock() in context manager with wait set to False")
+            raise RuntimeError("Can't use AsyncLock() in context manager with wait set to False")
 
-        if not self.lock():
+        if not await self.lock():
             raise RuntimeError("Failed to acquire lock %s"%self.lName)
 
-    def __exit__(self, *args):
-        self.release()
+    async def __aexit__(self, *args):
+        await self.release()
 
-    def lock(self):
+    async def lock(self):
         for i in range(2):
             try:
-                self.lockClient = getLockConnection(self.discoverServer, self.host, self.port, self.lockClient)
+                self.lockClient = await getAsyncLockConnection(self.discoverServer, self.host, self.port,
+                                                               self.lockClient, self.lName)
                 cmd = Lock.cmdDict[(self.shared, self.wait)]
-                return self.lockClient.getLock(cmd, self.lName)
-            except:
-                pass
+                return await self.lockClient.getLock(cmd, self.lName, self.timeout, self.lease)
+            except ConnectionError:
+                self.lockClient = None
 
         raise RuntimeError("Can't reach lockserver")
-        
-    def release(self):
-        return self.lockClient.releaseLock(self.lName)
-        
 
-class SharedLock(Lock):
+    async def release(self):
+        return await self.lockClient.releaseLock(self.lName)
+
+    async def renew(self, lease=None):
+        if lease is None:
+            lease = self.lease
+        return await self.lockClient.renewLock(self.lName, lease)
+
+
+class AsyncSharedLock(AsyncLock):
     def __init__(self, *args, **kwargs):
         kwargs['shared']=True
-        super(SharedLock, self).__init__(*args, **kwargs)
+        super(AsyncSharedLock, self).__init__(*args, **kwargs)
+
 
-def setMsg(mName, msg, discoverServer=True, host=None, port=None, lockClient=None):
-    "sets a server message"
+async def asyncSetMsg(mName, msg, discoverServer=True, host=None, port=None, lockClient=None, ttl=None):
+    "sets a server message, with ttl it goes away by itself after ttl seconds"
     for i in range(2):
         try:
-            lc = getLockConnection(discoverServer, host, port, lockClient)
-            lc.setMsg(mName, msg)
+            lc = await getAsyncLockConnection(discoverServer, host, port, lockClient, mName)
+            await lc.setMsg(mName, msg, ttl)
             return
-        except:
+        except ConnectionError:
             pass
 
     raise RuntimeError("Can't reach lockserver")
-    
 
-def getMsg(mName, discoverServer=True, host=None, port=None, lockClient=None):
+
+async def asyncGetMsg(mName, discoverServer=True, host=None, port=None, lockClient=None):
     "returns the message text if message exists on the server or otherwise returns False"
     for i in range(2):
         try:
-            lc = getLockConnection(discoverServer, host, port, lockClient)
-            msg = lc.getMsg(mName)
-            return msg
-        except:
+            lc = await getAsyncLockConnection(discoverServer, host, port, lockClient, mName)
+            return await lc.getMsg(mName)
+        except ConnectionError:
             pass
 
     raise RuntimeError("Can't reach lockserver")
 
 
-def lockAccessCount(lockName, discoverServer=True,
-                 host=None, port=None, lockClient=None):
+async def asyncWaitMsg(mName, timeout=None, discoverServer=True, host=None, port=None, lockClient=None):
+    "waits for message mName to be set and returns its text, or False after timeout seconds"
     for i in range(2):
         try:
-            lockClient = getLockConnection(discoverServer, host, port, lockClient)
-            return lockClient.getAccessCount(lockName)
-        except:
+            lc = await getAsyncLockConnection(discoverServer, host, port, lockClient, mName)
+            return await lc.waitMsg(mName, timeout)
+        except ConnectionError:
+            pass
+
+    raise RuntimeError("Can't reach lockserver")
+
+
+async def asyncLockAccessCount(lockName, discoverServer=True, host=None, port=None, lockClient=None):
+    for i in range(2):
+        try:
+            lc = await getAsyncLockConnection(discoverServer, host, port, lockClient, lockName)
+            return await lc.getAccessCount(lockName)
+        except ConnectionError:
             pass
 
     raise RuntimeError("Can't get access count from lock server")
-    
-def getLockConnection(discoverServer=True, host=None, port=None, lockClient=None):
+
+
+AsyncLockClients = weakref.WeakKeyDictionary()  # key is event loop, val is {(host, port): task connecting to it}
+
+async def getAsyncLockConnection(discoverServer=True, host=None, port=None, lockClient=None, names=None):
     """
-    abstract out the code that chooses whether to connect to the lock server or use an existing 
-    connection, optionally makes the connection, and returns the connection that should be used.
-    this includes waiting some amount of time for the lock server to be started.
+    asyncio version of getLockConnection().  Each event loop gets one connection per server that all
+    of its coroutines share, it's made by whichever gets here first and the rest wait for it.
     """
-    global DefaultLockClient
-
     if lockClient is not None:
         return lockClient
-    if DefaultLockClient is not None:
-        return DefaultLockClient
-    
+
     for i in range(30):
         try:
-            if discoverServer is False:
-                DefaultLockClient = LockClient(self.host, self.port)
-                return DefaultLockClient
-            else:
+            if discoverServer is not False:
                 if discoverServer is True:
                     filename = None
                 else:
                     filename = discoverServer
-                host, port =  discoverLockServer(filename)
-                DefaultLockClient = LockClient(host, port)
-                return DefaultLockClient
+                host, port = findLockServer(filename, names)
+            break
+        except (OSError, RuntimeError):
+            pass
 
-        except:
-            DefaultLockClient = None
+        await asyncio.sleep(5)
+    else:
+        raise RuntimeError("Can't reach lockserver")
 
-        time.sleep(5)
-    raise RuntimeError("Can't reach lockserver")
+    loop = asyncio.get_running_loop()
+    tasks = AsyncLockClients.get(loop)
+    if tasks is None:
+        tasks = AsyncLockClients[loop] = {}
+    task = tasks.get((host, port))
+    if task is not None and task.done() and (task.cancelled() or task.exception() is not None
+                                             or task.result().closed):
+        task = None
+    if task is None:
+        task = tasks[(host, port)] = loop.create_task(connectAsyncLockClient(host, port))
+    return await asyncio.shield(task)
+
+
+async def connectAsyncLockClient(host, port):
+    for i in range(30):
+        try:
+            return await AsyncLockClient.connect(host, port)
+        except OSError:
+            pass
 
+        await asyncio.sleep(5)
+    raise RuntimeError("Can't reach lockserver")
 
 
 ################################################
@@ -698,8 +5246,61 @@ def getLockConnection(discoverServer=True, host=None, port=None, lockClient=None
 ################################################
 
 def main():
-    writeLockServerHostFile()
-    LockServer()
+    parser = argparse.ArgumentParser(description="run the lock server")
+    parser.add_argument("--host", default='', help="address to bind to (default all)")
+    parser.add_argument("--port", type=int, default=DefaultLockPort)
+    parser.add_argument("--policy", choices=LockPolicies, default=LockPolicy,
+                        help="how waiters are served: batch (shared waiters are granted together, the "
+                        "default), fifo (strict arrival order) or writer (writers first)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the locks over this many processes (default 0, a single process)")
+    parser.add_argument("--routers", type=int, default=None,
+                        help="processes taking client connections for --shards (default one per shard)")
+    parser.add_argument("--journal", metavar="DIR", default=None,
+                        help="keep a log and snapshots of the locks and messages in DIR and recover from them "
+                        "on restart")
+    parser.add_argument("--fsync", default="always",
+                        help="how often the journal is synced: always (once per server loop), never or a "
+                        "number of seconds")
+    parser.add_argument("--recovery-grace", type=float, default=None,
+                        help="seconds recovered locks are held for their old owners (default %s)"%
+                        DefaultRecoveryGrace)
+    parser.add_argument("--session-grace", type=float, default=None,
+                        help="longest a dropped client's session is held for it to resume (default %s)"%
+                        MaxSessionGrace)
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve stats in the Prometheus text format on this port (with --shards each shard "
+                        "uses the port plus its index)")
+    parser.add_argument("--max-msg-bytes", type=int, default=None,
+                        help="drop the least recently used messages once they take up more than this many "
+                        "bytes (default no limit, with --shards the limit is per shard)")
+    parser.add_argument("--unix-socket", metavar="PATH", default=None,
+                        help="also listen on a unix domain socket at PATH, clients on this host use it instead "
+                        "of TCP")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="connections queued for the server to accept (default %d)"%DefaultListenBacklog)
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help="client connections to take before answering BUSY (default no limit)")
+    parser.add_argument("--max-host-connections", type=int, default=None,
+                        help="client connections to take from any one host before answering BUSY")
+    parser.add_argument("--max-waiters", type=int, default=None,
+                        help="requests that can be waiting before new waits are answered BUSY (default no limit)")
+    parser.add_argument("--max-client-waiters", type=int, default=None,
+                        help="requests any one connection can have waiting before BUSY")
+    parser.add_argument("--verbose", action="store_true", help="log every client connecting and disconnecting")
+    args = parser.parse_args()
+
+    unixSocket = os.path.abspath(args.unix_socket) if args.unix_socket is not None else None
+    serverArgs = dict(journal=args.journal, fsync=args.fsync, recoveryGrace=args.recovery_grace,
+                      sessionGrace=args.session_grace, metricsPort=args.metrics_port,
+                      maxMsgBytes=args.max_msg_bytes, unixSocket=unixSocket, backlog=args.backlog,
+                      maxConnections=args.max_connections, maxHostConnections=args.max_host_connections,
+                      maxWaiters=args.max_waiters, maxClientWaiters=args.max_client_waiters, verbose=args.verbose)
+    writeLockServerHostFile(port=args.port, unixSocket=unixSocket)
+    if args.shards:
+        ShardedLockServer(args.host, args.port, args.shards, args.routers, policy=args.policy, **serverArgs)
+    else:
+        LockServer(args.host, args.port, policy=args.policy, **serverArgs)
 
 if __name__ == "__main__":
     main()